@@ -21,10 +21,16 @@ setup(
     packages=["simplecpreprocessor"],
     long_description=long_description,
     version=version,
-    extras_require={"tests": test_requires},
+    python_requires=">=3.8",
+    extras_require={
+        "tests": test_requires,
+        "prescan": ["numpy"],
+        "zstd": ["zstandard"],
+    },
     entry_points={
         "console_scripts": [
-            "simplecpreprocessor = simplecpreprocessor.__main__:main"
+            "simplecpreprocessor = simplecpreprocessor.__main__:main",
+            "simplecpreprocessor-daemon = simplecpreprocessor.daemon:main",
         ]
     },
     classifiers=[
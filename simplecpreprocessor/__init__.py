@@ -1,5 +1,12 @@
 from simplecpreprocessor.core import preprocess
-from pkg_resources import get_distribution
-__version__ = get_distribution(__name__).version
 
 __all__ = ["preprocess", "__version__"]
+
+
+def __getattr__(name):
+    # Looking up distribution metadata is slow, only do it when asked
+    if name == "__version__":
+        from importlib.metadata import version
+        value = globals()["__version__"] = version(__name__)
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,7 +1,26 @@
-from simplecpreprocessor import preprocess
+from simplecpreprocessor import preprocess, prune
+from simplecpreprocessor.core import constants_with_defines
+from simplecpreprocessor.filesystem import MappedHeaderHandler, open_mapped
 import argparse
+import os
+import sys
 
-parser = argparse.ArgumentParser()
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size):
+    """
+    Parses a size in bytes with an optional K, M or G suffix.
+    """
+    multiplier = SIZE_UNITS.get(size[-1:].upper())
+    if multiplier is None:
+        return int(size)
+    return int(size[:-1]) * multiplier
+
+
+parser = argparse.ArgumentParser(
+    epilog="Run 'simplecpreprocessor cache --help' to manage a cache "
+           "directory")
 parser.add_argument("--input-file", required=True,
                     help="Header file to parse. Can also be a shim header")
 parser.add_argument("--include-path", action="append",
@@ -10,17 +29,166 @@ parser.add_argument("--include-path", action="append",
 parser.add_argument("--ignore-header", action="append",
                     help="Headers to ignore. Useful for eg CFFI",
                     dest="ignore_headers", default=[])
+parser.add_argument("--define", action="append",
+                    help="Define NAME or NAME=VALUE before processing",
+                    dest="defines", default=[])
+parser.add_argument("--max-include-depth", type=int,
+                    help="Fail if includes nest deeper than this")
+parser.add_argument("--max-expansion", type=int,
+                    help="Fail if a single macro use expands to more tokens")
+parser.add_argument("--max-output", type=int,
+                    help="Fail if output exceeds this many characters")
+parser.add_argument("--timeout", type=float,
+                    help="Fail if preprocessing takes more seconds")
+parser.add_argument("--memory-report", action="store_true",
+                    help="Report peak memory per phase and header to stderr")
+parser.add_argument("--mmap", action="store_true",
+                    help="Memory map input and headers instead of reading")
+parser.add_argument("--lex-workers", type=int,
+                    help="Lex large files in parallel processes, implies "
+                         "--mmap")
+parser.add_argument("--subtree-workers", type=int,
+                    help="Preprocess independent includes of the input file "
+                         "in parallel processes")
+parser.add_argument("--server",
+                    help="Unix socket of a running daemon to delegate to")
+parser.add_argument("--keep-symbol", action="append", dest="keep_symbols",
+                    default=[],
+                    help="Only output top-level declarations needed for "
+                         "given symbol, can be given multiple times")
+parser.add_argument("--line-markers", action="store_true",
+                    help="Annotate output with #line markers pointing at "
+                         "original headers and lines")
+parser.add_argument("--cache-dir",
+                    help="Keep tokenized headers and their outputs in this "
+                         "directory between runs")
+parser.add_argument("--cache-max-size", type=parse_size,
+                    help="Evict least recently used cache entries above "
+                         "this many bytes, K, M or G suffix allowed")
+# Same as cache.ZLIB and cache.ZSTD, cache is imported only when used
+parser.add_argument("--cache-compression", choices=["zlib", "zstd"],
+                    help="Compress cache entries, zstd needs zstandard")
 parser.add_argument("--output-file", required=True,
                     help="Output file that contains preprocessed header(s)")
 
+cache_parser = argparse.ArgumentParser(prog="simplecpreprocessor cache")
+cache_parser.add_argument("action", choices=["stats", "prune", "clear"],
+                          help="Show entry counts and sizes, evict least "
+                               "recently used entries or remove all")
+cache_parser.add_argument("--cache-dir", required=True,
+                          help="Cache directory to manage")
+cache_parser.add_argument("--max-size", type=parse_size,
+                          help="Size in bytes to prune down to, K, M or G "
+                               "suffix allowed")
+
+
+def cache_main(args):
+    from simplecpreprocessor import cache
+    args = cache_parser.parse_args(args)
+    if args.action == "stats":
+        stats = cache.cache_stats(args.cache_dir)
+        sys.stdout.write("%d entries, %d bytes\n" % (stats["entries"],
+                                                     stats["size"]))
+        for suffix in cache.SUFFIXES:
+            kind = stats[suffix[1:]]
+            sys.stdout.write("  %s: %d entries, %d bytes\n" % (
+                suffix[1:], kind["entries"], kind["size"]))
+    elif args.action == "prune":
+        if args.max_size is None:
+            cache_parser.error("prune needs --max-size")
+        removed = cache.prune_cache(args.cache_dir, args.max_size)
+        sys.stdout.write("Removed %d entries\n" % removed)
+    else:
+        removed = cache.clear_cache(args.cache_dir)
+        sys.stdout.write("Removed %d files\n" % removed)
+
+
+def parse_defines(defines):
+    parsed = {}
+    for define in defines:
+        name, sep, value = define.partition("=")
+        parsed[name] = value if sep else "1"
+    return parsed
+
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["cache"]:
+        return cache_main(args[1:])
     args = parser.parse_args(args)
-    with open(args.input_file) as i:
+    if args.line_markers and args.keep_symbols:
+        parser.error("--line-markers can't be combined with --keep-symbol")
+    defines = parse_defines(args.defines)
+    limits = dict(max_include_depth=args.max_include_depth,
+                  max_expansion=args.max_expansion,
+                  max_output=args.max_output, timeout=args.timeout)
+    if args.server is not None:
+        from simplecpreprocessor import daemon
+        output = daemon.request(args.server, input_file=args.input_file,
+                                include_paths=args.include_paths,
+                                ignore_headers=args.ignore_headers,
+                                defines=defines, limits=limits,
+                                line_markers=args.line_markers)
+        if args.keep_symbols:
+            output = "".join(prune.prune([output], args.keep_symbols))
         with open(args.output_file, "w") as o:
-            for line in preprocess(i, include_paths=args.include_paths,
-                                   ignore_headers=args.ignore_headers):
-                o.write(line)
+            o.write(output)
+        return
+    constants = constants_with_defines(defines)
+    lex_executor = None
+    subtree_executor = None
+    if args.lex_workers or args.subtree_workers:
+        # Slow to import, only runs with workers pay for it
+        from concurrent.futures import ProcessPoolExecutor
+        if args.lex_workers:
+            lex_executor = ProcessPoolExecutor(args.lex_workers)
+        if args.subtree_workers:
+            subtree_executor = ProcessPoolExecutor(args.subtree_workers)
+    if args.mmap or lex_executor is not None:
+        header_handler = MappedHeaderHandler((), lex_executor=lex_executor)
+        input_file = open_mapped(args.input_file, lex_executor)
+    else:
+        header_handler = None
+        input_file = open(args.input_file)
+    chunk_cache = None
+    if args.cache_dir is not None:
+        from simplecpreprocessor import cache
+        os.makedirs(args.cache_dir, exist_ok=True)
+        chunk_cache = cache.SharedChunkCache(
+            args.cache_dir, compression=args.cache_compression,
+            max_size=args.cache_max_size)
+    memory_tracker = None
+    if args.memory_report:
+        from simplecpreprocessor.memory import MemoryTracker
+        memory_tracker = MemoryTracker()
+        memory_tracker.start()
+    try:
+        with input_file as i:
+            with open(args.output_file, "w") as o:
+                output = preprocess(i, include_paths=args.include_paths,
+                                    header_handler=header_handler,
+                                    ignore_headers=args.ignore_headers,
+                                    platform_constants=constants,
+                                    memory_tracker=memory_tracker,
+                                    line_markers=args.line_markers,
+                                    subtree_executor=subtree_executor,
+                                    chunk_cache=chunk_cache,
+                                    reuse_output=chunk_cache is not None,
+                                    **limits)
+                if args.keep_symbols:
+                    output = prune.prune(output, args.keep_symbols)
+                for line in output:
+                    o.write(line)
+    finally:
+        if lex_executor is not None:
+            lex_executor.shutdown()
+        if subtree_executor is not None:
+            subtree_executor.shutdown()
+    if memory_tracker is not None:
+        memory_tracker.stop()
+        sys.stderr.write(memory_tracker.format_report())
 
 
-main()
+if __name__ == "__main__":
+    main()
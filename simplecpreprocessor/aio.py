@@ -0,0 +1,88 @@
+"""
+Asyncio front end for the preprocessor. Headers are read in an executor so
+the event loop is never blocked on file system access, and includes are
+loaded concurrently as soon as the including file has been read.
+"""
+import asyncio
+from simplecpreprocessor import core, filesystem
+
+
+class AsyncHeaderHandler(object):
+    """
+    Loads headers through a synchronous header handler in an executor.
+    Every loaded header is scanned for includes which are loaded
+    speculatively, also those in regions that turn out to be inactive.
+    """
+
+    def __init__(self, header_handler, executor=None):
+        self.header_handler = header_handler
+        self.executor = executor
+        self.loading = {}
+
+    def load(self, include_header, anchor_file):
+        key = self.header_handler.resolved_key(include_header, anchor_file)
+        future = self.loading.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor,
+                                          self.header_handler.read_header,
+                                          include_header, anchor_file)
+            future.add_done_callback(self._loaded)
+            self.loading[key] = future
+        return future
+
+    def prefetch(self, f_object):
+        for include_header, local in filesystem.scan_includes(f_object):
+            self.load(include_header, f_object.name if local else None)
+
+    def _loaded(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        f_object = future.result()
+        if f_object is not None:
+            self.prefetch(f_object)
+
+
+class AsyncPreprocessor(core.Preprocessor):
+    """
+    Preprocessor whose include handling yields futures of headers being
+    loaded. These are awaited by preprocess_async before continuing.
+    """
+
+    def __init__(self, *args, **kwargs):
+        executor = kwargs.pop("executor", None)
+        super(AsyncPreprocessor, self).__init__(*args, **kwargs)
+        self.async_headers = AsyncHeaderHandler(self.headers, executor)
+
+    def _read_header(self, header, error, anchor_file=None):
+        if header in self.ignore_headers:
+            return
+        future = self.async_headers.load(header, anchor_file)
+        yield future
+        f = future.result()
+        if f is None:
+            raise error
+        if not self.skip_file(f.name):
+            for chunk in self.preprocess(f):
+                yield chunk
+
+
+async def preprocess_async(f_object, line_ending="\n", include_paths=(),
+                           header_handler=None, platform_constants=None,
+                           ignore_headers=(), executor=None):
+    r"""
+    Asynchronous generator version of preprocess. Output is identical and
+    in the same order. Given file object is read in the executor as well.
+    """
+    preprocessor = AsyncPreprocessor(line_ending, include_paths,
+                                     header_handler, platform_constants,
+                                     ignore_headers, executor=executor)
+    loop = asyncio.get_running_loop()
+    lines = await loop.run_in_executor(executor, list, f_object)
+    f_object = filesystem.MemoryFile(getattr(f_object, "name", None), lines)
+    preprocessor.async_headers.prefetch(f_object)
+    for item in preprocessor.preprocess(f_object):
+        if isinstance(item, asyncio.Future):
+            await item
+        else:
+            yield item
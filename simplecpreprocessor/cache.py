@@ -0,0 +1,541 @@
+import collections
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from simplecpreprocessor import program, recording, tokens
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+MAGIC = b"SCPC\x01\x00\x00\x00"
+HEADER = struct.Struct("<8sII")
+OFFSET = struct.Struct("<I")
+TOKEN = struct.Struct("<II")
+WHITESPACE = 2
+CHUNK_MARK = 1
+# Envelope of compressed entries: magic, compression method and padding
+COMPRESSED = struct.Struct("<4sB3x")
+COMPRESSED_MAGIC = b"SCPZ"
+ZLIB = "zlib"
+ZSTD = "zstd"
+METHODS = {ZLIB: 1, ZSTD: 2}
+SUFFIXES = (".tok", ".rec")
+# Files a cache keeps chunks, programs, summaries and recordings of by
+# default
+MAX_ENTRIES = 1024
+# Share of the size budget a shared cache prunes down to once it's exceeded
+PRUNE_TARGET = 0.9
+# Recordings entries: magic and size of the JSON part before the tokens
+RECORDINGS_MAGIC = b"SCPR\x01\x00\x00\x00"
+RECORDINGS_HEADER = struct.Struct("<8sI")
+# Template slot kinds by name, as slots are told apart by identity
+SLOT_KINDS = {kind: kind for kind in (tokens.LITERAL, tokens.EXPANDED,
+                                      tokens.RAW, tokens.STRINGIFIED,
+                                      tokens.PASTE)}
+
+
+def content_digest(lines):
+    data = "".join(lines).encode("utf-8", "surrogateescape")
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRUCache(collections.OrderedDict):
+    """
+    Dict keeping at most max_entries items, evicting the least recently
+    used one first. Reads through get count as uses. Safe to share between
+    threads, a racing eviction only makes a read miss.
+    """
+
+    def __init__(self, max_entries=None):
+        super(LRUCache, self).__init__()
+        self.max_entries = max_entries
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+            self.move_to_end(key)
+        except KeyError:
+            return default
+        return value
+
+    def __setitem__(self, key, value):
+        super(LRUCache, self).__setitem__(key, value)
+        while self.max_entries is not None and len(self) > self.max_entries:
+            try:
+                self.popitem(last=False)
+            except KeyError:
+                break
+
+
+class ChunkCache(object):
+    """
+    Keeps tokenized chunks of files around so that repeated runs over the
+    same headers don't need to tokenize them again. Entries are keyed by
+    content hash so a changed file is never served stale and identical
+    copies of a file at different paths are tokenized only once. Entries
+    are immutable once stored, so a cache can be shared between threads;
+    concurrent misses for the same file may tokenize it more than once.
+    Compiled programs of files and their summaries are kept in memory next
+    to their chunks, as are recordings of included headers for reusing
+    their output. Each is kept for at most max_entries files, least
+    recently used ones are dropped first.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.chunks = LRUCache(max_entries)
+        self.programs = LRUCache(max_entries)
+        self.summaries = LRUCache(max_entries)
+        self.recordings = LRUCache(max_entries)
+
+    def _load(self, key):
+        return self.chunks.get(key)
+
+    def _store(self, key, chunks):
+        self.chunks[key] = chunks
+        return chunks
+
+    def load(self, f_object, line_ending):
+        """
+        Returns content hash and chunks of given file.
+        """
+        buffer = getattr(f_object, "data", None)
+        if buffer is None:
+            lines = list(f_object)
+            digest = content_digest(lines)
+        else:
+            digest = hashlib.sha1(buffer).hexdigest()
+        key = (digest, line_ending)
+        chunks = self._load(key)
+        if chunks is None:
+            if buffer is None:
+                tokenizer = tokens.Tokenizer(lines, line_ending)
+            else:
+                tokenizer = tokens.tokenizer_for(f_object, line_ending)
+            chunks = self._store(key, list(tokenizer.read_chunks()))
+        return digest, chunks
+
+    def read_chunks(self, f_object, line_ending):
+        return self.load(f_object, line_ending)[1]
+
+    def load_program(self, f_object, line_ending):
+        """
+        Returns content hash and compiled program of given file. Programs
+        are keyed by content hash like chunks, so all paths resolving to
+        the same contents share one.
+        """
+        digest, chunks = self.load(f_object, line_ending)
+        key = (digest, line_ending)
+        compiled = self.programs.get(key)
+        if compiled is None:
+            compiled = program.compile_chunks(chunks)
+            self.programs[key] = compiled
+        return digest, compiled
+
+    def load_summary(self, f_object, line_ending):
+        """
+        Returns content hash and summary of the program of given file.
+        """
+        digest, compiled = self.load_program(f_object, line_ending)
+        key = (digest, line_ending)
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = self.summaries[key] = program.summarize(compiled)
+        return digest, summary
+
+    def load_recordings(self, key):
+        """
+        Returns recordings of a header under given key, latest first.
+        """
+        return self.recordings.get(key, ())
+
+    def store_recording(self, key, recorded):
+        recordings = [recorded]
+        recordings.extend(self.load_recordings(key))
+        self.recordings[key] = recordings[:recording.MAX_RECORDINGS]
+        return self.recordings[key]
+
+
+def encode_chunks(chunks):
+    """
+    Encodes chunks into a compact binary form: a header, offsets into a
+    table of distinct token values, one fixed size record per token and
+    finally the UTF-8 encoded token values.
+    """
+    indices = {}
+    values = []
+    records = []
+    for chunk in chunks:
+        for token in chunk:
+            index = indices.get(token.value)
+            if index is None:
+                index = indices[token.value] = len(values)
+                values.append(token.value.encode("utf-8", "surrogateescape"))
+            flags = index << 2
+            if token.whitespace:
+                flags |= WHITESPACE
+            if token.chunk_mark:
+                flags |= CHUNK_MARK
+            records.append(TOKEN.pack(flags, token.line_no))
+    offsets = [0]
+    for value in values:
+        offsets.append(offsets[-1] + len(value))
+    parts = [HEADER.pack(MAGIC, len(values), len(records))]
+    parts.extend(OFFSET.pack(offset) for offset in offsets)
+    parts.extend(records)
+    parts.extend(values)
+    return b"".join(parts)
+
+
+class ChunkReader(object):
+    """
+    Reads chunks back from a buffer written by encode_chunks. Tokens are
+    decoded lazily while iterating and distinct values only once.
+    """
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        magic, value_count, token_count = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError("Not a chunk cache entry")
+        self.offsets_start = HEADER.size
+        self.records_start = (self.offsets_start +
+                              OFFSET.size * (value_count + 1))
+        self.values_start = self.records_start + TOKEN.size * token_count
+        if len(self.view) < self.values_start:
+            raise ValueError("Truncated chunk cache entry")
+        values_size, = OFFSET.unpack_from(self.view, self.records_start -
+                                          OFFSET.size)
+        if len(self.view) < self.values_start + values_size:
+            raise ValueError("Truncated chunk cache entry")
+        self.values = [None] * value_count
+
+    def _value(self, index):
+        value = self.values[index]
+        if value is None:
+            position = self.offsets_start + OFFSET.size * index
+            start, = OFFSET.unpack_from(self.view, position)
+            end, = OFFSET.unpack_from(self.view, position + OFFSET.size)
+            data = self.view[self.values_start + start:
+                             self.values_start + end]
+            value = bytes(data).decode("utf-8", "surrogateescape")
+            self.values[index] = value
+        return value
+
+    def tokens(self):
+        records = self.view[self.records_start:self.values_start]
+        for flags, line_no in TOKEN.iter_unpack(records):
+            token = tokens.Token(line_no, self._value(flags >> 2),
+                                 bool(flags & WHITESPACE))
+            if flags & CHUNK_MARK:
+                token.chunk_mark = True
+            yield token
+
+    def __iter__(self):
+        chunk = []
+        for token in self.tokens():
+            chunk.append(token)
+            if token.chunk_mark:
+                yield chunk
+                chunk = []
+
+
+def as_tuples(value):
+    if isinstance(value, list):
+        return tuple(as_tuples(item) for item in value)
+    return value
+
+
+def encode_change(value, token_lists):
+    if value is None:
+        return None
+    elif isinstance(value, tokens.FunctionMacro):
+        template = []
+        for kind, slot in value.template:
+            if kind is tokens.LITERAL:
+                token_lists.append([slot])
+                slot = None
+            template.append([kind, slot])
+        return {"params": value.params, "template": template}
+    token_lists.append(value)
+    return len(value)
+
+
+def decode_change(value, stream):
+    if value is None:
+        return None
+    elif isinstance(value, int):
+        return list(itertools.islice(stream, value))
+    template = []
+    for kind, slot in value["template"]:
+        kind = SLOT_KINDS[kind]
+        if kind is tokens.LITERAL:
+            slot = next(stream)
+        template.append((kind, slot))
+    return tokens.FunctionMacro.from_template(value["params"], template)
+
+
+def encode_recordings(recordings):
+    """
+    Encodes recordings of a header as plain data: names, reads and include
+    once marks as JSON, followed by the tokens of final definitions encoded
+    like chunks.
+    """
+    token_lists = []
+    entries = []
+    for recorded in recordings:
+        entries.append({
+            "tested": sorted(recorded.tested),
+            "defined": sorted(recorded.defined),
+            "undefined": sorted(recorded.undefined),
+            "expanded": sorted(recorded.expanded),
+            "reads": list(recorded.reads.items()),
+            "output": recorded.output,
+            "changes": [[name, encode_change(value, token_lists)]
+                        for name, value in recorded.changes.items()],
+            "include_once": list(recorded.include_once.items()),
+        })
+    data = json.dumps(entries).encode("ascii")
+    return b"".join([RECORDINGS_HEADER.pack(RECORDINGS_MAGIC, len(data)),
+                     data, encode_chunks(token_lists)])
+
+
+def decode_recordings(buffer):
+    """
+    Reads recordings back from a buffer written by encode_recordings.
+    """
+    magic, size = RECORDINGS_HEADER.unpack_from(buffer)
+    if magic != RECORDINGS_MAGIC:
+        raise ValueError("Not a recordings cache entry")
+    start = RECORDINGS_HEADER.size
+    view = memoryview(buffer)
+    entries = json.loads(bytes(view[start:start + size]).decode("ascii"))
+    stream = ChunkReader(view[start + size:]).tokens()
+    recordings = []
+    for entry in entries:
+        recorded = recording.Recording()
+        recorded.tested = set(entry["tested"])
+        recorded.defined = set(entry["defined"])
+        recorded.undefined = set(entry["undefined"])
+        recorded.expanded = set(entry["expanded"])
+        recorded.reads = {as_tuples(key): as_tuples(value)
+                          for key, value in entry["reads"]}
+        recorded.output = entry["output"]
+        recorded.changes = {name: decode_change(value, stream)
+                            for name, value in entry["changes"]}
+        recorded.include_once = {key: as_tuples(item)
+                                 for key, item in entry["include_once"]}
+        recordings.append(recorded)
+    return recordings
+
+
+def compress(data, compression):
+    if compression is None:
+        return data
+    elif compression == ZLIB:
+        compressed = zlib.compress(data)
+    elif compression == ZSTD:
+        compressed = zstandard.ZstdCompressor().compress(data)
+    return COMPRESSED.pack(COMPRESSED_MAGIC, METHODS[compression]) + compressed
+
+
+def decompress(data):
+    """
+    Returns contents of an entry, decompressed if it was stored compressed.
+    Uncompressed data is returned as is, without copying.
+    """
+    if data[:len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+        return data
+    _, method = COMPRESSED.unpack_from(data)
+    payload = data[COMPRESSED.size:]
+    if method == METHODS[ZLIB]:
+        return zlib.decompress(payload)
+    elif method == METHODS[ZSTD] and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError("Unsupported cache compression %s" % method)
+
+
+def cache_entries(directory):
+    """
+    Returns path, size and last use time of every entry in a cache
+    directory, least recently used first.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(SUFFIXES):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((path, stat.st_size, stat.st_mtime))
+    entries.sort(key=lambda entry: entry[2])
+    return entries
+
+
+def cache_stats(directory):
+    """
+    Returns entry counts and total sizes in bytes of a cache directory,
+    overall and by kind.
+    """
+    stats = {"entries": 0, "size": 0}
+    for suffix in SUFFIXES:
+        stats[suffix[1:]] = {"entries": 0, "size": 0}
+    for path, size, _ in cache_entries(directory):
+        for kind in (stats, stats[os.path.splitext(path)[1][1:]]):
+            kind["entries"] += 1
+            kind["size"] += size
+    return stats
+
+
+def prune_cache(directory, max_size):
+    """
+    Removes least recently used entries until the total size of a cache
+    directory is at most max_size bytes. Returns the number of entries
+    removed.
+    """
+    entries = cache_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for path, size, _ in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_cache(directory):
+    """
+    Removes all entries of a cache directory and leftover temporary files.
+    Returns the number of files removed.
+    """
+    removed = 0
+    for name in os.listdir(directory):
+        if name.endswith(SUFFIXES + (".tmp",)):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                continue
+            removed += 1
+    return removed
+
+
+class SharedChunkCache(ChunkCache):
+    """
+    Chunk cache stored as one memory mapped file per entry in given
+    directory. Processes sharing the directory fill it for each other and
+    read entries straight from the page cache without unpickling, so memory
+    of workers stays flat. Use a tmpfs directory such as /dev/shm to keep
+    entries in shared memory only.
+
+    Entries can be compressed with zlib or, if zstandard is installed,
+    zstd, trading the zero-copy reads for space. Entries written either
+    way are readable by any cache. Given max_size in bytes, least recently
+    used entries are evicted once writes take the directory over it, down
+    to PRUNE_TARGET of it so that pruning doesn't follow every write; the
+    size is tracked from the writes of this cache in between. Entries count
+    as used when a process first loads them.
+    """
+
+    def __init__(self, directory, compression=None, max_size=None,
+                 max_entries=MAX_ENTRIES):
+        super(SharedChunkCache, self).__init__(max_entries)
+        if compression not in (None, ZLIB, ZSTD):
+            raise ValueError("Unknown compression %s" % compression)
+        if compression == ZSTD and zstandard is None:
+            raise ValueError("zstd compression needs zstandard installed")
+        self.directory = directory
+        self.compression = compression
+        self.max_size = max_size
+        self.size = None
+        self.readers = LRUCache(max_entries)
+
+    def entry_path(self, key, suffix=".tok"):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + suffix)
+
+    def _write(self, path, data):
+        data = compress(data, self.compression)
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if self.max_size is not None and self.size is not None:
+            try:
+                self.size -= os.path.getsize(path)
+            except OSError:
+                pass
+            self.size += len(data)
+        os.replace(temporary, path)
+        if self.max_size is not None:
+            self._check_size()
+
+    def _check_size(self):
+        if self.size is None:
+            self.size = sum(size for _, size, _ in
+                            cache_entries(self.directory))
+        if self.size > self.max_size:
+            prune_cache(self.directory, int(self.max_size * PRUNE_TARGET))
+            # Counted again on the next write, with other writers' entries
+            self.size = None
+
+    def _read(self, path):
+        """
+        Maps an entry and marks it used. Returns None if it's missing.
+        """
+        try:
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (IOError, OSError, ValueError):
+            return None
+        return mapping
+
+    def _load(self, key):
+        reader = self.readers.get(key)
+        if reader is None:
+            mapping = self._read(self.entry_path(key))
+            if mapping is None:
+                return None
+            try:
+                reader = ChunkReader(decompress(mapping))
+            except (ValueError, struct.error, zlib.error):
+                return None
+            self.readers[key] = reader
+        return reader
+
+    def _store(self, key, chunks):
+        self._write(self.entry_path(key), encode_chunks(chunks))
+        return chunks
+
+    def load_recordings(self, key):
+        recordings = self.recordings.get(key)
+        if recordings is None:
+            mapping = self._read(self.entry_path(key, ".rec"))
+            if mapping is None:
+                return ()
+            try:
+                recordings = decode_recordings(decompress(mapping))
+            except (ValueError, KeyError, TypeError, IndexError,
+                    StopIteration, struct.error, zlib.error):
+                return ()
+            self.recordings[key] = recordings
+        return recordings
+
+    def store_recording(self, key, recorded):
+        recordings = super(SharedChunkCache, self).store_recording(
+            key, recorded)
+        self._write(self.entry_path(key, ".rec"),
+                    encode_recordings(recordings))
+        return recordings
@@ -1,9 +1,18 @@
+import time
 from simplecpreprocessor import filesystem, tokens, platform, exceptions
+from simplecpreprocessor import expressions, graph, program
+from simplecpreprocessor import recording
 
-PRAGMA_ONCE = "pragma_once"
+PRAGMA_ONCE = program.PRAGMA_ONCE
 IFDEF = "ifdef"
 IFNDEF = "ifndef"
+IF = "if"
+ELIF = "elif"
 ELSE = "else"
+# Header handlers that subtree workers can recreate from include paths alone
+SUBTREE_HANDLERS = (filesystem.HeaderHandler, filesystem.MappedHeaderHandler)
+# Line gaps up to this long are bridged with empty lines instead of a marker
+MAX_LINE_GAP = 8
 
 
 def constants_to_token_constants(constants):
@@ -11,23 +20,81 @@ def constants_to_token_constants(constants):
             for key, value in constants.items()}
 
 
-TOKEN_CONSTANTS = constants_to_token_constants(platform.PLATFORM_CONSTANTS)
+_token_constants = None
+
+
+def token_constants():
+    global _token_constants
+    if _token_constants is None:
+        _token_constants = constants_to_token_constants(
+            platform.platform_constants())
+    return _token_constants
+
+
+def __getattr__(name):
+    if name == "TOKEN_CONSTANTS":
+        return token_constants()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def constants_with_defines(defines, constants=None):
+    """
+    Returns a copy of token constants extended with given defines, a mapping
+    from define name to its value as a string.
+    """
+    if constants is None:
+        constants = token_constants()
+    constants = dict(constants)
+    constants.update(constants_to_token_constants(defines))
+    return constants
 
 
 class Defines(object):
+    """
+    Macro definitions by name. Reads and writes are noted in all active
+    recordings of headers being preprocessed.
+    """
+
     def __init__(self, base):
         self.defines = base.copy()
+        # Live view of defined names, kept in step by the dict itself
+        self.names = self.defines.keys()
+        self.recordings = []
+
+    def any_defined(self, names):
+        """
+        Tells whether any of given set of names is defined. Costs a lookup
+        per name in the smaller of the two.
+        """
+        if self.recordings:
+            for name in names:
+                if name.isidentifier():
+                    self.record(name)
+        return not self.names.isdisjoint(names)
+
+    def record(self, key, tested=False):
+        value = self.defines.get(key)
+        for recorded in self.recordings:
+            recorded.read_definition(key, value, tested)
 
     def get(self, key, default=None):
+        if self.recordings:
+            self.record(key)
         return self.defines.get(key, default)
 
     def __delitem__(self, key):
+        for recorded in self.recordings:
+            recorded.write_definition(key, False)
         self.defines.pop(key, None)
 
     def __setitem__(self, key, value):
+        for recorded in self.recordings:
+            recorded.write_definition(key, True)
         self.defines[key] = value
 
     def __contains__(self, key):
+        if self.recordings:
+            self.record(key, True)
         return key in self.defines
 
 
@@ -35,9 +102,25 @@ class Preprocessor(object):
 
     def __init__(self, line_ending=tokens.DEFAULT_LINE_ENDING,
                  include_paths=(), header_handler=None,
-                 platform_constants=TOKEN_CONSTANTS,
-                 ignore_headers=()):
+                 platform_constants=None,
+                 ignore_headers=(), chunk_cache=None,
+                 max_include_depth=None, max_expansion=None,
+                 max_output=None, timeout=None, memory_tracker=None,
+                 line_markers=False, subtree_executor=None,
+                 reuse_output=False):
+        if platform_constants is None:
+            platform_constants = token_constants()
+        if ((subtree_executor is not None or reuse_output) and
+                chunk_cache is None):
+            from simplecpreprocessor import cache
+            chunk_cache = cache.ChunkCache()
+        self.platform_constants = platform_constants
         self.ignore_headers = ignore_headers
+        self.chunk_cache = chunk_cache
+        self.subtree_executor = subtree_executor
+        self.subtree_futures = {}
+        self.reuse_output = reuse_output
+        self.file_digests = {}
         self.include_once = {}
         self.defines = Defines(platform_constants)
         self.constraints = []
@@ -45,110 +128,202 @@ class Preprocessor(object):
         self.line_ending = line_ending
         self.last_constraint = None
         self.header_stack = []
-        self.token_expander = tokens.TokenExpander(self.defines)
+        self.digest_stack = []
+        self.token_expander = tokens.TokenExpander(
+            self.defines, max_expansion,
+            None if timeout is None else self.check_deadline)
+        self.evaluator = expressions.Evaluator(
+            self.defines, max_expansion,
+            None if timeout is None else self.check_deadline)
+        self.max_include_depth = max_include_depth
+        self.max_output = max_output
+        self.output_size = 0
+        self.timeout = timeout
+        self.deadline = None
+        self.memory_tracker = memory_tracker
+        self.line_markers = line_markers
+        self.marked_name = None
+        self.marked_line = None
+        self.push_file = None
+        self.push_output = None
+        self.directives = {op: getattr(self, "process_%s" % op)
+                           for op in program.OPERATIONS}
         if header_handler is None:
             self.headers = filesystem.HeaderHandler(include_paths)
         else:
             self.headers = header_handler
             self.headers.add_include_paths(include_paths)
 
-    def process_define(self, **kwargs):
+    def process_define(self, line_no, definition):
         if self.ignore:
             return
-        chunk = kwargs["chunk"]
-        for i, tokenized in enumerate(chunk):
-            if not tokenized.whitespace:
-                define_name = tokenized.value
-                break
-        self.defines[define_name] = chunk[i+2:-1]
+        define_name, replacement = definition
+        self.defines[define_name] = replacement
+
+    def process_invalid(self, line_no, message):
+        raise exceptions.ParseError(message)
 
-    def process_endif(self, **kwargs):
-        line_no = kwargs["line_no"]
+    def process_endif(self, line_no, _):
         if not self.constraints:
             fmt = "Unexpected #endif on line %s"
             raise exceptions.ParseError(fmt % line_no)
         (constraint_type, constraint, ignore,
-         original_line_no) = self.constraints.pop()
+         original_line_no, _) = self.constraints.pop()
         if ignore:
             self.ignore = False
         self.last_constraint = constraint, constraint_type, original_line_no
 
-    def process_else(self, **kwargs):
-        line_no = kwargs["line_no"]
+    def process_else(self, line_no, _):
         if not self.constraints:
             fmt = "Unexpected #else on line %s"
             raise exceptions.ParseError(fmt % line_no)
-        _, constraint, ignore, _ = self.constraints.pop()
-        if self.ignore and ignore:
-            ignore = False
-            self.ignore = False
-        elif not self.ignore and not ignore:
-            ignore = True
+        constraint_type, constraint, ignore, _, taken = self.constraints.pop()
+        if constraint_type is ELSE:
+            fmt = "Unexpected #else after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        ignore, taken = self.next_branch(ignore, taken, True)
+        self.constraints.append((ELSE, constraint, ignore, line_no, taken))
+
+    def next_branch(self, ignore, taken, condition):
+        """
+        Moves to the next branch of a conditional given whether the current
+        one ignores input and whether a branch was taken already. Returns
+        the same for the next branch, which is taken if condition holds.
+        Condition may be a callable so it's only evaluated when needed.
+        """
+        if not taken:
+            if callable(condition):
+                condition = condition()
+            if condition:
+                self.ignore = False
+                return False, True
+        elif not self.ignore:
             self.ignore = True
-        self.constraints.append((ELSE, constraint, ignore, line_no))
-
-    def process_ifdef(self, **kwargs):
-        chunk = kwargs["chunk"]
-        line_no = kwargs["line_no"]
-        for token in chunk:
-            if not token.whitespace:
-                condition = token.value
-                break
-        if not self.ignore and condition not in self.defines:
+            return True, True
+        return ignore, taken
+
+    def push_constraint(self, constraint_type, condition, holds, line_no):
+        if not self.ignore and not holds:
             self.ignore = True
-            self.constraints.append((IFDEF, condition, True, line_no))
+            self.constraints.append((constraint_type, condition, True,
+                                     line_no, False))
         else:
-            self.constraints.append((IFDEF, condition, False, line_no))
-
-    def process_pragma(self, **kwargs):
-        chunk = kwargs["chunk"]
-        line_no = kwargs["line_no"]
-        pragma = None
-        for token in chunk:
-            if not token.whitespace:
-                method_name = "process_pragma_%s" % token.value
-                pragma = getattr(self, method_name, None)
-                break
+            self.constraints.append((constraint_type, condition, False,
+                                     line_no, True))
+
+    def process_ifdef(self, line_no, condition):
+        self.push_constraint(IFDEF, condition, condition in self.defines,
+                             line_no)
+
+    def evaluate(self, text, line_no):
+        try:
+            return self.evaluator.evaluate(text)
+        except exceptions.ParseError as e:
+            raise exceptions.ParseError("%s on line %s" % (e, line_no))
+
+    def process_if(self, line_no, text):
+        holds = self.ignore or self.evaluate(text, line_no)
+        self.push_constraint(IF, text, holds, line_no)
+
+    def process_elif(self, line_no, text):
+        if not self.constraints:
+            fmt = "Unexpected #elif on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        constraint_type, _, ignore, _, taken = self.constraints.pop()
+        if constraint_type is ELSE:
+            fmt = "Unexpected #elif after #else on line %s"
+            raise exceptions.ParseError(fmt % line_no)
+        ignore, taken = self.next_branch(
+            ignore, taken, lambda: self.evaluate(text, line_no))
+        self.constraints.append((ELIF, text, ignore, line_no, taken))
+
+    def process_pragma(self, line_no, name):
+        pragma = getattr(self, "process_pragma_%s" % name, None)
         if pragma is None:
-            s = "Unsupported pragma %s on line %s" % (token.value, line_no)
+            s = "Unsupported pragma %s on line %s" % (name, line_no)
             raise exceptions.ParseError(s)
         else:
-            pragma(chunk=chunk, line_no=line_no)
+            pragma(line_no)
 
-    def process_pragma_once(self, **_):
-        self.include_once[self.current_name()] = PRAGMA_ONCE
+    def process_pragma_once(self, line_no):
+        self.mark_include_once(PRAGMA_ONCE)
 
     def current_name(self):
         return self.header_stack[-1].name
 
-    def process_ifndef(self, **kwargs):
-        chunk = kwargs["chunk"]
-        line_no = kwargs["line_no"]
-        for token in chunk:
-            if not token.whitespace:
-                condition = token.value
-                break
-        if not self.ignore and condition in self.defines:
-            self.ignore = True
-            self.constraints.append((IFNDEF, condition, True, line_no))
-        else:
-            self.constraints.append((IFNDEF, condition, False, line_no))
+    def mark_include_once(self, item):
+        self.set_include_once(self.current_name(), item)
+        digest = self.digest_stack[-1]
+        if digest is not None:
+            # Identical copies elsewhere are recognized by their contents
+            self.set_include_once(digest, item)
 
-    def process_undef(self, **kwargs):
-        chunk = kwargs["chunk"]
-        for token in chunk:
-            if not token.whitespace:
-                undefine = token.value
-                break
+    def set_include_once(self, key, item):
+        if item == PRAGMA_ONCE:
+            # Marks coming from other processes aren't the same object
+            item = PRAGMA_ONCE
+        self.include_once[key] = item
+        for recorded in self.defines.recordings:
+            recorded.mark_include_once(key, item)
+
+    def process_ifndef(self, line_no, condition):
+        self.push_constraint(IFNDEF, condition, condition not in self.defines,
+                             line_no)
+
+    def process_undef(self, line_no, undefine):
+        if self.ignore:
+            return
         del self.defines[undefine]
 
     def process_source_chunks(self, chunk):
-        if not self.ignore:
-            for token in self.token_expander.expand_tokens(chunk):
+        if self.ignore:
+            return
+        expanded = self.token_expander.expand_tokens(chunk)
+        if self.memory_tracker is not None:
+            # Imported only with a tracker, which needs tracemalloc
+            from simplecpreprocessor import memory
+            name = getattr(self.header_stack[-1], "name", None)
+            expanded = self.memory_tracker.track(memory.EXPANSION, name,
+                                                 expanded)
+        if self.max_output is None:
+            for token in expanded:
                 yield token.value
+        else:
+            for token in expanded:
+                self.count_output(token.value, chunk[0].line_no)
+                yield token.value
+
+    def count_output(self, text, line_no):
+        self.output_size += len(text)
+        if self.output_size > self.max_output:
+            fmt = "Output exceeds %s characters on line %s of %s"
+            raise exceptions.ParseError(fmt % (
+                self.max_output, line_no, self.current_name()))
+
+    def check_budgets(self, f_object):
+        if (self.max_include_depth is not None and
+                len(self.header_stack) > self.max_include_depth + 1):
+            fmt = "Include depth exceeds %s when including %s"
+            raise exceptions.ParseError(fmt % (self.max_include_depth,
+                                               f_object.name))
+        if self.timeout is not None and self.deadline is None:
+            self.deadline = time.monotonic() + self.timeout
+
+    def check_deadline(self, line_no=None):
+        if time.monotonic() > self.deadline:
+            if line_no is None:
+                # Errors of expressions get the line number added
+                fmt = "Time limit of %s seconds exceeded in %s"
+                raise exceptions.ParseError(fmt % (self.timeout,
+                                                   self.current_name()))
+            fmt = "Time limit of %s seconds exceeded on line %s of %s"
+            raise exceptions.ParseError(fmt % (self.timeout, line_no,
+                                               self.current_name()))
 
     def skip_file(self, name):
         item = self.include_once.get(name)
+        for recorded in self.defines.recordings:
+            recorded.read((recording.ONCE, name), item)
         if item is PRAGMA_ONCE:
             return True
         elif item is None:
@@ -157,6 +332,8 @@ class Preprocessor(object):
             constraint, constraint_type = item
             if constraint_type == IFDEF:
                 return constraint not in self.defines
+            elif constraint_type == IF:
+                return not self.evaluator.evaluate(constraint)
             else:
                 assert constraint_type == IFNDEF
                 return constraint in self.defines
@@ -168,16 +345,19 @@ class Preprocessor(object):
                 raise error
             elif f is not filesystem.SKIP_FILE:
                 with f:
-                    for chunk in self.preprocess(f):
+                    for chunk in self.preprocess(
+                            f, included_as=(header, anchor_file)):
                         yield chunk
 
-    def process_include(self, **kwargs):
-        chunk = kwargs["chunk"]
-        line_no = kwargs["line_no"]
-        for token in chunk:
-            if not token.whitespace:
-                item = token.value
-                break
+    def process_include(self, line_no, item):
+        if self.ignore:
+            return
+        if len(self.header_stack) == 1 and line_no in self.subtree_futures:
+            future, skipped = self.subtree_futures.pop(line_no)
+            return self.stitch_subtree(future, skipped, line_no, item)
+        return self.read_include(line_no, item)
+
+    def read_include(self, line_no, item):
         s = "Line %s includes a file %s that can't be found" % (line_no,
                                                                 item)
         error = exceptions.ParseError(s)
@@ -191,56 +371,410 @@ class Preprocessor(object):
             fmt = "Invalid include on line %s, got %r for include name"
             raise exceptions.ParseError(fmt % (line_no, item))
 
+    def subtree_settings(self):
+        max_include_depth = self.max_include_depth
+        if max_include_depth is not None:
+            max_include_depth -= 1
+        return (type(self.headers), self.headers.include_paths,
+                self.platform_constants,
+                self.ignore_headers, self.line_ending, self.line_markers,
+                dict(max_include_depth=max_include_depth,
+                     max_expansion=self.token_expander.max_expansion,
+                     max_output=self.max_output, timeout=self.timeout))
+
+    def schedule_subtrees(self, operations):
+        """
+        Submits includes of the top-level file that don't depend on
+        anything before them to the subtree executor. Workers look headers
+        up afresh, so other handlers than plain file system ones are always
+        processed in order. Headers a subtree assumes skipped are passed
+        along with their include once marks.
+        """
+        if type(self.headers) not in SUBTREE_HANDLERS:
+            return
+        include_graph = graph.IncludeGraph(self.headers, self.chunk_cache,
+                                           self.line_ending,
+                                           self.ignore_headers)
+        independent = include_graph.independent_includes(self.current_name(),
+                                                         operations)
+        if not independent:
+            return
+        settings = self.subtree_settings()
+        for op, line_no, item in operations:
+            subtree = independent.get(line_no)
+            if op == "include" and subtree is not None:
+                header, local = graph.include_target(item)
+                anchor_file = self.current_name() if local else None
+                future = self.subtree_executor.submit(
+                    preprocess_subtree, settings, header, anchor_file,
+                    sorted(subtree.writes), subtree.skipped)
+                self.subtree_futures[line_no] = future, subtree.skipped
+
+    def stitch_subtree(self, future, skipped, line_no, item):
+        output, changes, include_once = future.result()
+        if not all(self.skip_file(key) for key in skipped):
+            # A header the worker skipped wouldn't be skipped in order
+            for chunk in self.read_include(line_no, item):
+                yield chunk
+            return
+        for name, value in changes.items():
+            if value is None:
+                del self.defines[name]
+            else:
+                self.defines[name] = value
+        for key, mark in include_once.items():
+            self.set_include_once(key, mark)
+        if self.max_output is not None:
+            self.count_output(output, line_no)
+        # Output of the subtree carries its own line markers
+        self.marked_name = None
+        if output:
+            yield output
+
     def check_fullfile_guard(self):
         if self.last_constraint is None:
             return
         constraint, constraint_type, begin = self.last_constraint
         if begin != 0:
             return
-        self.include_once[self.current_name()] = constraint, constraint_type
+        self.mark_include_once((constraint, constraint_type))
+
+    def read_program(self, f_object):
+        """
+        Returns content hash if known, the program of given file and a
+        callable skipping inactive lines if the tokenizer supports it.
+        Without a chunk cache the program is compiled as it's executed.
+        """
+        if (self.chunk_cache is None or
+                isinstance(f_object, filesystem.PushFile)):
+            tokenizer = tokens.tokenizer_for(f_object, self.line_ending)
+            return (None, map(program.compile_chunk, tokenizer.read_chunks()),
+                    getattr(tokenizer, "skip_inactive", None))
+        digest, operations = self.chunk_cache.load_program(f_object,
+                                                           self.line_ending)
+        if len(self.header_stack) > 1 and self.skip_file(digest):
+            operations = ()
+        return digest, operations, None
+
+    def line_marker(self, chunk):
+        """
+        Returns what to output before chunk so that consumers counting lines
+        from the last #line marker arrive at its source line: nothing, a few
+        empty lines or a new marker. Chunks spanning several lines are
+        followed by a marker as comments may have joined their lines.
+        """
+        line_no = chunk[0].line_no
+        name = self.current_name()
+        if (name == self.marked_name and
+                0 <= line_no - self.marked_line <= MAX_LINE_GAP):
+            marker = self.line_ending * (line_no - self.marked_line)
+        else:
+            quoted = name.replace("\\", "\\\\").replace('"', '\\"')
+            marker = '#line %d "%s"%s' % (line_no + 1, quoted,
+                                          self.line_ending)
+        if chunk[-1].line_no == line_no:
+            self.marked_name = name
+            self.marked_line = line_no + 1
+        else:
+            self.marked_name = None
+        return marker
+
+    def process_source(self, lines):
+        for chunk, names, text in lines:
+            if self.deadline is not None:
+                self.check_deadline(chunk[0].line_no)
+            if self.line_markers:
+                marker = self.line_marker(chunk)
+                if marker:
+                    yield marker
+            if self.defines.any_defined(names):
+                for token in self.process_source_chunks(chunk):
+                    yield token
+            else:
+                # Nothing to expand, the line goes out as it is
+                if self.max_output is not None:
+                    self.count_output(text, chunk[0].line_no)
+                yield text
+
+    def recording_key(self, f_object, digest):
+        return (f_object.name, digest, self.line_ending, self.line_markers,
+                tuple(self.ignore_headers))
+
+    def file_digest(self, header, anchor_file):
+        key = (header, anchor_file)
+        if key not in self.file_digests:
+            f_object = self.headers.read_header(header, anchor_file)
+            if f_object is None:
+                self.file_digests[key] = None
+            else:
+                self.file_digests[key] = self.chunk_cache.load(
+                    f_object, self.line_ending)[0]
+        return self.file_digests[key]
+
+    def still_valid(self, recorded):
+        """
+        Tells whether everything a recording read is the same now.
+        """
+        for key, value in recorded.reads.items():
+            if not isinstance(key, tuple):
+                current = recording.definition_key(
+                    self.defines.defines.get(key))
+            elif key[0] == recording.ONCE:
+                current = self.include_once.get(key[1])
+            else:
+                current = self.file_digest(key[1], key[2])
+            if current != value:
+                return False
+        return True
+
+    def find_recording(self, key):
+        for recorded in self.chunk_cache.load_recordings(key):
+            if self.still_valid(recorded):
+                return recorded
+        return None
+
+    def reuse_recording(self, recorded, line_no):
+        for active in self.defines.recordings:
+            active.merge(recorded)
+        for name, value in recorded.changes.items():
+            if value is None:
+                del self.defines[name]
+            else:
+                self.defines[name] = value
+        for key, item in recorded.include_once.items():
+            self.set_include_once(key, item)
+        if self.max_output is not None:
+            self.count_output(recorded.output, line_no)
+        self.marked_name = None
+        if recorded.output:
+            yield recorded.output
 
-    def preprocess(self, f_object, depth=0):
-        self.header_stack.append(f_object)
-        tokenizer = tokens.Tokenizer(f_object, self.line_ending)
-        for chunk in tokenizer.read_chunks():
+    def start_recording(self, f_object, digest, included_as):
+        """
+        Returns output reused from an earlier run of an included header if
+        one is still valid, or starts a new recording of it.
+        """
+        for active in self.defines.recordings:
+            active.read((recording.FILE,) + included_as, digest)
+        if not self.reuse_output or digest is None:
+            return None, None
+        key = self.recording_key(f_object, digest)
+        recorded = self.find_recording(key)
+        if recorded is not None:
+            return self.reuse_recording(recorded, 0), None
+        recorded = recording.Recording()
+        self.defines.recordings.append(recorded)
+        self.marked_name = None
+        return None, (key, recorded, len(self.constraints))
+
+    def finish_recording(self, started):
+        key, recorded, constraint_depth = started
+        self.defines.recordings.remove(recorded)
+        if len(self.constraints) != constraint_depth:
+            # Conditionals spanning files can't be reused
+            return
+        recorded.output = "".join(recorded.output)
+        recorded.changes = {name: self.defines.defines.get(name)
+                            for name in recorded.defined | recorded.undefined}
+        self.chunk_cache.store_recording(key, recorded)
+
+    def record_output(self, recorded, output):
+        for token in output:
+            recorded.output.append(token)
+            yield token
+
+    def execute(self, operations, skip_inactive):
+        for op, line_no, argument in operations:
+            if op is program.PAUSE:
+                yield tokens.PAUSE
+                continue
             self.last_constraint = None
-            if chunk[0].value == "#":
-                line_no = chunk[0].line_no
-                macro_name = chunk[1].value
-                macro_chunk = chunk[2:]
-                macro = getattr(self, "process_%s" % macro_name, None)
-                if macro is None:
-                    fmt = "Line number %s contains unsupported macro %s"
-                    raise exceptions.ParseError(fmt % (line_no, macro_name))
-                ret = macro(line_no=line_no, chunk=macro_chunk)
+            if op is program.SOURCE:
+                if not self.ignore:
+                    for token in self.process_source(argument):
+                        yield token
+            else:
+                if self.deadline is not None:
+                    self.check_deadline(line_no)
+                ret = self.directives[op](line_no, argument)
                 if ret is not None:
                     for token in ret:
                         yield token
+            if self.ignore and skip_inactive is not None:
+                skip_inactive()
+
+    def preprocess(self, f_object, depth=0, included_as=None):
+        top_level = not self.header_stack
+        if top_level:
+            self.headers.start_prefetch()
+            self.file_digests.clear()
+        try:
+            self.header_stack.append(f_object)
+            self.check_budgets(f_object)
+            digest, operations, skip_inactive = self.read_program(f_object)
+            self.digest_stack.append(digest)
+            if (top_level and self.subtree_executor is not None and
+                    digest is not None):
+                self.schedule_subtrees(operations)
+            reused = started = None
+            if included_as is not None and operations:
+                reused, started = self.start_recording(f_object, digest,
+                                                       included_as)
+            if self.memory_tracker is not None:
+                from simplecpreprocessor import memory
+                name = getattr(f_object, "name", None)
+                operations = self.memory_tracker.track(memory.LEXING, name,
+                                                       operations)
+            if reused is not None:
+                output = reused
             else:
-                for token in self.process_source_chunks(chunk):
-                    yield token
-        self.check_fullfile_guard()
-        self.header_stack.pop()
-        if not self.header_stack and self.constraints:
-            constraint_type, name, _, line_no = self.constraints[-1]
-            if constraint_type is IFDEF:
-                fmt = "#ifdef {name} from line {line_no} left open"
-            elif constraint_type is IFNDEF:
-                fmt = "#ifndef {name} from line {line_no} left open"
-            else:
-                fmt = "#else from line {line_no} left open"
-            raise exceptions.ParseError(fmt.format(name=name,
-                                                   line_no=line_no))
+                output = self.execute(operations, skip_inactive)
+            if started is not None:
+                output = self.record_output(started[1], output)
+            for token in output:
+                yield token
+            self.check_fullfile_guard()
+            # The including file continues after its #include, not after
+            # the #endif of this one
+            self.last_constraint = None
+            if started is not None:
+                self.finish_recording(started)
+            self.header_stack.pop()
+            self.digest_stack.pop()
+            if top_level and self.constraints:
+                self.raise_open_constraint()
+        finally:
+            if top_level:
+                self.headers.drop_prefetched()
+                for future, _ in self.subtree_futures.values():
+                    future.cancel()
+                self.subtree_futures.clear()
+                del self.defines.recordings[:]
+
+    def _drive_push(self):
+        output = []
+        for item in self.push_output:
+            if item is tokens.PAUSE:
+                break
+            output.append(item)
+        return output
+
+    def feed(self, data):
+        """
+        Pushes the next piece of input, text or UTF-8 bytes, and returns
+        output for all lines completed so far as a list of chunks. Lines
+        may be split between pieces.
+        """
+        if self.push_file is None:
+            self.push_file = filesystem.PushFile()
+            self.push_output = self.preprocess(self.push_file)
+            self._drive_push()
+        elif self.push_file.pushed.closed:
+            raise ValueError("Input already closed")
+        self.push_file.push(data)
+        return self._drive_push()
+
+    def close(self):
+        """
+        Ends pushed input and returns the rest of the output. Raises
+        ParseError like preprocess if conditionals are left open.
+        """
+        if self.push_file is None:
+            self.feed("")
+        self.push_file.close()
+        return self._drive_push()
+
+    def raise_open_constraint(self):
+        constraint_type, name, _, line_no, _ = self.constraints[-1]
+        if constraint_type is IFDEF:
+            fmt = "#ifdef {name} from line {line_no} left open"
+        elif constraint_type is IFNDEF:
+            fmt = "#ifndef {name} from line {line_no} left open"
+        elif constraint_type is IF:
+            fmt = "#if {name} from line {line_no} left open"
+        elif constraint_type is ELIF:
+            fmt = "#elif {name} from line {line_no} left open"
+        else:
+            fmt = "#else from line {line_no} left open"
+        raise exceptions.ParseError(fmt.format(name=name, line_no=line_no))
+
+
+_subtree_cache = None
+
+
+def preprocess_subtree(settings, include_header, anchor_file, writes,
+                       skipped=None):
+    """
+    Preprocesses a header on its own in a worker, starting from the
+    platform constants given in settings and the include once marks of
+    headers to skip. Returns its output, the final definitions of names in
+    writes, None for undefined ones, and include once state it set for the
+    caller to apply.
+    """
+    skipped = skipped or {}
+    global _subtree_cache
+    if _subtree_cache is None:
+        from simplecpreprocessor import cache
+        _subtree_cache = cache.ChunkCache()
+    (handler_type, include_paths, constants, ignore_headers, line_ending,
+     line_markers, limits) = settings
+    headers = handler_type(include_paths)
+    preprocessor = Preprocessor(line_ending, header_handler=headers,
+                                platform_constants=constants,
+                                ignore_headers=ignore_headers,
+                                chunk_cache=_subtree_cache,
+                                line_markers=line_markers, **limits)
+    for key, item in skipped.items():
+        preprocessor.set_include_once(key, item)
+        if item != PRAGMA_ONCE:
+            # Only tested by the skip, uses of guards aren't independent
+            preprocessor.defines[item[0]] = []
+    # Opened like the caller would so names and content hashes match
+    f_object = headers.open_header(include_header, lambda name: False,
+                                   anchor_file)
+    if f_object is None:
+        fmt = "Subtree header %s can't be found"
+        raise exceptions.ParseError(fmt % include_header)
+    with f_object:
+        output = "".join(preprocessor.preprocess(f_object))
+    changes = {name: preprocessor.defines.get(name) for name in writes}
+    include_once = {key: item for key, item in
+                    preprocessor.include_once.items() if key not in skipped}
+    return output, changes, include_once
 
 
 def preprocess(f_object, line_ending="\n", include_paths=(),
                header_handler=None,
-               platform_constants=TOKEN_CONSTANTS,
-               ignore_headers=()):
+               platform_constants=None,
+               ignore_headers=(), max_include_depth=None,
+               max_expansion=None, max_output=None, timeout=None,
+               memory_tracker=None, line_markers=False,
+               subtree_executor=None, chunk_cache=None, reuse_output=False):
     r"""
     This preprocessor yields chunks of text that combined results in lines
     delimited with given line ending. There is always a final line ending.
+    Budgets for include depth, tokens produced by a single macro use,
+    characters of output and seconds of wall-clock time can be given, a
+    ParseError is raised as soon as one of them is exceeded. Peak memory
+    is recorded into memory_tracker if one is given. With line_markers
+    output is annotated with #line markers pointing at the header and line
+    each output line came from. Given a subtree_executor, includes of
+    f_object that don't depend on anything before them are preprocessed
+    in parallel by it, reading headers from the file system. A chunk
+    cache keeps tokenized headers between calls and with reuse_output also
+    outputs of headers whose inputs are unchanged.
     """
     preprocessor = Preprocessor(line_ending, include_paths, header_handler,
-                                platform_constants, ignore_headers)
-    return preprocessor.preprocess(f_object)
+                                platform_constants, ignore_headers,
+                                max_include_depth=max_include_depth,
+                                max_expansion=max_expansion,
+                                max_output=max_output, timeout=timeout,
+                                memory_tracker=memory_tracker,
+                                line_markers=line_markers,
+                                subtree_executor=subtree_executor,
+                                chunk_cache=chunk_cache,
+                                reuse_output=reuse_output)
+    if memory_tracker is None:
+        return preprocessor.preprocess(f_object)
+    return memory_tracker.track_output(getattr(f_object, "name", None),
+                                       preprocessor.preprocess(f_object))
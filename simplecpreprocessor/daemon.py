@@ -0,0 +1,198 @@
+"""
+Long-lived preprocessing server. Keeps header resolution and tokenized
+headers warm between requests so that short invocations don't pay the cold
+start again. Requests and responses are single lines of JSON over a Unix
+socket.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+from simplecpreprocessor import cache, core, exceptions, filesystem
+
+LIMITS = ("max_include_depth", "max_expansion", "max_output", "timeout")
+# Include path combinations a server keeps header handlers for
+MAX_HANDLERS = 64
+INVALIDATE = "invalidate"
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            if request.get("command") == INVALIDATE:
+                self.server.invalidate()
+                response = {"output": ""}
+            else:
+                response = {"output": self.server.preprocess(request)}
+        except (exceptions.ParseError, IOError) as e:
+            response = {"error": str(e)}
+        except Exception as e:
+            # Any failure of a request is reported to its client
+            response = {"error": "%s: %s" % (type(e).__name__, e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class PreprocessServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    Serves each connection in its own thread. Header handlers and the chunk
+    cache are shared between requests, preprocessor state is not. Both are
+    bounded, handlers to the MAX_HANDLERS most recently used include paths,
+    and dropped by invalidate() when headers have moved.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, store=None):
+        self.header_handlers = cache.LRUCache(MAX_HANDLERS)
+        self.handlers_lock = threading.Lock()
+        self.chunk_cache = cache.ChunkCache()
+        self.store = store
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               RequestHandler)
+
+    def invalidate(self):
+        with self.handlers_lock:
+            self.header_handlers.clear()
+            self.chunk_cache = cache.ChunkCache()
+
+    def header_handler(self, include_paths):
+        key = tuple(include_paths)
+        with self.handlers_lock:
+            handler = self.header_handlers.get(key)
+            if handler is None and self.store is not None:
+                handler = filesystem.StoreHandler(self.store, include_paths,
+                                                  overlay=True)
+            elif handler is None:
+                handler = filesystem.HeaderHandler(include_paths)
+            self.header_handlers[key] = handler
+        return handler
+
+    def preprocess(self, request):
+        handler = self.header_handler(request.get("include_paths", ()))
+        constants = core.constants_with_defines(request.get("defines", {}))
+        limits = request.get("limits", {})
+        preprocessor = core.Preprocessor(
+            line_ending=request.get("line_ending", "\n"),
+            header_handler=handler,
+            platform_constants=constants,
+            ignore_headers=request.get("ignore_headers", ()),
+            chunk_cache=self.chunk_cache,
+            line_markers=request.get("line_markers", False),
+            reuse_output=True,
+            **{name: limits.get(name) for name in LIMITS})
+        if "input_text" in request:
+            f_object = filesystem.MemoryFile(
+                request.get("input_name", "<input>"),
+                request["input_text"].splitlines(True))
+            return "".join(preprocessor.preprocess(f_object))
+        with open(request["input_file"]) as f_object:
+            return "".join(preprocessor.preprocess(f_object))
+
+
+def request(socket_path, input_file=None, input_text=None, include_paths=(),
+            ignore_headers=(), defines=None, line_ending="\n",
+            limits=None, line_markers=False):
+    """
+    Sends a preprocessing request to a server listening on socket_path and
+    returns the output as a string. Either input_file or input_text needs
+    to be given. Relative paths are resolved against the current directory
+    since the server may be running elsewhere. Limits is a mapping of
+    budgets as accepted by Preprocessor.
+    """
+    message = {
+        "include_paths": [os.path.abspath(p) for p in include_paths],
+        "ignore_headers": list(ignore_headers),
+        "defines": dict(defines or {}),
+        "line_ending": line_ending,
+        "limits": dict(limits or {}),
+        "line_markers": line_markers,
+    }
+    if input_text is not None:
+        message["input_text"] = input_text
+    else:
+        message["input_file"] = os.path.abspath(input_file)
+    return send(socket_path, message)
+
+
+def invalidate(socket_path):
+    """
+    Makes a server listening on socket_path drop its header handlers and
+    chunk cache, so header resolutions are looked up again.
+    """
+    send(socket_path, {"command": INVALIDATE})
+
+
+def send(socket_path, message):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            buf = sock.recv(65536)
+            if not buf:
+                break
+            data.append(buf)
+    finally:
+        sock.close()
+    response = json.loads(b"".join(data).decode("utf-8"))
+    if "error" in response:
+        raise exceptions.ParseError(response["error"])
+    return response["output"]
+
+
+def remove_stale_socket(socket_path):
+    try:
+        mode = os.stat(socket_path).st_mode
+    except OSError:
+        return
+    if stat.S_ISSOCK(mode):
+        os.unlink(socket_path)
+
+
+def load_store(paths):
+    """
+    Loads directories and serialized header stores into one store.
+    """
+    headers = {}
+    for path in paths:
+        if os.path.isdir(path):
+            store = filesystem.HeaderStore.from_directory(path)
+        else:
+            with open(path, "rb") as f:
+                store = filesystem.HeaderStore.loads(f.read())
+        headers.update(store.headers)
+    return filesystem.HeaderStore(headers)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--socket", required=True,
+                    help="Path of the Unix socket to listen on")
+parser.add_argument("--preload", action="append", default=[],
+                    help="Directory or serialized header store to keep "
+                    "in memory")
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    remove_stale_socket(args.socket)
+    store = load_store(args.preload) if args.preload else None
+    server = PreprocessServer(args.socket, store)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        remove_stale_socket(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""
+Evaluation of #if and #elif expressions. Each distinct expression text is
+parsed once into a Python function taking callbacks for macro values and
+defined(), so evaluating it again only costs define lookups.
+"""
+import codecs
+import operator
+import re
+from simplecpreprocessor import exceptions, tokens
+
+LEXEME = re.compile(r"""
+    (?P<space>(?:\s|\\\r?\n)+) |
+    (?P<number>\d\w*) |
+    (?P<name>[A-Za-z_]\w*) |
+    (?P<char>'(?:\\.|[^'\\])+') |
+    (?P<op>&&|\|\||<<|>>|<=|>=|==|!=|[-+*/%<>&^|!~?:(),])
+    """, re.VERBOSE)
+NUMBER = re.compile(r"(0[xX][0-9a-fA-F]+|0[bB][01]+|\d+)[uUlL]*$")
+# Binary operators from lowest to highest precedence
+BINARY = (("||",), ("&&",), ("|",), ("^",), ("&",), ("==", "!="),
+          ("<", ">", "<=", ">="), ("<<", ">>"), ("+", "-"), ("*", "/", "%"))
+FORMATS = {
+    "||": "((%s or %s) and 1 or 0)",
+    "&&": "(%s and %s and 1 or 0)",
+}
+HELPER_NAMES = {
+    "|": "_or", "^": "_xor", "&": "_and", "==": "_eq", "!=": "_ne",
+    "<": "_lt", ">": "_gt", "<=": "_le", ">=": "_ge", "<<": "_lshift",
+    ">>": "_rshift", "+": "_add", "-": "_sub", "*": "_mul", "/": "_div",
+    "%": "_mod",
+}
+END = None
+# Expressions are evaluated in intmax_t and uintmax_t, 64 bits wide
+BITS = 64
+MASK = (1 << BITS) - 1
+SIGN = 1 << (BITS - 1)
+
+
+class Unsigned(int):
+    """
+    Value of type uintmax_t. Plain ints are values of type intmax_t.
+    """
+    __slots__ = ()
+
+
+def _wrap(value, unsigned):
+    value &= MASK
+    if unsigned:
+        return Unsigned(value)
+    return value - (1 << BITS) if value & SIGN else value
+
+
+def _promote(left, right):
+    """
+    Converts both operands to uintmax_t if either one is unsigned.
+    """
+    if isinstance(left, Unsigned) or isinstance(right, Unsigned):
+        return True, left & MASK, right & MASK
+    return False, left, right
+
+
+def _arithmetic(function):
+    def apply(left, right):
+        unsigned, left, right = _promote(left, right)
+        return _wrap(function(left, right), unsigned)
+    return apply
+
+
+def _comparison(function):
+    def apply(left, right):
+        _, left, right = _promote(left, right)
+        return 1 if function(left, right) else 0
+    return apply
+
+
+def _truncated(left, right):
+    if right == 0:
+        raise exceptions.ParseError("Division by zero")
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+
+def _div(left, right):
+    unsigned, left, right = _promote(left, right)
+    return _wrap(_truncated(left, right), unsigned)
+
+
+def _mod(left, right):
+    unsigned, left, right = _promote(left, right)
+    return _wrap(left - right * _truncated(left, right), unsigned)
+
+
+def _shift_count(right):
+    count = right & MASK if isinstance(right, Unsigned) else right
+    if not 0 <= count < BITS:
+        raise exceptions.ParseError("Shift count %s out of range" % count)
+    return count
+
+
+def _lshift(left, right):
+    return _wrap(left << _shift_count(right), isinstance(left, Unsigned))
+
+
+def _rshift(left, right):
+    return _wrap(left >> _shift_count(right), isinstance(left, Unsigned))
+
+
+def _neg(value):
+    return _wrap(-value, isinstance(value, Unsigned))
+
+
+def _invert(value):
+    return _wrap(~value, isinstance(value, Unsigned))
+
+
+HELPERS = {
+    "__builtins__": {}, "_Unsigned": Unsigned, "_div": _div, "_mod": _mod,
+    "_lshift": _lshift, "_rshift": _rshift, "_neg": _neg,
+    "_invert": _invert,
+    "_or": _arithmetic(operator.or_), "_xor": _arithmetic(operator.xor),
+    "_and": _arithmetic(operator.and_), "_add": _arithmetic(operator.add),
+    "_sub": _arithmetic(operator.sub), "_mul": _arithmetic(operator.mul),
+    "_eq": _comparison(operator.eq), "_ne": _comparison(operator.ne),
+    "_lt": _comparison(operator.lt), "_gt": _comparison(operator.gt),
+    "_le": _comparison(operator.le), "_ge": _comparison(operator.ge),
+}
+
+
+def lex(text):
+    lexemes = []
+    position = 0
+    while position < len(text):
+        match = LEXEME.match(text, position)
+        if match is None:
+            fmt = "Unexpected character %r in expression %r"
+            raise exceptions.ParseError(fmt % (text[position], text))
+        if match.lastgroup != "space":
+            lexemes.append((match.lastgroup, match.group(0)))
+        position = match.end()
+    lexemes.append((END, END))
+    return lexemes
+
+
+class ExpressionParser(object):
+    """
+    Recursive descent parser translating a C preprocessor expression into
+    the source of an equivalent Python expression.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.lexemes = lex(text)
+        self.position = 0
+
+    def error(self, problem):
+        fmt = "%s in expression %r"
+        return exceptions.ParseError(fmt % (problem, self.text))
+
+    def peek(self):
+        return self.lexemes[self.position][1]
+
+    def next(self):
+        lexeme = self.lexemes[self.position]
+        if lexeme[0] is END:
+            raise self.error("Unexpected end")
+        self.position += 1
+        return lexeme
+
+    def expect(self, value):
+        kind, found = self.next()
+        if found != value:
+            raise self.error("Expected %s, got %s" % (value, found))
+
+    def parse(self):
+        source = self.conditional()
+        if self.peek() is not END:
+            raise self.error("Unexpected %s" % self.peek())
+        return source
+
+    def conditional(self):
+        condition = self.binary(0)
+        if self.peek() != "?":
+            return condition
+        self.next()
+        true = self.conditional()
+        self.expect(":")
+        false = self.conditional()
+        return "(%s if %s else %s)" % (true, condition, false)
+
+    def binary(self, level):
+        if level == len(BINARY):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek() in BINARY[level]:
+            _, symbol = self.next()
+            right = self.binary(level + 1)
+            fmt = FORMATS.get(symbol)
+            if fmt is None:
+                left = "%s(%s, %s)" % (HELPER_NAMES[symbol], left, right)
+            else:
+                left = fmt % (left, right)
+        return left
+
+    def unary(self):
+        kind, value = self.next()
+        if value == "!":
+            return "(not %s)" % self.unary()
+        elif value == "-":
+            return "_neg(%s)" % self.unary()
+        elif value == "~":
+            return "_invert(%s)" % self.unary()
+        elif value == "+":
+            return self.unary()
+        elif value == "(":
+            source = self.conditional()
+            self.expect(")")
+            return source
+        elif kind == "number":
+            return self.number(value)
+        elif kind == "char":
+            return str(self.char(value))
+        elif kind == "name":
+            if value == "defined":
+                return "_defined(%r)" % self.defined_name()
+            elif self.peek() == "(":
+                return "_call(%r, %r)" % (value, self.arguments())
+            return "_value(%r)" % value
+        raise self.error("Unexpected %s" % value)
+
+    def defined_name(self):
+        parenthesized = self.peek() == "("
+        if parenthesized:
+            self.next()
+        kind, name = self.next()
+        if kind != "name":
+            raise self.error("Expected macro name after defined")
+        if parenthesized:
+            self.expect(")")
+        return name
+
+    def arguments(self):
+        self.next()
+        arguments = [[]]
+        depth = 0
+        while True:
+            _, value = self.next()
+            if value == "(":
+                depth += 1
+            elif value == ")":
+                if depth == 0:
+                    return tuple(" ".join(argument)
+                                 for argument in arguments)
+                depth -= 1
+            elif value == "," and depth == 0:
+                arguments.append([])
+                continue
+            arguments[-1].append(value)
+
+    def number(self, value):
+        """
+        Returns the source of a number. Numbers with a u suffix and ones
+        too large for intmax_t are unsigned.
+        """
+        match = NUMBER.match(value)
+        if match is None:
+            raise self.error("Invalid number %s" % value)
+        digits = match.group(1)
+        if digits[:2] in ("0x", "0X"):
+            number = int(digits[2:], 16)
+        elif digits[:2] in ("0b", "0B"):
+            number = int(digits[2:], 2)
+        elif digits.startswith("0") and len(digits) > 1:
+            try:
+                number = int(digits[1:], 8)
+            except ValueError:
+                raise self.error("Invalid octal number %s" % value)
+        else:
+            number = int(digits)
+        if number > MASK:
+            raise self.error("Number %s too large" % value)
+        if number >= SIGN or "u" in value[match.end(1):].lower():
+            return "_Unsigned(%d)" % number
+        return str(number)
+
+    def char(self, value):
+        body = value[1:-1]
+        if body.startswith("\\"):
+            body = codecs.decode(body, "unicode_escape")
+        if len(body) != 1:
+            raise self.error("Invalid character constant %s" % value)
+        return ord(body)
+
+
+_compiled = {}
+
+
+def compile_expression(text):
+    """
+    Returns a function taking value, defined and call callbacks that
+    evaluates given expression text. The first two are called with a macro
+    name, call also with argument texts of a function-like macro
+    invocation. Functions are cached by text, a cache shared by all
+    threads as functions hold no state.
+    """
+    function = _compiled.get(text)
+    if function is None:
+        source = ExpressionParser(text).parse()
+        function = eval("lambda _value, _defined, _call: " + source,
+                        HELPERS)
+        _compiled[text] = function
+    return function
+
+
+class Evaluator(object):
+    """
+    Evaluates expressions against defines. Macros expand to the value of
+    their replacement evaluated as an expression, identifiers that aren't
+    macros evaluate to 0. Function-like macros are substituted without
+    expanding arguments first, names left in the result are evaluated
+    like any other. Replacements read for one expression are limited to
+    max_expansion tokens. Given check_deadline, it's called every
+    tokens.CHECK_INTERVAL replacements.
+    """
+
+    def __init__(self, defines, max_expansion=None, check_deadline=None):
+        self.defines = defines
+        self.seen = set()
+        self.max_expansion = max_expansion
+        self.check_deadline = check_deadline
+        self.text = None
+        self.expanded = 0
+        self.replacements = 0
+
+    def defined(self, name):
+        return 1 if name in self.defines else 0
+
+    def replaced(self, name, replacement):
+        self.expanded += len(replacement)
+        if (self.max_expansion is not None and
+                self.expanded > self.max_expansion):
+            fmt = "Expansion of macros in expression %r exceeds %s tokens"
+            raise exceptions.ParseError(fmt % (self.text, self.max_expansion))
+        self.replacements += 1
+        if (self.check_deadline is not None and
+                self.replacements % tokens.CHECK_INTERVAL == 0):
+            self.check_deadline()
+        text = "".join(token.value for token in replacement).strip()
+        if not text:
+            return 0
+        self.seen.add(name)
+        try:
+            return compile_expression(text)(self.value, self.defined,
+                                            self.call)
+        finally:
+            self.seen.discard(name)
+
+    def value(self, name):
+        replacement = self.defines.get(name)
+        if (replacement is None or name in self.seen or
+                isinstance(replacement, tokens.FunctionMacro)):
+            return 0
+        return self.replaced(name, replacement)
+
+    def call(self, name, arguments):
+        macro = self.defines.get(name)
+        if not isinstance(macro, tokens.FunctionMacro) or name in self.seen:
+            fmt = "%s is not a function-like macro"
+            raise exceptions.ParseError(fmt % name)
+        arguments = macro.arguments(name, None, [
+            [tokens.Token.from_string(None, value)
+             for value in tokens.TOKEN.findall(argument)]
+            for argument in arguments])
+        return self.replaced(name, macro.substitute(arguments, list))
+
+    def evaluate(self, text):
+        self.text = text
+        self.expanded = 0
+        try:
+            return bool(compile_expression(text)(self.value, self.defined,
+                                                 self.call))
+        except (ArithmeticError, ValueError, MemoryError) as e:
+            fmt = "Can't evaluate expression %r: %s"
+            raise exceptions.ParseError(fmt % (text, e))
@@ -1,13 +1,54 @@
+import codecs
+import mmap
+import os
 import posixpath
+import re
+import struct
+import threading
+from simplecpreprocessor import tokens
 
 SKIP_FILE = object()
+# Bytes per range of files lexed in parallel, kept here so that parallel
+# is only imported when it's used
+DEFAULT_RANGE_SIZE = 4 * 1024 * 1024
+STORE_MAGIC = b"SCPH\x01\x00\x00\x00"
+STORE_HEADER = struct.Struct("<8sI")
+STORE_ENTRY = struct.Struct("<II")
+INCLUDE = re.compile(r'^\s*#\s*include\s*(<[^>]+>|"[^"]+")')
+
+
+def scan_includes(f_object):
+    """
+    Yields include name and whether it's relative to the including file for
+    every include line of given file regardless of conditionals.
+    """
+    for line in f_object:
+        match = INCLUDE.match(line)
+        if match is not None:
+            item = match.group(1)
+            yield item[1:-1], item[0] == '"'
 
 
 class HeaderHandler(object):
+    """
+    Resolves and opens headers. If an executor is given, every opened
+    header is read fully and the headers it includes are read in the
+    background so they are already in memory when needed. Headers opened
+    during earlier runs are prefetched at the start of the next one.
+
+    A handler can be shared by preprocessors running in several threads.
+    Include paths are replaced rather than modified so lookups see a
+    consistent list, and prefetch state is guarded by a lock.
+    """
 
-    def __init__(self, include_paths):
+    def __init__(self, include_paths, executor=None):
         self.include_paths = list(include_paths)
         self.resolved = {}
+        self.executor = executor
+        self.prefetched = {}
+        self.prefetch_lock = threading.Lock()
+        self.dependencies = {}
+        self.runs = 0
 
     def _open(self, header_path):
         try:
@@ -18,7 +59,11 @@ class HeaderHandler(object):
             return f
 
     def add_include_paths(self, include_paths):
-        self.include_paths.extend(include_paths)
+        with self.prefetch_lock:
+            added = [include_path for include_path in include_paths
+                     if include_path not in self.include_paths]
+            if added:
+                self.include_paths = self.include_paths + added
 
     def _resolve(self, anchor_file):
         if anchor_file is not None:
@@ -26,23 +71,110 @@ class HeaderHandler(object):
         for include_path in self.include_paths:
             yield include_path
 
+    def resolved_key(self, include_header, anchor_file):
+        if anchor_file is None:
+            return include_header
+        return posixpath.dirname(anchor_file), include_header
+
     def open_header(self, include_header, skip_file, anchor_file):
-        header_path = self.resolved.get(include_header)
+        key = self.resolved_key(include_header, anchor_file)
+        if self.executor is not None:
+            return self._open_prefetched(include_header, skip_file,
+                                         anchor_file, key)
+        header_path = self.resolved.get(key)
         if header_path is not None:
             if skip_file(header_path):
                 return SKIP_FILE
             else:
                 return self._open(header_path)
+        return self._find(include_header, anchor_file, key)
+
+    def _open_prefetched(self, include_header, skip_file, anchor_file, key):
+        with self.prefetch_lock:
+            self.dependencies[include_header, anchor_file] = None
+            future = self.prefetched.get(key)
+            self.prefetched[key] = None
+        header_path = self.resolved.get(key)
+        if header_path is not None and skip_file(header_path):
+            return SKIP_FILE
+        if future is not None:
+            f = future.result()
+        else:
+            f = self.read_header(include_header, anchor_file)
+        if f is not None:
+            self._prefetch_includes(f)
+        return f
+
+    def prefetch(self, include_header, anchor_file):
+        key = self.resolved_key(include_header, anchor_file)
+        with self.prefetch_lock:
+            if key in self.prefetched:
+                return
+            future = self.executor.submit(self.read_header, include_header,
+                                          anchor_file)
+            self.prefetched[key] = future
+        future.add_done_callback(self._prefetched)
+
+    def _prefetched(self, future):
+        if not future.cancelled() and future.exception() is None:
+            f = future.result()
+            if f is not None:
+                self._prefetch_includes(f)
+
+    def _prefetch_includes(self, f_object):
+        for include_header, local in scan_includes(f_object):
+            self.prefetch(include_header, f_object.name if local else None)
+
+    def start_prefetch(self):
+        """
+        Prefetches headers that were opened during earlier runs.
+        """
+        with self.prefetch_lock:
+            self.runs += 1
+            dependencies = list(self.dependencies)
+        if self.executor is not None:
+            for include_header, anchor_file in dependencies:
+                self.prefetch(include_header, anchor_file)
+
+    def drop_prefetched(self):
+        """
+        Forgets headers prefetched but never opened once no run is in
+        progress so that next run doesn't see stale contents.
+        """
+        with self.prefetch_lock:
+            self.runs -= 1
+            if self.runs <= 0:
+                self.runs = 0
+                self.prefetched.clear()
+
+    def _find(self, include_header, anchor_file, key):
+        f = None
         for include_path in self._resolve(anchor_file):
             header_path = posixpath.join(include_path, include_header)
             f = self._open(posixpath.normpath(header_path))
             if f:
-                self.resolved[include_header] = f.name
+                self.resolved[key] = f.name
                 break
         return f
 
+    def read_header(self, include_header, anchor_file):
+        """
+        Resolves and reads a header fully into memory. Returns None if the
+        header can't be found.
+        """
+        key = self.resolved_key(include_header, anchor_file)
+        header_path = self.resolved.get(key)
+        if header_path is not None:
+            f = self._open(header_path)
+        else:
+            f = self._find(include_header, anchor_file, key)
+        if f is None:
+            return None
+        with f:
+            return MemoryFile(f.name, list(f))
+
 
-class FakeFile(object):
+class MemoryFile(object):
 
     def __init__(self, name, contents):
         self.name = name
@@ -59,11 +191,258 @@ class FakeFile(object):
         pass
 
 
+class BytesFile(object):
+    """
+    File whose contents are ASCII-compatible bytes that are tokenized
+    directly. Iterating yields decoded lines for consumers that need text.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def tokenizer(self, line_ending):
+        return tokens.BytesTokenizer(self.data, line_ending)
+
+    def __iter__(self):
+        start = 0
+        size = len(self.data)
+        while start < size:
+            end = self.data.find(b"\n", start) + 1 or size
+            yield self.data[start:end].decode("utf-8", "replace")
+            start = end
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class MappedFile(BytesFile):
+    """
+    File whose contents are memory mapped and tokenized as bytes. Given a
+    lex executor, files of at least range_size bytes are lexed in parallel
+    ranges.
+    """
+
+    def __init__(self, name, f, lex_executor=None,
+                 range_size=DEFAULT_RANGE_SIZE):
+        self.f = f
+        self.lex_executor = lex_executor
+        self.range_size = range_size
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            data = b""
+        super(MappedFile, self).__init__(name, data)
+
+    def tokenizer(self, line_ending):
+        if self.lex_executor is None or len(self.data) < self.range_size:
+            return super(MappedFile, self).tokenizer(line_ending)
+        from simplecpreprocessor import parallel
+        return parallel.ParallelTokenizer(self.data, line_ending,
+                                          self.lex_executor, self.range_size,
+                                          source=self.name)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.f.close()
+
+
+def open_mapped(path, lex_executor=None,
+                range_size=DEFAULT_RANGE_SIZE):
+    return MappedFile(path, open(path, "rb"), lex_executor, range_size)
+
+
+class MappedHeaderHandler(HeaderHandler):
+    """
+    Header handler that memory maps headers instead of reading them as
+    text. Cuts decoding and per-line allocation for large headers, which
+    are lexed in parallel when given a lex executor.
+    """
+
+    def __init__(self, include_paths, executor=None, lex_executor=None,
+                 range_size=DEFAULT_RANGE_SIZE):
+        super(MappedHeaderHandler, self).__init__(include_paths, executor)
+        self.lex_executor = lex_executor
+        self.range_size = range_size
+
+    def _open(self, header_path):
+        try:
+            return open_mapped(header_path, self.lex_executor,
+                               self.range_size)
+        except IOError:
+            return None
+
+
+class ArchiveHandler(HeaderHandler):
+    """
+    Serves headers straight from a zip or tar archive without extracting
+    it. Include paths are relative to the archive root. Zip members are
+    read on demand through an index built once; tar archives have no index
+    so all regular members are read in a single sequential pass.
+    """
+
+    def __init__(self, archive_path, include_paths=(), executor=None):
+        import tarfile
+        import zipfile
+        super(ArchiveHandler, self).__init__(include_paths, executor)
+        self.zip_file = None
+        if zipfile.is_zipfile(archive_path):
+            self.zip_file = zipfile.ZipFile(archive_path)
+            self.members = {}
+            for info in self.zip_file.infolist():
+                if not info.is_dir():
+                    self.members[self.member_path(info.filename)] = info
+        else:
+            with tarfile.open(archive_path) as tar_file:
+                self.members = {}
+                for info in tar_file:
+                    if info.isfile():
+                        f = tar_file.extractfile(info)
+                        self.members[self.member_path(info.name)] = f.read()
+
+    @staticmethod
+    def member_path(name):
+        return posixpath.normpath(name).lstrip("/")
+
+    def _open(self, header_path):
+        member = self.members.get(self.member_path(header_path))
+        if member is None:
+            return None
+        if self.zip_file is not None:
+            member = self.zip_file.read(member)
+        return BytesFile(header_path, member)
+
+    def close(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+
+
+class HeaderStore(object):
+    """
+    In-memory collection of headers keyed by normalized path. Contents are
+    kept as bytes. A store is never modified after loading, so one store
+    can be shared by any number of handlers and threads.
+    """
+
+    def __init__(self, headers):
+        self.headers = {posixpath.normpath(path): data
+                        for path, data in headers.items()}
+
+    @classmethod
+    def from_directory(cls, directory, extensions=None):
+        """
+        Loads all files under directory, or only those with given
+        extensions. Paths are stored as the absolute directory joined with
+        the relative path so that include paths, which clients send as
+        absolute ones, work as on the real file system.
+        """
+        headers = {}
+        for root, _, files in os.walk(os.path.abspath(directory)):
+            for name in files:
+                if extensions and not name.endswith(tuple(extensions)):
+                    continue
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    headers[path.replace(os.sep, "/")] = f.read()
+        return cls(headers)
+
+    @classmethod
+    def loads(cls, blob):
+        magic, count = STORE_HEADER.unpack_from(blob)
+        if magic != STORE_MAGIC:
+            raise ValueError("Not a header store")
+        headers = {}
+        position = STORE_HEADER.size
+        for _ in range(count):
+            name_size, data_size = STORE_ENTRY.unpack_from(blob, position)
+            position += STORE_ENTRY.size
+            name = blob[position:position + name_size].decode("utf-8")
+            position += name_size
+            headers[name] = bytes(blob[position:position + data_size])
+            position += data_size
+        return cls(headers)
+
+    def dumps(self):
+        parts = [STORE_HEADER.pack(STORE_MAGIC, len(self.headers))]
+        for path, data in sorted(self.headers.items()):
+            name = path.encode("utf-8")
+            parts.append(STORE_ENTRY.pack(len(name), len(data)))
+            parts.append(name)
+            parts.append(data)
+        return b"".join(parts)
+
+    def get(self, path):
+        return self.headers.get(posixpath.normpath(path))
+
+    def __len__(self):
+        return len(self.headers)
+
+
+class StoreHandler(HeaderHandler):
+    """
+    Serves headers from a HeaderStore without any file system access. With
+    overlay, headers missing from the store are looked up from the file
+    system instead.
+    """
+
+    def __init__(self, store, include_paths=(), overlay=False,
+                 executor=None):
+        super(StoreHandler, self).__init__(include_paths, executor)
+        self.store = store
+        self.overlay = overlay
+
+    def _open(self, header_path):
+        data = self.store.get(header_path)
+        if data is not None:
+            return BytesFile(header_path, data)
+        elif self.overlay:
+            return super(StoreHandler, self)._open(header_path)
+        else:
+            return None
+
+
+class PushFile(object):
+    """
+    Input pushed in pieces of text or UTF-8 bytes, see Preprocessor.feed.
+    Multibyte characters may be split between pieces.
+    """
+
+    def __init__(self, name="<stream>"):
+        self.name = name
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.pushed = None
+
+    def tokenizer(self, line_ending):
+        self.pushed = tokens.PushTokenizer(line_ending)
+        return self.pushed
+
+    def push(self, data):
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data)
+        self.pushed.push(data)
+
+    def close(self):
+        self.pushed.push(self.decoder.decode(b"", final=True))
+        self.pushed.close()
+
+
+class FakeFile(MemoryFile):
+    pass
+
+
 class FakeHandler(HeaderHandler):
 
-    def __init__(self, header_mapping, include_paths=()):
+    def __init__(self, header_mapping, include_paths=(), executor=None):
         self.header_mapping = header_mapping
-        super(FakeHandler, self).__init__(list(include_paths))
+        super(FakeHandler, self).__init__(list(include_paths), executor)
 
     def _open(self, header_path):
         contents = self.header_mapping.get(header_path)
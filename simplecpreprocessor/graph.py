@@ -0,0 +1,143 @@
+"""
+Include graph analysis built from cached program summaries. An include can
+be preprocessed on its own, in parallel with everything before it, when no
+header it may reach reads a name written before it or was reached before
+it. Its output and effects are then the same as if processed in order.
+Headers marked included once that were reached before are assumed skipped
+instead; the caller checks that they are before using the output.
+"""
+from simplecpreprocessor import program
+
+
+class Subtree(object):
+    """
+    Everything a header and the headers it may include read and write over
+    all of their branches. Headers are kept both by resolved name and by
+    content hash, as identical copies are skipped by contents too. Include
+    once marks are kept for headers setting them and for headers assumed
+    skipped, by the same keys.
+    """
+
+    def __init__(self):
+        self.headers = set()
+        self.reads = set()
+        self.writes = set()
+        self.opaque = False
+        self.include_once = {}
+        self.skipped = {}
+
+    def guards(self):
+        return set(item[0] for item in self.skipped.values()
+                   if item != program.PRAGMA_ONCE)
+
+    def independent_of(self, headers, writes):
+        # Skipping a guarded header holds only while nothing redefines it
+        return not (self.opaque or self.reads & writes or
+                    self.headers & headers or self.guards() & self.writes)
+
+
+def include_target(item):
+    """
+    Returns header name and whether it's relative to the including file for
+    an include item, or None if it's not a valid one.
+    """
+    if item is None or len(item) < 2:
+        return None
+    if item[0] == "<" and item[-1] == ">":
+        return item[1:-1], False
+    elif item[0] == '"' and item[-1] == '"':
+        return item[1:-1], True
+    return None
+
+
+class IncludeGraph(object):
+    """
+    Reaches headers through a header handler and summarizes them through a
+    chunk cache. Includes that can't be found are left out: if they are
+    actually reached, processing them fails the same way in a worker.
+    """
+
+    def __init__(self, headers, chunk_cache, line_ending, ignore_headers=()):
+        self.headers = headers
+        self.chunk_cache = chunk_cache
+        self.line_ending = line_ending
+        self.ignore_headers = ignore_headers
+        self.found = {}
+
+    def find(self, header, anchor_file):
+        key = self.headers.resolved_key(header, anchor_file)
+        if key not in self.found:
+            f_object = self.headers.open_header(header, lambda name: False,
+                                                anchor_file)
+            if f_object is None:
+                self.found[key] = None
+            else:
+                with f_object:
+                    digest, summary = self.chunk_cache.load_summary(
+                        f_object, self.line_ending)
+                self.found[key] = f_object.name, digest, summary
+        return self.found[key]
+
+    def subtree(self, item, anchor_file, include_once=None):
+        """
+        Returns the subtree of headers reachable through an include item of
+        the file named anchor_file. Headers with include once marks given
+        by name or content hash are assumed skipped.
+        """
+        include_once = include_once or {}
+        subtree = Subtree()
+        pending = [(item, anchor_file)]
+        while pending:
+            item, anchor_file = pending.pop()
+            target = include_target(item)
+            if target is None or target[0] in self.ignore_headers:
+                continue
+            header, local = target
+            found = self.find(header, anchor_file if local else None)
+            if found is None or found[0] in subtree.headers:
+                continue
+            name, digest, summary = found
+            keys = [key for key in (name, digest) if key in include_once]
+            if keys:
+                for key in keys:
+                    subtree.skipped[key] = include_once[key]
+                continue
+            subtree.headers.update((name, digest))
+            if summary.include_once is not None:
+                subtree.include_once[name] = summary.include_once
+                subtree.include_once[digest] = summary.include_once
+            subtree.reads |= summary.tested | summary.used
+            subtree.writes |= summary.defined | summary.undefined
+            subtree.opaque |= summary.opaque
+            pending.extend((included, name) for included in summary.includes)
+        return subtree
+
+    def independent_includes(self, name, operations):
+        """
+        Returns the subtrees of includes among operations of the file named
+        name that are outside conditionals and independent of everything
+        before them, by line number.
+        """
+        independent = {}
+        headers = set([name])
+        writes = set()
+        include_once = {}
+        depth = 0
+        for op, line_no, argument in operations:
+            if op in ("ifdef", "ifndef", "if"):
+                depth += 1
+            elif op == "endif":
+                depth -= 1
+            elif op == "define":
+                writes.add(argument[0])
+            elif op == "undef":
+                writes.add(argument)
+            elif op == "include":
+                subtree = self.subtree(argument, name, include_once)
+                if (depth == 0 and subtree.headers and
+                        subtree.independent_of(headers, writes)):
+                    independent[line_no] = subtree
+                headers |= subtree.headers
+                writes |= subtree.writes
+                include_once.update(subtree.include_once)
+        return independent
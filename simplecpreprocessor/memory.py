@@ -0,0 +1,86 @@
+"""
+Peak memory accounting based on tracemalloc. Memory is attributed to the
+phase running at the time, lexing, macro expansion or output, and to the
+header being processed. Python 3.8 can't reset the traced peak, there
+memory in use after each step is recorded instead, which misses
+short-lived peaks within a step.
+"""
+import tracemalloc
+
+LEXING = "lexing"
+EXPANSION = "expansion"
+OUTPUT = "output"
+_reset_peak = getattr(tracemalloc, "reset_peak", None)
+
+
+def reset_peak():
+    if _reset_peak is not None:
+        _reset_peak()
+
+
+class MemoryTracker(object):
+    """
+    Records peak traced memory in bytes per phase and per header. Tracing
+    is started when tracking starts unless it's already running.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.headers = {}
+        self.started = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def record(self, phase, name):
+        current, peak = tracemalloc.get_traced_memory()
+        if _reset_peak is None:
+            peak = current
+        if peak > self.phases.get(phase, 0):
+            self.phases[phase] = peak
+        if peak > self.headers.get(name, 0):
+            self.headers[name] = peak
+
+    def track(self, phase, name, iterable):
+        """
+        Attributes memory used while producing items of iterable.
+        """
+        iterator = iter(iterable)
+        while True:
+            reset_peak()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(phase, name)
+                return
+            self.record(phase, name)
+            yield item
+
+    def track_output(self, name, iterable):
+        """
+        Attributes memory used by the consumer between items of iterable.
+        """
+        for item in iterable:
+            reset_peak()
+            yield item
+            self.record(OUTPUT, name)
+
+    def report(self):
+        return {"phases": dict(self.phases), "headers": dict(self.headers)}
+
+    def format_report(self):
+        lines = ["Peak memory by phase:"]
+        for phase, peak in sorted(self.phases.items()):
+            lines.append("  %-12s %12d bytes" % (phase, peak))
+        lines.append("Peak memory by header:")
+        for name, peak in sorted(self.headers.items(),
+                                 key=lambda item: -item[1]):
+            lines.append("  %12d bytes %s" % (peak, name))
+        return "\n".join(lines) + "\n"
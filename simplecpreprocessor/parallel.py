@@ -0,0 +1,83 @@
+"""
+Parallel lexing of very large files. The file is split into byte ranges at
+line boundaries which workers tokenize independently, assuming no comment
+is open where their range starts. Ranges are stitched back in order; the
+few that actually start inside a block comment are tokenized again with the
+right state in a second pass.
+"""
+import mmap
+from simplecpreprocessor import cache, filesystem, tokens
+
+DEFAULT_RANGE_SIZE = filesystem.DEFAULT_RANGE_SIZE
+
+
+def split_ranges(buffer, range_size):
+    """
+    Returns (start, end) offsets of ranges of about range_size bytes, each
+    ending at a line boundary.
+    """
+    ranges = []
+    start = 0
+    size = len(buffer)
+    while start < size:
+        end = size
+        if start + range_size < size:
+            end = buffer.find(b"\n", start + range_size - 1) + 1 or size
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def lex_range(source, start, end, comment, line_ending):
+    """
+    Tokenizes a range of source, a buffer or the path of a file to map.
+    Returns the encoded tokens with line numbers relative to the range, the
+    number of lines in the range and the comment open at its end.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    tokenizer = tokens.BytesTokenizer(source, line_ending, start, end,
+                                      comment=comment)
+    encoded = cache.encode_chunks([tokenizer])
+    line_count = source[start:end].count(b"\n")
+    return encoded, line_count, tokenizer.final_comment
+
+
+class ParallelTokenizer(tokens.Tokenizer):
+    """
+    Tokenizes a buffer in ranges lexed by given executor. Use a process pool
+    executor to actually lex in parallel, workers then map the file from
+    source instead of receiving the buffer.
+    """
+
+    def __init__(self, buffer, line_ending, executor,
+                 range_size=DEFAULT_RANGE_SIZE, source=None):
+        self.buffer = buffer
+        self.line_ending = line_ending
+        self.executor = executor
+        self.range_size = range_size
+        self.source = buffer if source is None else source
+
+    def __iter__(self):
+        ranges = split_ranges(self.buffer, self.range_size)
+        futures = [self.executor.submit(lex_range, self.source, start, end,
+                                        None, self.line_ending)
+                   for start, end in ranges]
+        try:
+            line_no = 0
+            comment = None
+            for (start, end), future in zip(ranges, futures):
+                encoded, line_count, final_comment = future.result()
+                if comment is not None:
+                    encoded, line_count, final_comment = lex_range(
+                        self.buffer, start, end, comment, self.line_ending)
+                for token in cache.ChunkReader(encoded).tokens():
+                    token.line_no += line_no
+                    yield token
+                line_no += line_count
+                comment = final_comment
+        finally:
+            for future in futures:
+                future.cancel()
+        self.final_comment = comment
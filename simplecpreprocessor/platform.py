@@ -58,4 +58,21 @@ def calculate_platform_constants():
     return constants
 
 
-PLATFORM_CONSTANTS = calculate_platform_constants()
+_platform_constants = None
+
+
+def platform_constants():
+    """
+    Returns constants of the running platform. They are calculated on first
+    use since platform detection may need to spawn processes.
+    """
+    global _platform_constants
+    if _platform_constants is None:
+        _platform_constants = calculate_platform_constants()
+    return _platform_constants
+
+
+def __getattr__(name):
+    if name == "PLATFORM_CONSTANTS":
+        return platform_constants()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,81 @@
+"""
+Vectorized pre-scan of a buffer with NumPy, an optional dependency. Finds
+directive lines and positions where plain line-by-line skipping isn't safe,
+block comment starts and backslash continuations, so that lines in inactive
+regions can be passed over without tokenizing them.
+"""
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+NEWLINE = ord("\n")
+CARRIAGE_RETURN = ord("\r")
+HASH = ord("#")
+SLASH = ord("/")
+STAR = ord("*")
+BACKSLASH = ord("\\")
+BLANKS = (ord(" "), ord("\t"))
+
+
+def available():
+    return numpy is not None
+
+
+class DirectiveIndex(object):
+    """
+    Index of directive line starts and skip barriers of given buffer.
+    """
+
+    def __init__(self, buffer):
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        self.size = len(data)
+        self.newlines = numpy.flatnonzero(data == NEWLINE)
+        self.directives = self._directives(data)
+        slashes = numpy.flatnonzero(data[:-1] == SLASH)
+        comments = slashes[data[slashes + 1] == STAR]
+        backslashes = numpy.flatnonzero(data[:-1] == BACKSLASH)
+        following = data[backslashes + 1]
+        continuations = backslashes[(following == NEWLINE) |
+                                    (following == CARRIAGE_RETURN)]
+        self.barriers = numpy.sort(numpy.concatenate((comments,
+                                                      continuations)))
+
+    def line_start(self, position):
+        line = numpy.searchsorted(self.newlines, position)
+        if line == 0:
+            return 0
+        return int(self.newlines[line - 1]) + 1
+
+    def _directives(self, data):
+        hashes = numpy.flatnonzero(data == HASH)
+        starts = numpy.concatenate(([0], self.newlines + 1))[
+            numpy.searchsorted(self.newlines, hashes)]
+        # Walk back over indentation until every hash hits a non-blank
+        # byte or the start of its line
+        positions = hashes.copy()
+        while True:
+            indented = positions > starts
+            previous = data[positions[indented] - 1]
+            blank = (previous == BLANKS[0]) | (previous == BLANKS[1])
+            if not blank.any():
+                break
+            moved = numpy.flatnonzero(indented)[blank]
+            positions[moved] -= 1
+        return numpy.unique(starts[positions == starts])
+
+    def skip(self, position):
+        """
+        Returns the offset of the first line at or after the line starting
+        at position that needs tokenizing and the number of lines before it.
+        """
+        target = self.size
+        index = numpy.searchsorted(self.directives, position)
+        if index < len(self.directives):
+            target = int(self.directives[index])
+        index = numpy.searchsorted(self.barriers, position)
+        if index < len(self.barriers) and self.barriers[index] < target:
+            target = self.line_start(self.barriers[index])
+        lines = (numpy.searchsorted(self.newlines, target) -
+                 numpy.searchsorted(self.newlines, position))
+        return target, int(lines)
@@ -0,0 +1,216 @@
+"""
+Compiles the chunks of a file into a program the preprocessor executes:
+directive operations with their arguments decoded up front, and runs of
+consecutive source lines. Each source line carries its chunk, the set of
+token values in it and its text, so lines without defined names can be
+output without expanding them. Programs hold no state of a run, so one
+compiled program of a cached header serves every run that includes it.
+"""
+from simplecpreprocessor import exceptions, expressions, tokens
+
+SOURCE = "source"
+PAUSE = "pause"
+INVALID = "invalid"
+PRAGMA_ONCE = "pragma_once"
+
+
+def first_value(chunk):
+    for token in chunk:
+        if not token.whitespace:
+            return token.value
+    return None
+
+
+def decode_name(chunk, line_no):
+    return first_value(chunk)
+
+
+def decode_expression(chunk, line_no):
+    return "".join(token.value for token in chunk).strip()
+
+
+def decode_function_macro(chunk, line_no):
+    params = []
+    for i, token in enumerate(chunk):
+        if token.value == ")":
+            break
+        elif token.value == ".":
+            if params[-1:] != [tokens.VA_ARGS]:
+                params.append(tokens.VA_ARGS)
+        elif not token.whitespace and token.value != ",":
+            params.append(token.value)
+    else:
+        fmt = "Missing ) in parameter list of macro on line %s"
+        raise exceptions.ParseError(fmt % line_no)
+    return tokens.FunctionMacro(params, chunk[i+1:])
+
+
+def decode_define(chunk, line_no):
+    for i, token in enumerate(chunk):
+        if not token.whitespace:
+            name = token.value
+            break
+    if chunk[i+1].value == "(":
+        return name, decode_function_macro(chunk[i+2:-1], line_no)
+    return name, chunk[i+2:-1]
+
+
+def decode_nothing(chunk, line_no):
+    return None
+
+
+DECODERS = {
+    "define": decode_define,
+    "undef": decode_name,
+    "ifdef": decode_name,
+    "ifndef": decode_name,
+    "if": decode_expression,
+    "elif": decode_expression,
+    "else": decode_nothing,
+    "endif": decode_nothing,
+    "include": decode_name,
+    "pragma": decode_name,
+}
+# Operations the preprocessor executes besides source runs and pauses
+OPERATIONS = tuple(DECODERS) + (INVALID,)
+
+
+def source_line(chunk):
+    values = [token.value for token in chunk]
+    return chunk, frozenset(values), "".join(values)
+
+
+def compile_chunk(chunk):
+    """
+    Returns the operation for a single chunk as a tuple of operation name,
+    line number and decoded argument. Source chunks become a run of one
+    line. A directive that can't be decoded compiles to an INVALID
+    operation carrying the message of the error to raise when it's
+    executed.
+    """
+    if chunk is tokens.PAUSE:
+        return PAUSE, None, None
+    line_no = chunk[0].line_no
+    if chunk[0].value != "#":
+        return SOURCE, line_no, [source_line(chunk)]
+    name = chunk[1].value
+    decoder = DECODERS.get(name)
+    if decoder is None:
+        fmt = "Line number %s contains unsupported macro %s"
+        return INVALID, line_no, fmt % (line_no, name)
+    try:
+        return name, line_no, decoder(chunk[2:], line_no)
+    except exceptions.ParseError as e:
+        return INVALID, line_no, str(e)
+
+
+def compile_chunks(chunks):
+    """
+    Returns the program for all chunks of a file as a list of operations,
+    consecutive source lines merged into one run.
+    """
+    program = []
+    for chunk in chunks:
+        operation = compile_chunk(chunk)
+        if (operation[0] is SOURCE and program and
+                program[-1][0] is SOURCE):
+            program[-1][2].extend(operation[2])
+        else:
+            program.append(operation)
+    return program
+
+
+class Summary(object):
+    """
+    Macro names a program tests in conditionals, defines, undefines and
+    uses in source lines or replacements, over all of its branches, and the
+    items it may include. A program defining a macro with ## is opaque as
+    pasting can produce names that don't appear in its text. Programs that
+    always mark themselves included once have the mark they set.
+    """
+
+    def __init__(self):
+        self.tested = set()
+        self.defined = set()
+        self.undefined = set()
+        self.used = set()
+        self.includes = []
+        self.opaque = False
+        self.include_once = None
+
+
+def expression_names(text):
+    try:
+        lexemes = expressions.lex(text)
+    except exceptions.ParseError:
+        return None
+    return set(value for kind, value in lexemes
+               if kind == "name" and value != "defined")
+
+
+def fullfile_guard(operations):
+    """
+    Returns the name tested by an #ifndef spanning a whole program that
+    defines it right away, or None.
+    """
+    if (len(operations) < 3 or operations[0][:2] != ("ifndef", 0) or
+            operations[1][0] != "define" or
+            operations[1][2][0] != operations[0][2] or
+            operations[-1][0] != "endif"):
+        return None
+    depth = 0
+    for op, _, _ in operations[:-1]:
+        if op in ("ifdef", "ifndef", "if"):
+            depth += 1
+        elif op == "endif":
+            depth -= 1
+            if depth == 0:
+                return None
+    return operations[0][2]
+
+
+def summarize(operations):
+    """
+    Returns the summary of a compiled program.
+    """
+    summary = Summary()
+    guard = fullfile_guard(operations)
+    if guard is not None:
+        summary.include_once = guard, "ifndef"
+    # Depth of conditionals besides the guard
+    depth = 0 if guard is None else -1
+    for op, line_no, argument in operations:
+        if op in ("ifdef", "ifndef", "if"):
+            depth += 1
+        elif op == "endif":
+            depth -= 1
+        if op is SOURCE:
+            for _, names, _ in argument:
+                summary.used.update(names)
+        elif op in ("ifdef", "ifndef"):
+            summary.tested.add(argument)
+        elif op in ("if", "elif"):
+            names = expression_names(argument)
+            if names is None:
+                summary.opaque = True
+            else:
+                summary.tested.update(names)
+        elif op == "define":
+            name, replacement = argument
+            summary.defined.add(name)
+            if isinstance(replacement, tokens.FunctionMacro):
+                for kind, slot in replacement.template:
+                    if kind is tokens.LITERAL:
+                        summary.used.add(slot.value)
+                    elif kind is tokens.PASTE:
+                        summary.opaque = True
+            else:
+                summary.used.update(token.value for token in replacement)
+        elif op == "undef":
+            summary.undefined.add(argument)
+        elif op == "include":
+            summary.includes.append(argument)
+        elif (op == "pragma" and argument == "once" and depth == 0 and
+                guard is None):
+            summary.include_once = PRAGMA_ONCE
+    return summary
@@ -0,0 +1,135 @@
+"""
+Prunes preprocessed output down to the top-level declarations that wanted
+symbols need, for consumers such as CFFI that only bind a few functions and
+types. Declarations end at a semicolon outside braces or at the closing
+brace of a function body. A declaration is kept if it declares a wanted
+symbol or a name used by another kept declaration.
+"""
+import re
+
+TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|\w+|\s+|.')
+IDENTIFIER = re.compile(r"[A-Za-z_]\w*$")
+TAGS = frozenset(["struct", "union", "enum"])
+KEYWORDS = TAGS | frozenset([
+    "auto", "break", "case", "char", "const", "continue", "default", "do",
+    "double", "else", "extern", "float", "for", "goto", "if", "inline",
+    "int", "long", "register", "restrict", "return", "short", "signed",
+    "sizeof", "static", "switch", "typedef", "unsigned", "void", "volatile",
+    "while", "_Bool", "_Complex", "__attribute__", "__extension__",
+    "__restrict", "__restrict__", "__inline", "__inline__", "__asm__",
+    "__const", "__volatile__", "__signed__", "__declspec"])
+# Tokens after a name at top level that make the name a declared one
+DECLARATOR_ENDS = frozenset(["(", ";", ",", "[", "=", ":"])
+
+
+def lines(chunks):
+    """
+    Yields output a line at a time, joining chunks so that tokens split
+    between chunks, such as character constants from a macro, stay whole.
+    """
+    pending = []
+    for chunk in chunks:
+        pending.append(chunk)
+        if chunk.endswith("\n"):
+            yield "".join(pending)
+            pending = []
+    if pending:
+        yield "".join(pending)
+
+
+def split_declarations(chunks):
+    """
+    Yields text and significant tokens of each top-level declaration in
+    given chunks of output.
+    """
+    parts = []
+    significant = []
+    depth = 0
+    function_body = False
+    for line in lines(chunks):
+        for token in TOKEN.findall(line):
+            parts.append(token)
+            if token.isspace():
+                continue
+            ended = False
+            if token == "{":
+                if depth == 0:
+                    function_body = significant[-1:] == [")"]
+                depth += 1
+            elif token == "}":
+                depth -= 1
+                ended = depth == 0 and function_body
+            elif token == ";":
+                ended = depth == 0
+            significant.append(token)
+            if ended:
+                yield "".join(parts).strip(), significant
+                parts = []
+                significant = []
+
+
+def is_identifier(token):
+    return IDENTIFIER.match(token) is not None and token not in KEYWORDS
+
+
+def declared_names(tokens):
+    """
+    Returns names declared by a declaration given its significant tokens:
+    tags of defined or forward declared aggregates, enumerators, and
+    declarators outside braces.
+    """
+    names = set()
+    braces = []
+    parens = 0
+    for i, token in enumerate(tokens):
+        previous = tokens[i - 1] if i else None
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+        if token == "{":
+            braces.append("enum" in tokens[max(i - 2, 0):i])
+        elif token == "}":
+            braces.pop()
+        elif token == "(":
+            parens += 1
+        elif token == ")":
+            parens -= 1
+        elif not is_identifier(token):
+            continue
+        elif previous in TAGS:
+            if not braces and not parens and following in ("{", ";"):
+                names.add(token)
+        elif braces:
+            if (braces[-1] and previous in ("{", ",") and
+                    following in (",", "=", "}")):
+                names.add(token)
+        elif parens == 0 and following in DECLARATOR_ENDS:
+            names.add(token)
+        elif (parens == 1 and previous == "*" and following == ")" and
+                tokens[i - 2] == "("):
+            names.add(token)
+    return names
+
+
+def prune(chunks, symbols, line_ending="\n"):
+    """
+    Yields the top-level declarations of given output that declare any of
+    symbols or something they depend on, each on its own line, in their
+    original order.
+    """
+    declarations = []
+    declared_by = {}
+    for text, tokens in split_declarations(chunks):
+        names = declared_names(tokens)
+        references = set(token for token in tokens
+                         if is_identifier(token)) - names
+        for name in names:
+            declared_by.setdefault(name, []).append(len(declarations))
+        declarations.append((text, references))
+    kept = set()
+    wanted = list(symbols)
+    while wanted:
+        for index in declared_by.get(wanted.pop(), ()):
+            if index not in kept:
+                kept.add(index)
+                wanted.extend(declarations[index][1])
+    for index in sorted(kept):
+        yield declarations[index][0] + line_ending
@@ -0,0 +1,83 @@
+"""
+Define/use summaries recorded while included headers are preprocessed. A
+recording notes everything a header, including the headers it includes,
+reads from the state before it started: definitions of names, include once
+marks and contents of included files. A later run where all of those are
+unchanged can reuse its output and effects instead of processing it again.
+"""
+from simplecpreprocessor import tokens
+
+ONCE = "once"
+FILE = "file"
+# Variants of a header kept for different definitions of what it reads
+MAX_RECORDINGS = 8
+
+
+def definition_key(value):
+    """
+    Returns a comparable key for a definition that's equal for equal
+    definitions made in different runs, None for undefined names.
+    """
+    if value is None:
+        return None
+    elif isinstance(value, tokens.FunctionMacro):
+        return (tuple(value.params), tuple(
+            (kind, slot.value if kind is tokens.LITERAL else slot)
+            for kind, slot in value.template))
+    return tuple(token.value for token in value)
+
+
+class Recording(object):
+    """
+    Summary of one run of a header: macro names it tested in conditionals,
+    defined, undefined and expanded, and what it read from before it
+    started, keyed by macro name or by (ONCE, key) and (FILE, header,
+    anchor_file) for include once marks and included file contents.
+    Output, final definitions of written names and include once marks set
+    are filled in when the header is finished.
+    """
+
+    def __init__(self):
+        self.tested = set()
+        self.defined = set()
+        self.undefined = set()
+        self.expanded = set()
+        self.reads = {}
+        self.written = set()
+        self.output = []
+        self.changes = {}
+        self.include_once = {}
+
+    def read(self, key, value):
+        if key not in self.reads and key not in self.written:
+            self.reads[key] = value
+
+    def read_definition(self, name, value, tested=False):
+        if tested:
+            self.tested.add(name)
+        elif value is not None:
+            self.expanded.add(name)
+        if name not in self.reads and name not in self.written:
+            self.reads[name] = definition_key(value)
+
+    def write_definition(self, name, defined):
+        if defined:
+            self.defined.add(name)
+        else:
+            self.undefined.add(name)
+        self.written.add(name)
+
+    def mark_include_once(self, key, item):
+        self.include_once[key] = item
+        self.written.add((ONCE, key))
+
+    def merge(self, other):
+        """
+        Takes in what a reused recording of a nested header read and wrote.
+        """
+        for key, value in other.reads.items():
+            self.read(key, value)
+        self.tested |= other.tested
+        self.expanded |= other.expanded
+        self.defined |= other.defined
+        self.undefined |= other.undefined
@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+import asyncio
+import threading
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.aio import preprocess_async
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+
+
+def run_async(f_obj, **kwargs):
+    async def collect():
+        return [chunk async for chunk in preprocess_async(f_obj, **kwargs)]
+    return "".join(asyncio.run(collect()))
+
+
+def test_same_output_as_sync():
+    mapping = {
+        "a.h": ["#ifndef A\n", "#define A\n", '#include "b.h"\n',
+                "a B\n", "#endif\n"],
+        "b.h": ["#pragma once\n", "#define B 2\n", "b\n"],
+    }
+    lines = ['#include "a.h"\n', '#include "b.h"\n', '#include "a.h"\n',
+             "B\n"]
+    expected = "".join(preprocess(FakeFile("header.h", lines),
+                                  header_handler=FakeHandler(mapping)))
+    output = run_async(FakeFile("header.h", lines),
+                       header_handler=FakeHandler(mapping))
+    assert output == expected == "b\na 2\n2\n"
+
+
+def test_missing_header():
+    f_obj = FakeFile("header.h", ['#include "other.h"\n'])
+    with pytest.raises(ParseError):
+        run_async(f_obj, header_handler=FakeHandler({}))
+
+
+def test_ignored_header():
+    f_obj = FakeFile("header.h", ["#include <other.h>\n", "1\n"])
+    output = run_async(f_obj, header_handler=FakeHandler({"other.h": []}),
+                       ignore_headers=["other.h"])
+    assert output == "1\n"
+
+
+class BlockingHandler(FakeHandler):
+    """
+    Opening first.h blocks until second.h has been requested, which only
+    happens if headers are loaded concurrently.
+    """
+
+    def __init__(self, header_mapping):
+        super(BlockingHandler, self).__init__(header_mapping)
+        self.second_requested = threading.Event()
+
+    def _open(self, header_path):
+        if header_path == "first.h":
+            assert self.second_requested.wait(5)
+        elif header_path == "second.h":
+            self.second_requested.set()
+        return super(BlockingHandler, self)._open(header_path)
+
+
+def test_headers_loaded_concurrently():
+    handler = BlockingHandler({"first.h": ["1\n"], "second.h": ["2\n"]})
+    f_obj = FakeFile("header.h", ['#include "first.h"\n',
+                                  '#include "second.h"\n'])
+    assert run_async(f_obj, header_handler=handler) == "1\n2\n"
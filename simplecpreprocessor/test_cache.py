@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+import os
+from concurrent.futures import ProcessPoolExecutor
+import mock
+import pytest
+from simplecpreprocessor.__main__ import main
+from simplecpreprocessor.cache import (ChunkCache, ChunkReader,
+                                       SharedChunkCache, cache_entries,
+                                       cache_stats, clear_cache,
+                                       content_digest, encode_chunks,
+                                       prune_cache)
+from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor.filesystem import FakeFile, HeaderHandler
+from simplecpreprocessor.tokens import Tokenizer
+
+HEADER = ["#ifndef OTHER\n",
+          "#define OTHER\n",
+          "/* comment */ int x; \\\n",
+          "  const char *s = \"ä\";\n",
+          "#endif\n"]
+
+
+def tokenized(chunks):
+    return [[(t.line_no, t.value, t.whitespace, t.chunk_mark) for t in chunk]
+            for chunk in chunks]
+
+
+def test_encode_round_trip():
+    chunks = list(Tokenizer(HEADER, "\n").read_chunks())
+    reader = ChunkReader(encode_chunks(chunks))
+    assert tokenized(reader) == tokenized(chunks)
+    assert tokenized(reader) == tokenized(chunks)
+
+
+def test_invalid_entry():
+    with pytest.raises(ValueError):
+        ChunkReader(b"\x00" * 16)
+
+
+@pytest.mark.parametrize("size", [5, 40, -1])
+def test_truncated_entry(tmpdir, size):
+    tmpdir.join("other.h").write("".join(HEADER))
+    cache_dir = tmpdir.mkdir("cache")
+    expected = run(str(cache_dir), str(tmpdir))
+    for entry in cache_dir.listdir("*.tok"):
+        data = entry.read_binary()
+        entry.write_binary(data[:size])
+    assert run(str(cache_dir), str(tmpdir)) == expected
+
+
+def run(directory, include_path):
+    handler = HeaderHandler([include_path])
+    preprocessor = Preprocessor(header_handler=handler,
+                                chunk_cache=SharedChunkCache(directory))
+    f_obj = FakeFile("header.h", ["#include <other.h>\n", "OTHER x\n"])
+    return "".join(preprocessor.preprocess(f_obj))
+
+
+def test_shared_between_caches(tmpdir):
+    tmpdir.join("other.h").write("".join(HEADER))
+    cache_dir = tmpdir.mkdir("cache")
+    expected = run(str(cache_dir), str(tmpdir))
+    assert len(cache_dir.listdir()) == 2
+    with mock.patch("simplecpreprocessor.tokens.Tokenizer") as tokenizer:
+        tokenizer.side_effect = AssertionError("Tokenized again")
+        preprocessor = Preprocessor(
+            header_handler=HeaderHandler([str(tmpdir)]),
+            chunk_cache=SharedChunkCache(str(cache_dir)))
+        with open(str(tmpdir.join("other.h"))) as f_obj:
+            output = "".join(preprocessor.preprocess(f_obj))
+    assert expected == " int x; \\\n  const char *s = \"ä\";\n x\n"
+    assert output == " int x; \\\n  const char *s = \"ä\";\n"
+
+
+def test_process_pool_workers(tmpdir):
+    tmpdir.join("other.h").write("".join(HEADER))
+    cache_dir = tmpdir.mkdir("cache")
+    with ProcessPoolExecutor(2) as executor:
+        futures = [executor.submit(run, str(cache_dir), str(tmpdir))
+                   for _ in range(4)]
+        outputs = set(future.result() for future in futures)
+    assert len(outputs) == 1
+    entries = [name for name in os.listdir(str(cache_dir))
+               if name.endswith(".tok")]
+    assert len(entries) == 2
+
+
+@pytest.mark.parametrize("compression", [None, "zlib", "zstd"])
+def test_compressed_entries(tmpdir, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    chunks = list(Tokenizer(HEADER, "\n").read_chunks())
+    cache = SharedChunkCache(str(tmpdir), compression=compression)
+    cache._store("key", chunks)
+    size = tmpdir.listdir()[0].size()
+    assert (size < len(encode_chunks(chunks))) == (compression is not None)
+    # Any cache reads entries whatever compression they were written with
+    assert tokenized(SharedChunkCache(str(tmpdir))._load("key")) == (
+        tokenized(chunks))
+
+
+def test_unknown_compression(tmpdir):
+    with pytest.raises(ValueError):
+        SharedChunkCache(str(tmpdir), compression="lzma")
+
+
+def test_size_budget_evicts_least_recently_used(tmpdir):
+    chunks = list(Tokenizer(HEADER, "\n").read_chunks())
+    entry_size = len(encode_chunks(chunks))
+    # Pruned down to 90% of the budget, room for two entries
+    cache = SharedChunkCache(str(tmpdir), max_size=entry_size * 5 // 2)
+    cache._store("first", chunks)
+    cache._store("second", chunks)
+    os.utime(cache.entry_path("first"), (0, 0))
+    os.utime(cache.entry_path("second"), (1, 1))
+    # Loading marks an entry used so the other one gets evicted
+    assert SharedChunkCache(str(tmpdir))._load("first") is not None
+    cache._store("third", chunks)
+    assert os.path.exists(cache.entry_path("first"))
+    assert not os.path.exists(cache.entry_path("second"))
+    assert os.path.exists(cache.entry_path("third"))
+
+
+def test_size_budget_counted_once(tmpdir):
+    chunks = list(Tokenizer(HEADER, "\n").read_chunks())
+    entry_size = len(encode_chunks(chunks))
+    cache = SharedChunkCache(str(tmpdir), max_size=entry_size * 3)
+    with mock.patch("simplecpreprocessor.cache.cache_entries",
+                    wraps=cache_entries) as entries:
+        cache._store("first", chunks)
+        cache._store("second", chunks)
+        cache._store("second", chunks)
+        cache._store("third", chunks)
+        assert entries.call_count == 1
+        assert cache.size == entry_size * 3
+        cache._store("fourth", chunks)
+        assert entries.call_count == 2
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_stats_prune_clear(tmpdir):
+    tmpdir.join("other.h").write("".join(HEADER))
+    cache_dir = tmpdir.mkdir("cache")
+    run(str(cache_dir), str(tmpdir))
+    cache_dir.join("leftover.tmp").write("")
+    stats = cache_stats(str(cache_dir))
+    assert stats["entries"] == 2
+    assert stats["tok"]["entries"] == 2
+    assert stats["size"] == sum(entry.size() for entry in cache_dir.listdir()
+                                if entry.ext == ".tok")
+    assert prune_cache(str(cache_dir), stats["size"]) == 0
+    assert prune_cache(str(cache_dir), stats["size"] - 1) == 1
+    assert clear_cache(str(cache_dir)) == 2
+    assert cache_dir.listdir() == []
+
+
+def test_command_line(tmpdir, capsys):
+    tmpdir.join("other.h").write("".join(HEADER))
+    header = tmpdir.join("header.h")
+    header.write('#include "other.h"\nOTHER\n')
+    cache_dir = tmpdir.join("cache")
+    arguments = ["--input-file", str(header), "--cache-dir", str(cache_dir),
+                 "--cache-compression", "zlib"]
+    for output in ("first.h", "second.h"):
+        main(arguments + ["--output-file", str(tmpdir.join(output))])
+    assert tmpdir.join("first.h").read() == tmpdir.join("second.h").read()
+    assert cache_dir.listdir(lambda path: path.ext == ".rec")
+    main(["cache", "stats", "--cache-dir", str(cache_dir)])
+    assert "entries" in capsys.readouterr().out
+    main(["cache", "clear", "--cache-dir", str(cache_dir)])
+    assert cache_dir.listdir() == []
+    with pytest.raises(SystemExit):
+        main(["cache", "prune", "--cache-dir", str(cache_dir)])
+
+
+def test_entries_bounded():
+    cache = ChunkCache(max_entries=2)
+    for name in ("a.h", "b.h", "a.h", "c.h"):
+        f_obj = FakeFile(name, ["int %s;\n" % name[0]])
+        cache.load_summary(f_obj, "\n")
+    for kept in (cache.chunks, cache.programs, cache.summaries):
+        assert len(kept) == 2
+    # a.h was used after b.h so b.h went first
+    assert content_digest(["int b;\n"]) not in [
+        digest for digest, _ in cache.programs]
+    assert content_digest(["int a;\n"]) in [
+        digest for digest, _ in cache.programs]
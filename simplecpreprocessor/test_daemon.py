@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+import pytest
+import threading
+from simplecpreprocessor import daemon
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import HeaderStore
+
+
+@pytest.fixture
+def server(tmpdir):
+    socket_path = str(tmpdir.join("daemon.sock"))
+    server = daemon.PreprocessServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_inline_text(server):
+    output = daemon.request(server.server_address,
+                            input_text="#define FOO 1\nFOO\n")
+    assert output == "1\n"
+
+
+def test_input_file_with_include(server, tmpdir):
+    include = tmpdir.mkdir("include")
+    include.join("other.h").write("#define BAR 2\n")
+    header = tmpdir.join("header.h")
+    header.write("#include <other.h>\nBAR FOO\n")
+    for _ in range(2):
+        output = daemon.request(server.server_address,
+                                input_file=str(header),
+                                include_paths=[str(include)],
+                                defines={"FOO": "3"})
+        assert output == "2 3\n"
+    handler = server.header_handler([str(include)])
+    assert handler.resolved["other.h"] == str(include.join("other.h"))
+
+
+def test_changed_header_not_stale(server, tmpdir):
+    other = tmpdir.join("other.h")
+    header = tmpdir.join("header.h")
+    header.write('#include "other.h"\n')
+    other.write("1\n")
+    assert daemon.request(server.server_address,
+                          input_file=str(header)) == "1\n"
+    other.write("2\n")
+    assert daemon.request(server.server_address,
+                          input_file=str(header)) == "2\n"
+
+
+def test_concurrent_requests(server, tmpdir):
+    tmpdir.join("other.h").write("#define BAR 2\nBAR FOO\n")
+    outputs = {}
+
+    def run(index):
+        outputs[index] = daemon.request(
+            server.server_address, input_text='#include "other.h"\n',
+            include_paths=[str(tmpdir)], defines={"FOO": str(index)})
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outputs == {index: "2 %d\n" % index for index in range(8)}
+    assert len(server.header_handlers) == 1
+
+
+def test_error_reported(server):
+    with pytest.raises(ParseError) as excinfo:
+        daemon.request(server.server_address, input_text="#endif\n")
+    assert "Unexpected #endif" in str(excinfo.value)
+
+
+def test_unexpected_errors_reported(server, tmpdir):
+    header = tmpdir.join("header.h")
+    header.write_binary(b"int \xff;\n")
+    with pytest.raises(ParseError) as excinfo:
+        daemon.request(server.server_address, input_file=str(header))
+    assert "UnicodeDecodeError" in str(excinfo.value)
+    with pytest.raises(ParseError) as excinfo:
+        daemon.send(server.server_address, {"defines": {}})
+    assert "KeyError" in str(excinfo.value)
+    assert daemon.request(server.server_address, input_text="1\n") == "1\n"
+
+
+def test_invalidate(server, tmpdir):
+    first = tmpdir.mkdir("first")
+    second = tmpdir.mkdir("second")
+    first.join("other.h").write("1\n")
+    second.join("other.h").write("2\n")
+    paths = [str(first), str(second)]
+    assert daemon.request(server.server_address, input_text="#include "
+                          "<other.h>\n", include_paths=paths) == "1\n"
+    first.join("other.h").remove()
+    daemon.invalidate(server.server_address)
+    assert server.header_handlers == {}
+    assert daemon.request(server.server_address, input_text="#include "
+                          "<other.h>\n", include_paths=paths) == "2\n"
+
+
+def test_header_handlers_bounded(server, tmpdir):
+    for index in range(daemon.MAX_HANDLERS + 1):
+        server.header_handler([str(tmpdir.join(str(index)))])
+    assert len(server.header_handlers) == daemon.MAX_HANDLERS
+    assert (str(tmpdir.join("0")),) not in server.header_handlers
+
+
+def test_remove_stale_socket(tmpdir):
+    regular = tmpdir.join("regular")
+    regular.write("")
+    daemon.remove_stale_socket(str(regular))
+    daemon.remove_stale_socket(str(tmpdir.join("missing")))
+    assert regular.check()
+
+
+def test_load_store(tmpdir):
+    include = tmpdir.mkdir("include")
+    include.join("other.h").write("1\n")
+    blob = tmpdir.join("store.bin")
+    blob.write(HeaderStore({"/sdk/sdk.h": b"2\n"}).dumps(), mode="wb")
+    store = daemon.load_store([str(include), str(blob)])
+    assert store.get(str(include.join("other.h"))) == b"1\n"
+    assert store.get("/sdk/sdk.h") == b"2\n"
+
+
+def test_load_relative_directory(tmpdir):
+    include = tmpdir.mkdir("include")
+    include.join("other.h").write("1\n")
+    with tmpdir.as_cwd():
+        store = daemon.load_store(["include"])
+    assert store.get(str(include.join("other.h"))) == b"1\n"
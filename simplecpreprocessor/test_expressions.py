@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor import expressions
+from simplecpreprocessor.core import Defines, constants_to_token_constants
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.tokens import FunctionMacro, Token
+
+
+def evaluate(text, **defines):
+    evaluator = expressions.Evaluator(
+        Defines(constants_to_token_constants(defines)))
+    return evaluator.evaluate(text)
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("1", True),
+    ("0", False),
+    ("0x10 == 16", True),
+    ("010 == 8", True),
+    ("10UL == 10", True),
+    ("'a' == 97", True),
+    ("'\\n' == 10", True),
+    ("1 + 2 * 3 == 7", True),
+    ("(1 + 2) * 3 == 9", True),
+    ("-7 / 2 == -3", True),
+    ("-7 % 2 == -1", True),
+    ("1 << 4 == 16", True),
+    ("3 < 2 < 1", True),
+    ("!0 && !!2 == 1", True),
+    ("(2 && 3) == 1", True),
+    ("(0 || 5) == 1", True),
+    ("~0 == -1", True),
+    ("1 ? 2 : 0", True),
+    ("0 ? 2 : 0", False),
+    ("5 & 3 ^ 1 | 8", True),
+    ("UNDEFINED", False),
+    ("!defined UNDEFINED", True),
+    ("~0 == 0xFFFFFFFFFFFFFFFF", True),
+    ("-1 < 0", True),
+    ("-1 < 0u", False),
+    ("1u - 2 > 0", True),
+    ("0xFFFFFFFFFFFFFFFF + 1 == 0", True),
+    ("9223372036854775807 + 1 < 0", True),
+    ("9223372036854775808 > 0", True),
+    ("1 << 63 < 0", True),
+    ("-1 >> 1 == -1", True),
+    ("(0u - 1) >> 63 == 1", True),
+    ("(0 - 1u) / 2 == 0x7FFFFFFFFFFFFFFF", True),
+    ("-0x8000000000000000 == 0x8000000000000000", True),
+])
+def test_expressions(text, expected):
+    assert evaluate(text) is expected
+
+
+def test_macros():
+    assert evaluate("defined(FOO) && FOO > 2", FOO="3")
+    assert evaluate("BAR == 3", FOO="3", BAR="FOO")
+    assert evaluate("SUM == 5", SUM="2 + 3")
+    assert not evaluate("EMPTY", EMPTY="")
+    assert not evaluate("SELF", SELF="SELF")
+    assert not evaluate("0 && 1 / ZERO", ZERO="0")
+
+
+def test_function_macros():
+    defines = Defines({})
+    defines["IS"] = FunctionMacro(["a", "b"], list(map(
+        Token.from_string, [None] * 5, ["(", "a", "==", "b", ")"])))
+    defines["TWO"] = [Token.from_string(None, "2")]
+    evaluator = expressions.Evaluator(defines)
+    assert evaluator.evaluate("IS(TWO, 1 + 1) && !IS(TWO, 3)")
+    assert not evaluator.evaluate("IS")
+    with pytest.raises(ParseError):
+        evaluator.evaluate("TWO(1)")
+
+
+@pytest.mark.parametrize("text", [
+    "", "1 +", "(1", "1 2", "defined", "defined(1)", "1 $ 2", "09", "1.5",
+    "1 ? 2", "'ab'", "1 << 64", "1 << -1", "1 >> 64", "1 << 99999999999",
+    "18446744073709551616",
+])
+def test_invalid(text):
+    with pytest.raises(ParseError):
+        evaluate(text)
+
+
+def test_division_by_zero():
+    with pytest.raises(ParseError) as excinfo:
+        evaluate("1 / ZERO", ZERO="0")
+    assert "Division by zero" in str(excinfo.value)
+
+
+def test_compiled_once():
+    function = expressions.compile_expression("A + 1 == 2")
+    assert expressions.compile_expression("A + 1 == 2") is function
+    assert function(lambda name: 1, lambda name: 1, None) == 1
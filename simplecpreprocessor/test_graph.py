@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import mock
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.cache import ChunkCache
+from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.graph import IncludeGraph
+from simplecpreprocessor.program import compile_chunks
+from simplecpreprocessor.tokens import Tokenizer
+
+HEADERS = {
+    "a.h": ["#ifndef A_H\n", "#define A_H\n", "#define A 1\n",
+            '#include "common.h"\n', "int a = A;\n", "#endif\n"],
+    "common.h": ["#pragma once\n", "typedef int common;\n"],
+    "b.h": ["#ifndef B_H\n", "#define B_H\n", "int b;\n", "#endif\n"],
+    "c.h": ["int c = A;\n"],
+    "d.h": ['#include "common.h"\n', "int d;\n"],
+    "e.h": ["#undef A\n", "int e;\n"],
+}
+MAIN = ['#include "a.h"\n', '#include "b.h"\n', '#include "c.h"\n',
+        '#include "d.h"\n', "#ifdef A\n", '#include "missing.h"\n',
+        "#endif\n", '#include "e.h"\n', "A\n"]
+
+
+def test_independent_includes():
+    graph = IncludeGraph(FakeHandler(HEADERS), ChunkCache(), "\n")
+    operations = compile_chunks(Tokenizer(MAIN, "\n").read_chunks())
+    independent = graph.independent_includes("main.h", operations)
+    # c.h reads A from a.h, d.h skips common.h reached via a.h
+    assert sorted(independent) == [0, 1, 3, 7]
+    assert independent[0].headers >= {"a.h", "common.h"}
+    assert independent[0].writes == {"A_H", "A"}
+    assert "common.h" not in independent[3].headers
+    assert independent[3].skipped["common.h"] == "pragma_once"
+    assert independent[7].writes == {"A"}
+
+
+def test_guarded_common_header_skipped():
+    headers = {"config.h": ["#ifndef CONFIG_H\n", "#define CONFIG_H\n",
+                            "#define WIDTH 4\n", "#endif\n"]}
+    umbrella = []
+    for i in range(5):
+        headers["h%s.h" % i] = ["#ifndef H%s_H\n" % i, "#define H%s_H\n" % i,
+                                '#include "config.h"\n', "int h%s;\n" % i,
+                                "#endif\n"]
+        umbrella.append('#include "h%s.h"\n' % i)
+    graph = IncludeGraph(FakeHandler(headers), ChunkCache(), "\n")
+    operations = compile_chunks(Tokenizer(umbrella, "\n").read_chunks())
+    independent = graph.independent_includes("main.h", operations)
+    assert sorted(independent) == [0, 1, 2, 3, 4]
+    assert independent[4].skipped["config.h"] == ("CONFIG_H", "ifndef")
+
+
+def test_redefined_guard_not_skipped():
+    headers = {"config.h": ["#ifndef CONFIG_H\n", "#define CONFIG_H\n",
+                            "#endif\n"],
+               "x.h": ['#include "config.h"\n', "#undef CONFIG_H\n"]}
+    graph = IncludeGraph(FakeHandler(headers), ChunkCache(), "\n")
+    operations = compile_chunks(Tokenizer(['#include "config.h"\n',
+                                           '#include "x.h"\n'],
+                                          "\n").read_chunks())
+    assert sorted(graph.independent_includes("main.h", operations)) == [0]
+
+
+def test_pasting_macro_opaque():
+    headers = {"p.h": ["#define CAT(a, b) a ## b\n", "CAT(x, y)\n"]}
+    graph = IncludeGraph(FakeHandler(headers), ChunkCache(), "\n")
+    operations = compile_chunks(Tokenizer(['#include "p.h"\n'],
+                                          "\n").read_chunks())
+    assert graph.independent_includes("main.h", operations) == {}
+
+
+def write_headers(tmpdir):
+    for name, lines in HEADERS.items():
+        tmpdir.join(name).write("".join(lines))
+    main = tmpdir.join("main.h")
+    main.write("".join(line for line in MAIN if "missing" not in line))
+    return str(main)
+
+
+def test_same_output_as_serial(tmpdir):
+    path = write_headers(tmpdir)
+    with open(path) as f_obj:
+        expected = "".join(preprocess(f_obj))
+    assert expected == ("typedef int common;\nint a = 1;\nint b;\n"
+                        "int c = 1;\nint d;\nint e;\nA\n")
+    with ThreadPoolExecutor(2) as executor:
+        preprocessor = Preprocessor(subtree_executor=executor)
+        with mock.patch.object(executor, "submit",
+                               wraps=executor.submit) as submit:
+            with open(path) as f_obj:
+                assert "".join(preprocessor.preprocess(f_obj)) == expected
+        assert submit.call_count == 4
+        assert preprocessor.subtree_futures == {}
+        assert "A" not in preprocessor.defines
+        assert preprocessor.include_once[str(tmpdir.join("b.h"))] == (
+            "B_H", "ifndef")
+
+
+def test_skipped_header_processed_when_not_skipped(tmpdir):
+    tmpdir.join("g.h").write("#ifndef G\n#define G\nint g;\n#endif\n")
+    tmpdir.join("h.h").write('#include "g.h"\nint h;\n')
+    main = tmpdir.join("main.h")
+    main.write('#include "g.h"\n#undef G\n#include "h.h"\n')
+    with ThreadPoolExecutor(2) as executor:
+        preprocessor = Preprocessor(subtree_executor=executor)
+        with mock.patch.object(executor, "submit",
+                               wraps=executor.submit) as submit:
+            with open(str(main)) as f_obj:
+                output = "".join(preprocessor.preprocess(f_obj))
+        assert submit.call_count == 2
+    # The worker skipped g.h but it's included again in order
+    assert output == "int g;\nint g;\nint h;\n"
+
+
+def test_process_pool(tmpdir):
+    path = write_headers(tmpdir)
+    with open(path) as f_obj:
+        expected = "".join(preprocess(f_obj, line_markers=True))
+    with ProcessPoolExecutor(2) as executor:
+        with open(path) as f_obj:
+            output = "".join(preprocess(f_obj, line_markers=True,
+                                        subtree_executor=executor))
+    assert output == expected
+
+
+def test_other_handlers_processed_in_order():
+    handler = FakeHandler(HEADERS)
+    f_obj = FakeFile("main.h", [line for line in MAIN
+                                if "missing" not in line])
+    with ThreadPoolExecutor(2) as executor:
+        preprocessor = Preprocessor(header_handler=handler,
+                                    subtree_executor=executor)
+        with mock.patch.object(executor, "submit") as submit:
+            output = "".join(preprocessor.preprocess(f_obj))
+    assert output == "".join(preprocess(f_obj, header_handler=handler))
+    assert output.endswith("int e;\nA\n")
+    assert not submit.called
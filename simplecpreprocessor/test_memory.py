@@ -0,0 +1,106 @@
+"""
+Checks that preprocessing streams: peak memory must not grow with the size
+of the input. Set STREAM_TEST_BYTES to run the large case with eg a 1 GB
+header, the default keeps the suite fast.
+"""
+from __future__ import absolute_import
+import os
+import subprocess
+import sys
+import mock
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.memory import MemoryTracker
+
+SMALL_BYTES = 20000
+LARGE_BYTES = int(os.environ.get("STREAM_TEST_BYTES", SMALL_BYTES * 8))
+BLOCK = ("/* generated block {0}\n"
+         " * with a multi-line comment */\n"
+         "#define FIELD_TYPE int // redefined in every block\n"
+         "#ifdef NOT_DEFINED\n"
+         "struct skipped_{0} {{ char c; }};\n"
+         "#else\n"
+         "struct s_{0} {{\n"
+         "    FIELD_TYPE a; \\\n"
+         "    char *b;\n"
+         "}};\n"
+         "#endif\n"
+         "#undef FIELD_TYPE\n")
+
+
+class GeneratedHeader(object):
+
+    def __init__(self, size):
+        self.name = "generated.h"
+        self.size = size
+
+    def __iter__(self):
+        produced = 0
+        block = 0
+        while produced < self.size:
+            text = BLOCK.format(block)
+            for line in text.splitlines(True):
+                yield line
+            produced += len(text)
+            block += 1
+
+
+def streamed_peak(size):
+    tracker = MemoryTracker()
+    tracker.start()
+    try:
+        output_size = 0
+        for chunk in preprocess(GeneratedHeader(size),
+                                memory_tracker=tracker):
+            output_size += len(chunk)
+    finally:
+        tracker.stop()
+    assert output_size > size // 10
+    return max(tracker.phases.values())
+
+
+def test_streaming_is_bounded_memory():
+    small = streamed_peak(SMALL_BYTES)
+    large = streamed_peak(LARGE_BYTES)
+    assert large < small * 1.5 + 64 * 1024, (small, large)
+
+
+def test_report_per_phase_and_header():
+    f_obj = FakeFile("header.h", ['#include "other.h"\n', "X\n"])
+    handler = FakeHandler({"other.h": ["#define X 1\n", "X\n"]})
+    tracker = MemoryTracker()
+    tracker.start()
+    try:
+        ret = preprocess(f_obj, header_handler=handler,
+                         memory_tracker=tracker)
+        assert "".join(ret) == "1\n1\n"
+    finally:
+        tracker.stop()
+    report = tracker.report()
+    assert set(report["phases"]) == {"lexing", "expansion", "output"}
+    assert set(report["headers"]) == {"header.h", "other.h"}
+    text = tracker.format_report()
+    assert "other.h" in text
+    assert "expansion" in text
+
+
+def test_without_reset_peak():
+    # Python 3.8 has no tracemalloc.reset_peak
+    with mock.patch("simplecpreprocessor.memory._reset_peak", None):
+        tracker = MemoryTracker()
+        tracker.start()
+        try:
+            ret = preprocess(FakeFile("header.h", ["1\n"]),
+                             memory_tracker=tracker)
+            assert "".join(ret) == "1\n"
+        finally:
+            tracker.stop()
+    assert tracker.phases["lexing"] > 0
+    assert tracker.phases["output"] > 0
+
+
+def test_not_imported_without_tracker():
+    code = ("import sys, simplecpreprocessor.__main__; "
+            "print('tracemalloc' in sys.modules)")
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.strip() == b"False"
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import open_mapped
+from simplecpreprocessor.parallel import ParallelTokenizer, split_ranges
+from simplecpreprocessor.tokens import BytesTokenizer
+
+SOURCE = (b"#define FOO 1\n"
+          b"/* block comment\n"
+          b" * spanning\n"
+          b" * lines */ int a = FOO;\n"
+          b"// line comment \\\n"
+          b"   continued\n"
+          b"#ifdef FOO\n"
+          b"struct s { \\\n"
+          b"  char *c; };\n"
+          b"#endif\n"
+          b"const char *s = \"\xc3\xa4\"; /* trailing\n"
+          b"*/ int b;\n") * 3
+
+
+def tokenized(tokenizer):
+    return [[(t.line_no, t.value, t.whitespace, t.chunk_mark) for t in chunk]
+            for chunk in tokenizer.read_chunks()]
+
+
+def test_split_ranges():
+    ranges = split_ranges(SOURCE, 10)
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == len(SOURCE)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert SOURCE[end - 1:end] == b"\n"
+    assert split_ranges(b"", 10) == []
+    assert split_ranges(SOURCE, len(SOURCE)) == [(0, len(SOURCE))]
+
+
+@pytest.mark.parametrize("range_size", [1, 7, 30, 100, 10000])
+def test_same_as_serial(range_size):
+    expected = tokenized(BytesTokenizer(SOURCE, "\n"))
+    with ThreadPoolExecutor(4) as executor:
+        tokenizer = ParallelTokenizer(SOURCE, "\n", executor, range_size)
+        assert tokenized(tokenizer) == expected
+
+
+def test_process_pool(tmpdir):
+    header = tmpdir.join("header.h")
+    header.write(SOURCE, mode="wb")
+    with open_mapped(str(header)) as f_obj:
+        expected = "".join(preprocess(f_obj))
+    with ProcessPoolExecutor(2) as executor:
+        with open_mapped(str(header), executor, range_size=64) as f_obj:
+            assert isinstance(f_obj.tokenizer("\n"), ParallelTokenizer)
+            assert "".join(preprocess(f_obj)) == expected
+    assert "int a = 1;" in expected
+    assert "spanning" not in expected
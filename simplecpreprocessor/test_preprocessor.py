@@ -1,17 +1,29 @@
 from __future__ import absolute_import
 import pytest
 from simplecpreprocessor import preprocess
-from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor.core import (Preprocessor,
+                                      constants_to_token_constants)
 from simplecpreprocessor.exceptions import ParseError, UnsupportedPlatform
-from simplecpreprocessor.tokens import Token
+from simplecpreprocessor.tokens import Token, BytesTokenizer
 from simplecpreprocessor.platform import (calculate_platform_constants,
                                           extract_platform_spec)
-from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+from simplecpreprocessor.filesystem import (FakeFile, FakeHandler,
+                                            ArchiveHandler, HeaderHandler,
+                                            HeaderStore, StoreHandler,
+                                            MappedHeaderHandler, open_mapped)
+from simplecpreprocessor.cache import ChunkCache
 import posixpath
+import time
 import os
+import tarfile
+import zipfile
 import cProfile
 from pstats import Stats
 import platform
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import mock
 
 profiler = None
@@ -223,6 +235,157 @@ def test_else_left_open_causes_error():
     assert "left open" in s
 
 
+def test_function_macro():
+    f_obj = FakeFile("header.h", [
+        "#define FOO 42\n",
+        "#define MAX(a, b) ((a) > (b) ? (a) : (b))\n",
+        "MAX(1, FOO) MAX(MAX(1, 2), (3, 4))\n"])
+    expected = "((1) > (42) ? (1) : (42)) ((((1) > (2) ? (1) : (2))) > " \
+               "((3, 4)) ? (((1) > (2) ? (1) : (2))) : ((3, 4)))\n"
+    run_case(f_obj, expected)
+
+
+def test_function_macro_stringify_and_paste():
+    f_obj = FakeFile("header.h", [
+        "#define FOO 42\n",
+        "#define STR(x) #x\n",
+        "#define XSTR(x) STR(x)\n",
+        "#define CAT(a, b) a ## b\n",
+        'STR(FOO  "a\\b") XSTR(FOO)\n',
+        "CAT(FO, O) CAT(x, FOO) CAT(, y)\n"])
+    expected = '"FOO \\"a\\\\b\\"" "42"\n42 xFOO y\n'
+    run_case(f_obj, expected)
+
+
+def test_function_macro_variadic():
+    f_obj = FakeFile("header.h", [
+        "#define LOG(fmt, ...) printf(fmt, __VA_ARGS__)\n",
+        "#define NONE() none\n",
+        'LOG("%d %d", 1, 2); NONE()\n'])
+    run_case(f_obj, 'printf("%d %d", 1, 2); none\n')
+
+
+def test_function_macro_without_invocation():
+    f_obj = FakeFile("header.h", [
+        "#define F(x) x + F(x)\n",
+        "#define G 1\n",
+        "F F G F (2)\n",
+        "F(\n"])
+    run_case(f_obj, "F F 1 2 + F(2)\nF(\n")
+
+
+def test_object_macro_naming_function_macro():
+    f_obj = FakeFile("header.h", [
+        "#define F(x) [x]\n",
+        "#define G F\n",
+        "#define CreateWindow CreateWindowA\n",
+        "#define CreateWindowA(name) create(name)\n",
+        "G(1) G (2) G;\n",
+        'CreateWindow("w");\n'])
+    run_case(f_obj, '[1] [2] F;\ncreate("w");\n')
+
+
+def test_replacement_rescanned_once_names_defined():
+    f_obj = FakeFile("header.h", ["#define A B C\n", "A\n",
+                                  "#define B 1\n", "A\n",
+                                  "#undef B\n", "A\n"])
+    assert "".join(preprocess(f_obj)) == "B C\n1 C\nB C\n"
+
+
+def test_function_macro_result_invoked():
+    f_obj = FakeFile("header.h", [
+        "#define F(x) [x]\n",
+        "#define ID(x) x\n",
+        "ID(F)(1) ID(F) x\n"])
+    run_case(f_obj, "[1] F x\n")
+
+
+@pytest.mark.parametrize("lines,message", [
+    (["#define F(x, y) x\n", "F(1)\n"],
+     "Macro F on line 1 expects 2 arguments, got 1"),
+    (["#define F(x\n"], "Missing ) in parameter list of macro on line 0"),
+])
+def test_function_macro_errors(lines, message):
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(FakeFile("header.h", lines)))
+    assert message in str(excinfo.value)
+
+
+def test_if_elif_else():
+    lines = ["#if FOO > 2\n", "big\n",
+             "#elif defined(FOO) && FOO == 2\n", "two\n",
+             "#elif FOO\n", "one\n",
+             "#else\n", "none\n",
+             "#endif\n"]
+    for value, expected in (("3", "big\n"), ("2", "two\n"),
+                            ("1", "one\n"), ("0", "none\n")):
+        f_obj = FakeFile("header.h", ["#define FOO %s\n" % value] + lines)
+        run_case(f_obj, expected)
+
+
+def test_if_nested_in_ignored_region():
+    f_obj = FakeFile("header.h", [
+        "#if 0\n",
+        "#if 1 / 0\n",
+        "a\n",
+        "#elif 1\n",
+        "#undef FOO\n",
+        "#else\n",
+        "c\n",
+        "#endif\n",
+        "#elif 1\n",
+        "FOO\n",
+        "#elif 1\n",
+        "d\n",
+        "#endif\n"])
+    ret = preprocess(f_obj, platform_constants=constants_to_token_constants(
+        {"FOO": "foo"}))
+    assert "".join(ret) == "foo\n"
+
+
+def test_if_multiline_expression():
+    f_obj = FakeFile("header.h", [
+        "#if defined(FOO) || \\\n",
+        "    !defined(BAR) /* comment */\n",
+        "1\n",
+        "#endif\n"])
+    run_case(f_obj, "1\n")
+
+
+def test_if_left_open_causes_error():
+    f_obj = FakeFile("header.h", ["#if 1\n", "#elif 0\n"])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj))
+    assert "#elif 0 from line 1 left open" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("lines,message", [
+    (["#elif 1\n"], "Unexpected #elif on line 0"),
+    (["#if 1\n", "#else\n", "#elif 1\n"], "#elif after #else on line 2"),
+    (["#if 1\n", "#else\n", "#else\n"], "#else after #else on line 2"),
+    (["#if 1 +\n"], "on line 0"),
+    (["#if 1 / 0\n"], "Division by zero"),
+])
+def test_if_errors(lines, message):
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(FakeFile("header.h", lines)))
+    assert message in str(excinfo.value)
+
+
+def test_if_file_guard():
+    f_obj = FakeFile("header.h", ['#include "other.h"\n',
+                                  '#include "other.h"\n'])
+    handler = FakeHandler({"other.h": ["#if !defined(OTHER_H)\n",
+                                       "#define OTHER_H\n",
+                                       "1\n",
+                                       "#endif\n"]})
+    preprocessor = Preprocessor(header_handler=handler)
+    assert "".join(preprocessor.preprocess(f_obj)) == "1\n"
+    assert preprocessor.include_once["other.h"] == ("!defined(OTHER_H)",
+                                                    "if")
+    assert preprocessor.skip_file("other.h")
+
+
 def test_unexpected_macro_gives_parse_error():
     f_obj = FakeFile("header.h", ["#something_unsupported foo bar\n"])
     with pytest.raises(ParseError):
@@ -440,6 +603,89 @@ def test_space_macro_indentation():
     run_case(f_obj, expected)
 
 
+def test_include_local_resolved_per_directory():
+    f_obj = FakeFile("header.h", ['#include "a/other.h"\n',
+                                  '#include "b/other.h"\n'])
+    handler = FakeHandler({"a/other.h": ['#include "config.h"\n'],
+                           "a/config.h": ["1\n"],
+                           "b/other.h": ['#include "config.h"\n'],
+                           "b/config.h": ["2\n"]})
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "1\n2\n"
+
+
+def test_chunk_cache_reused():
+    handler = FakeHandler({"other.h": ["#define X 1\n", "X\n"]})
+    cache = ChunkCache()
+    for _ in range(2):
+        f_obj = FakeFile("header.h", ['#include "other.h"\n'])
+        preprocessor = Preprocessor(header_handler=handler,
+                                    chunk_cache=cache)
+        assert "".join(preprocessor.preprocess(f_obj)) == "1\n"
+    assert len(cache.chunks) == 2
+
+
+def test_chunk_cache_program_reused():
+    handler = FakeHandler({"other.h": ["#ifdef Y\n", "#define X Y\n",
+                                       "#else\n", "#define X 2\n",
+                                       "#endif\n", "X\n"]})
+    cache = ChunkCache()
+    outputs = []
+    for defines in ([], ["#define Y 3\n"]):
+        f_obj = FakeFile("header.h", defines + ['#include "other.h"\n'])
+        preprocessor = Preprocessor(header_handler=handler,
+                                    chunk_cache=cache)
+        outputs.append("".join(preprocessor.preprocess(f_obj)))
+        if not defines:
+            programs = dict(cache.programs)
+    assert outputs == ["2\n", "3\n"]
+    assert len(programs) == 2
+    for key, compiled in programs.items():
+        assert cache.programs[key] is compiled
+
+
+def test_chunk_cache_content_change():
+    contents = ["1\n"]
+    handler = FakeHandler({"other.h": contents})
+    cache = ChunkCache()
+    f_obj = FakeFile("header.h", ['#include "other.h"\n'])
+    ret = Preprocessor(header_handler=handler,
+                       chunk_cache=cache).preprocess(f_obj)
+    assert "".join(ret) == "1\n"
+    contents[0] = "2\n"
+    ret = Preprocessor(header_handler=handler,
+                       chunk_cache=cache).preprocess(f_obj)
+    assert "".join(ret) == "2\n"
+
+
+def test_chunk_cache_identical_contents():
+    contents = ["#pragma once\n", "int x;\n"]
+    handler = FakeHandler({"a/other.h": contents,
+                           "b/other.h": list(contents)})
+    cache = ChunkCache()
+    f_obj = FakeFile("header.h", ['#include "a/other.h"\n',
+                                  '#include "b/other.h"\n'])
+    preprocessor = Preprocessor(header_handler=handler, chunk_cache=cache)
+    assert "".join(preprocessor.preprocess(f_obj)) == "int x;\n"
+    assert len(cache.chunks) == 2
+    assert "".join(preprocess(f_obj, header_handler=handler)) == (
+        "int x;\nint x;\n")
+
+
+def test_chunk_cache_identical_guarded_contents():
+    contents = ["#ifndef OTHER\n", "#define OTHER\n", "int x;\n",
+                "#endif\n"]
+    handler = FakeHandler({"a/other.h": contents,
+                           "b/other.h": list(contents)})
+    f_obj = FakeFile("header.h", ['#include "a/other.h"\n',
+                                  '#include "b/other.h"\n'])
+    preprocessor = Preprocessor(header_handler=handler,
+                                chunk_cache=ChunkCache())
+    assert "".join(preprocessor.preprocess(f_obj)) == "int x;\n"
+    assert len(set(preprocessor.include_once.values())) == 1
+    assert len(preprocessor.include_once) == 2
+
+
 def test_include_with_path_list_with_subdirectory():
     header_file = posixpath.join("nested", "other.h")
     include_path = "somedir"
@@ -593,6 +839,311 @@ def test_platform_constants():
     assert "".join(ret) == "ODDPLATFORM\n"
 
 
+def test_include_in_inactive_region_not_read():
+    f_obj = FakeFile("header.h", ["#ifdef _WIN32\n",
+                                  "#include <windows.h>\n",
+                                  "#endif\n",
+                                  "1\n"])
+    ret = preprocess(f_obj, header_handler=FakeHandler({}))
+    assert "".join(ret) == "1\n"
+
+
+class RecordingHandler(FakeHandler):
+
+    def __init__(self, header_mapping, executor, blocking=None):
+        super(RecordingHandler, self).__init__(header_mapping,
+                                               executor=executor)
+        self.blocking = blocking or {}
+        self.opened = {}
+        self.events = {}
+        for header in self.blocking.values():
+            self.events[header] = threading.Event()
+
+    def _open(self, header_path):
+        waits_for = self.blocking.get(header_path)
+        if waits_for is not None:
+            assert self.events[waits_for].wait(5)
+        elif header_path in self.events:
+            self.events[header_path].set()
+        self.opened[header_path] = threading.current_thread()
+        return super(RecordingHandler, self)._open(header_path)
+
+
+def test_prefetch_includes_of_opened_header():
+    mapping = {"a.h": ['#include "b.h"\n', '#include "c.h"\n'],
+               "b.h": ["b\n"],
+               "c.h": ["c\n"]}
+    f_obj = FakeFile("header.h", ['#include "a.h"\n'])
+    with ThreadPoolExecutor(4) as executor:
+        handler = RecordingHandler(mapping, executor, {"b.h": "c.h"})
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "b\nc\n"
+    assert handler.prefetched == {}
+
+
+def test_prefetch_dependencies_of_earlier_run():
+    mapping = {"a.h": ["#pragma once\n", "a\n"], "b.h": ["b\n"]}
+    with ThreadPoolExecutor(4) as executor:
+        handler = RecordingHandler(mapping, executor)
+        for _ in range(2):
+            handler.opened.clear()
+            f_obj = FakeFile("header.h", ['#include "a.h"\n',
+                                          '#include "a.h"\n',
+                                          '#include "b.h"\n'])
+            ret = preprocess(f_obj, header_handler=handler)
+            assert "".join(ret) == "a\nb\n"
+    assert list(handler.dependencies) == [("a.h", "header.h"),
+                                          ("b.h", "header.h")]
+    main_thread = threading.current_thread()
+    assert all(thread is not main_thread
+               for thread in handler.opened.values())
+
+
+def run_threads(count, target):
+    errors = []
+
+    def run(index):
+        try:
+            target(index)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_shared_handler_stress(tmpdir, prefetch):
+    include = tmpdir.mkdir("include")
+    for index in range(10):
+        include.join("h%d.h" % index).write(
+            "#pragma once\n"
+            '#include "h%d.h"\n'
+            "#if VALUE > %d\n"
+            "int h%d = VALUE;\n"
+            "#endif\n" % ((index + 1) % 10, index, index))
+    chunk_cache = ChunkCache()
+    with ThreadPoolExecutor(4) as executor:
+        handler = HeaderHandler([], executor if prefetch else None)
+
+        def target(index):
+            value = str(index % 10)
+            for _ in range(20):
+                f_obj = FakeFile("header.h", ["#include <h0.h>\n"])
+                preprocessor = Preprocessor(
+                    header_handler=handler, include_paths=[str(include)],
+                    chunk_cache=chunk_cache,
+                    platform_constants=constants_to_token_constants(
+                        {"VALUE": value}))
+                output = "".join(preprocessor.preprocess(f_obj))
+                assert output == "".join(
+                    "int h%d = %s;\n" % (header, value)
+                    for header in range(9, -1, -1) if int(value) > header)
+        run_threads(16, target)
+    assert handler.include_paths == [str(include)]
+    assert len(handler.resolved) == 11
+    assert handler.prefetched == {}
+    assert handler.runs == 0
+
+
+MAPPED_HEADER = (b"#ifndef OTHER\r\n"
+                 b"#define OTHER\r\n"
+                 b"/* multi\r\n"
+                 b" * line comment\r\n"
+                 b" */ int x; // trailing\r\n"
+                 b"#define S \"\xc3\xa4 /* \"\r\n"
+                 b"const char *s = S; /* \xc3\xa4 */\r\n"
+                 b"#include \"empty.h\"\r\n"
+                 b"#endif\r\n")
+
+
+def test_mapped_header_handler(tmpdir):
+    tmpdir.join("other.h").write(MAPPED_HEADER, mode="wb")
+    tmpdir.join("empty.h").write("")
+    header = tmpdir.join("header.h")
+    header.write('#include <other.h>\n#include <other.h>\n')
+    with open(str(header)) as f_obj:
+        expected = "".join(preprocess(
+            f_obj, header_handler=HeaderHandler([str(tmpdir)])))
+    with open_mapped(str(header)) as f_obj:
+        output = "".join(preprocess(
+            f_obj, header_handler=MappedHeaderHandler([str(tmpdir)])))
+    assert output == expected
+    assert output == u" int x;\nconst char *s = \"\u00e4 /* \";\n"
+
+
+def test_mapped_missing_header():
+    handler = MappedHeaderHandler([])
+    assert handler.read_header("does_not_exist.h", None) is None
+
+
+def test_bytes_tokenizer_skips_comment_lines():
+    tokenizer = BytesTokenizer(b"/*\na b c\n*/ d\n", "\n")
+    tokenized = []
+    for token in tokenizer:
+        tokenized.append(token.value)
+    assert tokenized == [" ", "d", "\n"]
+    assert b"b" not in tokenizer.decoded
+
+
+ARCHIVE_MEMBERS = {
+    "sdk/include/sdk.h": b'#include "detail/types.h"\nsdk_t f(void);\n',
+    "sdk/include/detail/types.h": b"typedef int sdk_t;\n",
+}
+
+
+def check_archive_handler(archive_path):
+    handler = ArchiveHandler(archive_path, include_paths=["sdk/include"])
+    f_obj = FakeFile("header.h", ["#include <sdk.h>\n"])
+    try:
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "typedef int sdk_t;\nsdk_t f(void);\n"
+        f_obj = FakeFile("header.h", ["#include <missing.h>\n"])
+        with pytest.raises(ParseError):
+            "".join(preprocess(f_obj, header_handler=handler))
+    finally:
+        handler.close()
+
+
+def test_zip_archive_handler(tmpdir):
+    archive_path = str(tmpdir.join("sdk.zip"))
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("sdk/include/", b"")
+        for name, data in ARCHIVE_MEMBERS.items():
+            archive.writestr(name, data)
+    check_archive_handler(archive_path)
+
+
+def test_tar_archive_handler(tmpdir):
+    for name, data in ARCHIVE_MEMBERS.items():
+        member = tmpdir.join("root", name)
+        member.write(data, mode="wb", ensure=True)
+    archive_path = str(tmpdir.join("sdk.tar.gz"))
+    with tarfile.open(archive_path, "w:gz") as archive:
+        archive.add(str(tmpdir.join("root")), arcname=".")
+    check_archive_handler(archive_path)
+
+
+def test_header_store_from_directory(tmpdir):
+    include = tmpdir.mkdir("include")
+    include.join("sdk.h").write('#include "detail/types.h"\nsdk_t f;\n')
+    include.join("detail", "types.h").write("typedef int sdk_t;\n",
+                                            ensure=True)
+    include.join("README").write("not a header")
+    store = HeaderStore.from_directory(str(include), extensions=[".h"])
+    assert len(store) == 2
+    include.remove()
+    for loaded in (store, HeaderStore.loads(store.dumps())):
+        handler = StoreHandler(loaded, [str(include)])
+        f_obj = FakeFile("header.h", ["#include <sdk.h>\n"])
+        ret = preprocess(f_obj, header_handler=handler)
+        assert "".join(ret) == "typedef int sdk_t;\nsdk_t f;\n"
+
+
+def test_header_store_overlay(tmpdir):
+    tmpdir.join("real.h").write("real\n")
+    tmpdir.join("stored.h").write("on disk\n")
+    store = HeaderStore({str(tmpdir.join("stored.h")): b"stored\n"})
+    f_obj = FakeFile("header.h", ["#include <stored.h>\n",
+                                  "#include <real.h>\n"])
+    handler = StoreHandler(store, [str(tmpdir)], overlay=True)
+    ret = preprocess(f_obj, header_handler=handler)
+    assert "".join(ret) == "stored\nreal\n"
+    handler = StoreHandler(store, [str(tmpdir)])
+    with pytest.raises(ParseError):
+        "".join(preprocess(f_obj, header_handler=handler))
+
+
+def test_header_store_invalid_blob():
+    with pytest.raises(ValueError):
+        HeaderStore.loads(b"\x00" * 12)
+
+
+def test_max_include_depth():
+    f_obj = FakeFile("header.h", ['#include "other.h"\n'])
+    handler = FakeHandler({"other.h": ['#include "other.h"\n']})
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, header_handler=handler,
+                           max_include_depth=10))
+    assert "Include depth exceeds 10" in str(excinfo.value)
+    handler = FakeHandler({"other.h": ['#include "leaf.h"\n'],
+                           "leaf.h": ["1\n"]})
+    ret = preprocess(f_obj, header_handler=handler, max_include_depth=2)
+    assert "".join(ret) == "1\n"
+
+
+def test_max_expansion():
+    lines = ["#define A0 x\n"]
+    for i in range(1, 20):
+        lines.append("#define A%d A%d A%d\n" % (i, i - 1, i - 1))
+    f_obj = FakeFile("header.h", lines + ["A3 A19\n"])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, max_expansion=1000))
+    assert "Expansion of A19 on line 20 exceeds 1000" in str(excinfo.value)
+    f_obj = FakeFile("header.h", lines + ["A3\n"])
+    ret = preprocess(f_obj, max_expansion=15)
+    assert "".join(ret) == "x x x x x x x x\n"
+
+
+def exponential_chain(first, fmt):
+    lines = ["#define A0 %s\n" % first]
+    for i in range(1, 23):
+        lines.append(fmt % (i, i - 1, i - 1))
+    return lines
+
+
+def test_max_expansion_of_empty_replacements():
+    lines = exponential_chain("", "#define A%d A%d A%d\n")
+    f_obj = FakeFile("header.h", lines + ["A22\n"])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, max_expansion=1000))
+    assert "Expansion of A22 on line 23 exceeds 1000" in str(excinfo.value)
+
+
+def test_max_expansion_in_expression():
+    lines = exponential_chain("1", "#define A%d (A%d + A%d)\n")
+    f_obj = FakeFile("header.h", lines + ["#if A22\n", "#endif\n"])
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, max_expansion=1000))
+    assert "exceeds 1000 tokens on line 23" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("last_lines", [
+    ["A22\n"], ["#if A22\n", "#endif\n"],
+])
+def test_timeout_during_expansion(last_lines):
+    lines = exponential_chain("1", "#define A%d (A%d + A%d)\n")
+    f_obj = FakeFile("header.h", lines + last_lines)
+    start = time.monotonic()
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, timeout=0.2))
+    assert "Time limit of 0.2 seconds exceeded" in str(excinfo.value)
+    assert "line 23" in str(excinfo.value)
+    assert time.monotonic() - start < 2
+
+
+def test_max_output():
+    f_obj = FakeFile("header.h", ["12345\n", "6789\n"])
+    assert "".join(preprocess(f_obj, max_output=11)) == "12345\n6789\n"
+    with pytest.raises(ParseError) as excinfo:
+        "".join(preprocess(f_obj, max_output=10))
+    assert "Output exceeds 10 characters on line 1" in str(excinfo.value)
+
+
+def test_timeout():
+    f_obj = FakeFile("header.h", ["1\n", "2\n"])
+    with mock.patch("time.monotonic") as monotonic:
+        monotonic.side_effect = [0, 1, 2, 3]
+        with pytest.raises(ParseError) as excinfo:
+            "".join(preprocess(f_obj, timeout=1.5))
+    assert "Time limit of 1.5 seconds exceeded on line 1" in str(
+        excinfo.value)
+
+
 def test_handler_missing_file():
     handler = FakeHandler([])
     assert handler.parent_open("does_not_exist") is None
@@ -676,3 +1227,109 @@ def test_platform():
     system = platform.system()
     bitness, _ = platform.architecture()
     assert extract_platform_spec() == (system, bitness)
+
+
+def test_import_does_no_platform_detection():
+    code = ("import sys, simplecpreprocessor\n"
+            "from simplecpreprocessor import core, platform\n"
+            "assert 'pkg_resources' not in sys.modules\n"
+            "assert platform._platform_constants is None\n"
+            "assert core._token_constants is None\n")
+    subprocess.check_call([sys.executable, "-c", code])
+
+
+def test_lazy_constants():
+    from simplecpreprocessor import core, platform as scpp_platform
+    assert core.TOKEN_CONSTANTS is core.token_constants()
+    assert (scpp_platform.PLATFORM_CONSTANTS is
+            scpp_platform.platform_constants())
+    with pytest.raises(AttributeError):
+        core.BOGUS
+
+
+PUSHED = ("#define FOO 1\n"
+          "/* multi-line\n"
+          " comment */ FOO x \\\n"
+          "  y\n"
+          '#include "other.h"\n'
+          "#ifdef FOO\n"
+          "ä BAR\r\n"
+          "#endif\n")
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 1000])
+def test_push_feed(size):
+    handler = FakeHandler({"other.h": ["#define BAR 2\n"]})
+    expected = "".join(preprocess(FakeFile("header.h",
+                                           PUSHED.splitlines(True)),
+                                  header_handler=handler))
+    # Odd sizes push bytes, splitting multibyte characters
+    data = PUSHED.encode("utf-8") if size % 2 else PUSHED
+    preprocessor = Preprocessor(header_handler=handler)
+    output = []
+    for start in range(0, len(data), size):
+        output.extend(preprocessor.feed(data[start:start + size]))
+        assert "".join(output) == expected[:len("".join(output))]
+    output.extend(preprocessor.close())
+    assert "".join(output) == expected == " 1 x \\\n  y\nä 2\n"
+
+
+def test_push_output_per_line():
+    preprocessor = Preprocessor()
+    assert preprocessor.feed("#define FOO 1\nFOO") == []
+    assert preprocessor.feed(" 2\nFO") == ["1", " ", "2", "\n"]
+    assert preprocessor.feed("O\n") == ["1", "\n"]
+    assert preprocessor.close() == []
+    with pytest.raises(ValueError):
+        preprocessor.feed("x\n")
+
+
+def test_push_open_constraint():
+    preprocessor = Preprocessor()
+    assert preprocessor.feed("#ifdef FOO\n") == []
+    with pytest.raises(ParseError) as excinfo:
+        preprocessor.close()
+    assert "left open" in str(excinfo.value)
+
+
+def test_line_markers():
+    f_obj = FakeFile("header.h", ["int a;\n",
+                                  "#define X 1\n",
+                                  "X b;\n",
+                                  '#include "other.h"\n',
+                                  "int c; /* multi\n",
+                                  " line */ int d;\n",
+                                  "int e;\n"])
+    handler = FakeHandler({"other.h": ["int o;\n"]})
+    ret = preprocess(f_obj, header_handler=handler, line_markers=True)
+    assert "".join(ret) == ('#line 1 "header.h"\n'
+                            "int a;\n"
+                            "\n"
+                            "1 b;\n"
+                            '#line 1 "other.h"\n'
+                            "int o;\n"
+                            '#line 5 "header.h"\n'
+                            "int c; int d;\n"
+                            '#line 7 "header.h"\n'
+                            "int e;\n")
+
+
+def test_line_markers_long_gap():
+    lines = ["int a;\n"] + ["#define X\n"] * 20 + ["int b;\n"]
+    ret = preprocess(FakeFile("header.h", lines), line_markers=True)
+    assert "".join(ret) == ('#line 1 "header.h"\nint a;\n'
+                            '#line 22 "header.h"\nint b;\n')
+
+
+def test_lines_without_defines_not_expanded():
+    f_obj = FakeFile("header.h", ["#define X 1\n", "int a;\n", "X b;\n",
+                                  "#undef X\n", "X c;\n"])
+    preprocessor = Preprocessor()
+    with mock.patch.object(preprocessor.token_expander, "expand_tokens",
+                           wraps=preprocessor.token_expander.expand_tokens
+                           ) as expand_tokens:
+        ret = "".join(preprocessor.preprocess(f_obj))
+    assert ret == "int a;\n1 b;\nX c;\n"
+    # Only for the line using X, its replacement is rescanned in place
+    assert [call[0][0][0].value
+            for call in expand_tokens.call_args_list] == ["X"]
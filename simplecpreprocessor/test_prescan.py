@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+import mock
+import pytest
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import BytesFile
+from simplecpreprocessor.tokens import BytesTokenizer
+
+numpy = pytest.importorskip("numpy")
+from simplecpreprocessor.prescan import DirectiveIndex  # noqa: E402
+
+BLOCK = (b"#ifdef NOT_DEFINED\n"
+         b"int skipped_a;\n"
+         b"  #ifdef NESTED\n"
+         b"int skipped_b; /* comment with\n"
+         b"#endif inside */\n"
+         b"\t#endif\n"
+         b"#define CONTINUED \\\n"
+         b"#endif\n"
+         b"x /* a */ #else\n"
+         b"int skipped_c; // # not a directive\n"
+         b"#else\n"
+         b"int kept; \\\n"
+         b"  int kept_continued;\n"
+         b"#endif\n"
+         b"#ifndef NOT_DEFINED\n"
+         b"int kept_crlf;\r\n"
+         b"#endif\n") * 50
+
+
+def test_directive_index():
+    data = b"a\n  #if X\n/* c\n*/\n\t# endif\nb # c\n"
+    index = DirectiveIndex(data)
+    assert data[index.directives[0]:].startswith(b"  #if")
+    assert data[index.directives[1]:].startswith(b"\t# endif")
+    assert len(index.directives) == 2
+    assert index.skip(0) == (2, 1)
+    assert index.skip(10) == (10, 0)
+    assert index.skip(18) == (18, 0)
+    assert index.skip(27) == (len(data), 1)
+
+
+def test_same_output_with_skipping():
+    with mock.patch.object(BytesTokenizer, "prescan_min_size", 0):
+        with mock.patch.object(BytesTokenizer, "_tokenize",
+                               autospec=True,
+                               side_effect=BytesTokenizer._tokenize) as t:
+            skipped = "".join(preprocess(BytesFile("header.h", BLOCK)))
+            skipped_calls = t.call_count
+    with mock.patch("simplecpreprocessor.prescan.numpy", None):
+        with mock.patch.object(BytesTokenizer, "_tokenize",
+                               autospec=True,
+                               side_effect=BytesTokenizer._tokenize) as t:
+            expected = "".join(preprocess(BytesFile("header.h", BLOCK)))
+            expected_calls = t.call_count
+    assert skipped == expected
+    assert "kept_continued" in expected
+    assert "skipped" not in expected
+    assert skipped_calls < expected_calls
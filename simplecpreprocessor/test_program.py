@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+import pytest
+from simplecpreprocessor import program
+from simplecpreprocessor.cache import ChunkCache
+from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor.exceptions import ParseError
+from simplecpreprocessor.filesystem import FakeFile
+from simplecpreprocessor.tokens import FunctionMacro, Tokenizer
+
+
+def compiled(lines):
+    return program.compile_chunks(Tokenizer(lines, "\n").read_chunks())
+
+
+def test_directives_decoded():
+    operations = compiled(["#ifndef  GUARD\n",
+                           "#define GUARD 1\n",
+                           "#define F(a, ...) a\n",
+                           "#if GUARD > 0\n",
+                           "#include <other.h>\n",
+                           "#endif\n"])
+    assert [(op, line_no) for op, line_no, _ in operations] == [
+        ("ifndef", 0), ("define", 1), ("define", 2), ("if", 3),
+        ("include", 4), ("endif", 5)]
+    assert operations[0][2] == "GUARD"
+    name, replacement = operations[1][2]
+    assert name == "GUARD"
+    assert [token.value for token in replacement] == ["1"]
+    name, macro = operations[2][2]
+    assert name == "F"
+    assert isinstance(macro, FunctionMacro)
+    assert operations[3][2] == "GUARD > 0"
+    assert operations[4][2] == "<other.h>"
+    assert operations[5][2] is None
+
+
+def test_source_runs_merged():
+    operations = compiled(["int a;\n", "int b;\n", "#undef X\n", "c\n"])
+    assert [op for op, _, _ in operations] == [
+        program.SOURCE, "undef", program.SOURCE]
+    assert len(operations[0][2]) == 2
+    assert operations[0][1] == 0
+    assert operations[2][1] == 3
+
+
+def test_invalid_directives_deferred():
+    operations = compiled(["#warning careful\n", "#define F(a\n"])
+    assert [op for op, _, _ in operations] == [program.INVALID] * 2
+    assert "unsupported macro warning" in operations[0][2]
+    assert "Missing )" in operations[1][2]
+
+
+def test_invalid_directive_raises_new_error():
+    # Both runs execute the same cached program
+    cache = ChunkCache()
+    errors = []
+    for _ in range(2):
+        f_obj = FakeFile("header.h", ["#warning careful\n"])
+        preprocessor = Preprocessor(chunk_cache=cache)
+        with pytest.raises(ParseError) as excinfo:
+            "".join(preprocessor.preprocess(f_obj))
+        errors.append(excinfo.value)
+    assert errors[0] is not errors[1]
+    assert "unsupported macro warning" in str(errors[1])
+
+
+def test_include_once_summarized():
+    guarded = ["#ifndef G\n", "#define G\n", "#ifdef X\n", "#endif\n",
+               "#endif\n"]
+    assert program.summarize(compiled(guarded)).include_once == (
+        "G", "ifndef")
+    pragma = ["#ifdef X\n", "#endif\n", "#pragma once\n"]
+    assert program.summarize(compiled(pragma)).include_once == (
+        program.PRAGMA_ONCE)
+    unguarded = ["#ifndef G\n", "#define G\n", "#endif\n", "int x;\n"]
+    assert program.summarize(compiled(unguarded)).include_once is None
+    conditional = ["#ifdef X\n", "#pragma once\n", "#endif\n"]
+    assert program.summarize(compiled(conditional)).include_once is None
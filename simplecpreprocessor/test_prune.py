@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+from simplecpreprocessor import preprocess
+from simplecpreprocessor.filesystem import FakeFile
+from simplecpreprocessor.prune import declared_names, prune, \
+    split_declarations
+
+HEADER = """\
+typedef unsigned int size_type;
+struct buffer;
+typedef struct buffer buffer_t;
+struct buffer {
+    char *data;
+    size_type size;
+};
+enum mode { MODE_READ = 1, MODE_WRITE };
+typedef void (*callback_t)(buffer_t *, enum mode);
+struct unused { int x; } unused_var;
+int unused_function(int size_type);
+buffer_t *buffer_new(size_type size);
+static inline int helper(int x) {
+    if (x) { return MODE_READ; }
+    return 0;
+}
+void buffer_watch(buffer_t *b, callback_t callback, const char *s);
+const char *names[] = {"a;", "}"};
+"""
+
+
+def declarations(text):
+    return [tokens for _, tokens in split_declarations([text])]
+
+
+def test_split_declarations():
+    texts = [text for text, _ in split_declarations(HEADER.splitlines(True))]
+    assert len(texts) == 12
+    assert texts[3].startswith("struct buffer {")
+    assert texts[3].endswith("};")
+    assert texts[9].endswith("return 0;\n}")
+    assert texts[11] == 'const char *names[] = {"a;", "}"};'
+
+
+def test_declared_names():
+    names = [declared_names(tokens) for tokens in declarations(HEADER)]
+    assert names[:5] == [{"size_type"}, {"buffer"}, {"buffer_t"},
+                         {"buffer"}, {"mode", "MODE_READ", "MODE_WRITE"}]
+    assert names[5] == {"callback_t"}
+    assert names[6] == {"unused", "unused_var"}
+    assert names[9] == {"helper"}
+    assert names[11] == {"names"}
+
+
+def test_prune_keeps_dependencies():
+    output = "".join(prune(HEADER.splitlines(True), ["buffer_watch"]))
+    assert output == (
+        "typedef unsigned int size_type;\n"
+        "struct buffer;\n"
+        "typedef struct buffer buffer_t;\n"
+        "struct buffer {\n"
+        "    char *data;\n"
+        "    size_type size;\n"
+        "};\n"
+        "enum mode { MODE_READ = 1, MODE_WRITE };\n"
+        "typedef void (*callback_t)(buffer_t *, enum mode);\n"
+        "void buffer_watch(buffer_t *b, callback_t callback, "
+        "const char *s);\n")
+
+
+def test_prune_preprocessed_output():
+    f_obj = FakeFile("header.h", ["#define SIZE 4\n",
+                                  "typedef int value_t[SIZE];\n",
+                                  "value_t *get(void);\n",
+                                  "int other(void);\n"])
+    output = prune(preprocess(f_obj), ["get", "missing"])
+    assert "".join(output) == "typedef int value_t[4];\nvalue_t *get(void);\n"
+
+
+def test_constants_split_between_chunks():
+    f_obj = FakeFile("header.h", ["#define OPEN '{'\n",
+                                  "static int f(void) { return OPEN; }\n",
+                                  "int g(void);\n"])
+    output = list(preprocess(f_obj))
+    assert "".join(prune(output, ["g"])) == "int g(void);\n"
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+import mock
+from simplecpreprocessor.cache import ChunkCache, SharedChunkCache
+from simplecpreprocessor.core import Preprocessor
+from simplecpreprocessor.filesystem import FakeFile, FakeHandler
+
+OTHER = ["#ifndef OTHER_H\n", "#define OTHER_H\n", "#define Y X\n",
+         '#include "nested.h"\n', "Y Z;\n", "#endif\n"]
+
+
+def run(cache, handler, value="1"):
+    f_obj = FakeFile("main.h", ["#define X %s\n" % value,
+                                '#include "other.h"\n',
+                                '#include "other.h"\n',
+                                "Y\n"])
+    preprocessor = Preprocessor(header_handler=handler, chunk_cache=cache,
+                                reuse_output=True)
+    with mock.patch.object(preprocessor, "execute",
+                           wraps=preprocessor.execute) as execute:
+        output = "".join(preprocessor.preprocess(f_obj))
+    return output, execute.call_count
+
+
+def test_summary_recorded():
+    handler = FakeHandler({"other.h": OTHER, "nested.h": ["int n;\n"]})
+    cache = ChunkCache()
+    assert run(cache, handler) == ("int n;\n1 Z;\n1\n", 3)
+    key, = [key for key in cache.recordings if key[0] == "other.h"]
+    recorded, = cache.recordings[key]
+    assert recorded.tested == {"OTHER_H"}
+    assert recorded.defined == {"OTHER_H", "Y"}
+    assert recorded.expanded == {"X", "Y"}
+    assert recorded.reads["X"] == ("1",)
+    assert recorded.reads["Z"] is None
+    # The guard is read before other.h defines it, Y only after
+    assert recorded.reads["OTHER_H"] is None
+    assert "Y" not in recorded.reads
+    assert recorded.output == "int n;\n1 Z;\n"
+
+
+def test_output_reused_when_reads_unchanged():
+    handler = FakeHandler({"other.h": OTHER, "nested.h": ["int n;\n"]})
+    cache = ChunkCache()
+    run(cache, handler)
+    # Only main.h runs, the include guard still applies to the copy
+    assert run(cache, handler) == ("int n;\n1 Z;\n1\n", 1)
+    # nested.h doesn't read X so it's still reused
+    assert run(cache, handler, "2") == ("int n;\n2 Z;\n2\n", 2)
+    assert run(cache, handler, "1") == ("int n;\n1 Z;\n1\n", 1)
+
+
+def test_changed_nested_header_not_reused():
+    nested = ["int n;\n"]
+    handler = FakeHandler({"other.h": OTHER, "nested.h": nested})
+    cache = ChunkCache()
+    run(cache, handler)
+    nested[0] = "int m;\n"
+    assert run(cache, handler) == ("int m;\n1 Z;\n1\n", 3)
+
+
+def test_persisted_in_shared_cache(tmpdir):
+    handler = FakeHandler({"other.h": OTHER, "nested.h": ["int n;\n"]})
+    run(SharedChunkCache(str(tmpdir)), handler)
+    assert len(tmpdir.listdir(lambda path: path.ext == ".rec")) == 2
+    cache = SharedChunkCache(str(tmpdir))
+    assert run(cache, handler) == ("int n;\n1 Z;\n1\n", 1)
+
+
+def test_recordings_persisted_as_data(tmpdir):
+    macro = ["#pragma once\n", "#define F(a, b) [a] #b x ## a\n",
+             "#define G F(X, 2)\n", "#define Y G\n"]
+    handler = FakeHandler({"other.h": macro, "nested.h": []})
+    run(SharedChunkCache(str(tmpdir)), handler)
+    cache = SharedChunkCache(str(tmpdir))
+    rec, = tmpdir.listdir(lambda path: path.ext == ".rec")
+    assert rec.read_binary().startswith(b"SCPR")
+    assert run(cache, handler) == ('[1]"2" xX\n', 1)
+    key, = cache.recordings
+    recorded, = cache.recordings[key]
+    assert recorded.defined == {"F", "G", "Y"}
+    assert recorded.include_once["other.h"] == "pragma_once"
+    assert [token.value for token in recorded.changes["G"]] == \
+        ["F", "(", "X", ",", " ", "2", ")"]
+    f_obj = FakeFile("main.c", ['#include "other.h"\n', "F(y, z)\n"])
+    preprocessor = Preprocessor(header_handler=handler, chunk_cache=cache,
+                                reuse_output=True)
+    assert "".join(preprocessor.preprocess(f_obj)) == '[y]"z" xy\n'
+
+
+def test_unreadable_recordings_ignored(tmpdir):
+    handler = FakeHandler({"other.h": OTHER, "nested.h": ["int n;\n"]})
+    run(SharedChunkCache(str(tmpdir)), handler)
+    for rec in tmpdir.listdir(lambda path: path.ext == ".rec"):
+        rec.write_binary(b"SCPR\x01\x00\x00\x00\x04\x00\x00\x00[{}]")
+    cache = SharedChunkCache(str(tmpdir))
+    assert run(cache, handler) == ("int n;\n1 Z;\n1\n", 3)
+
+
+def test_header_ending_with_guarded_include():
+    handler = FakeHandler({
+        "outer.h": ["#ifndef O\n", "#endif\n", "int a;\n",
+                    '#include "g.h"\n'],
+        "g.h": ["#ifndef G\n", "#define G\n", "int g;\n", "#endif\n"]})
+    cache = ChunkCache()
+    outputs = []
+    # Plain, recorded and replayed
+    for reuse_output in (False, True, True):
+        f_obj = FakeFile("main.c", ['#include "outer.h"\n',
+                                    '#include "outer.h"\n'])
+        preprocessor = Preprocessor(header_handler=handler,
+                                    chunk_cache=cache,
+                                    reuse_output=reuse_output)
+        outputs.append("".join(preprocessor.preprocess(f_obj)))
+        # Only g.h is included once, guarded by G
+        assert preprocessor.include_once["g.h"] == ("G", "ifndef")
+        assert "outer.h" not in preprocessor.include_once
+    assert outputs == ["int a;\nint g;\nint a;\n"] * 3
@@ -1,15 +1,31 @@
 import re
+from simplecpreprocessor import exceptions
 
 DEFAULT_LINE_ENDING = "\n"
 TOKEN = re.compile((r"<\w+(?:/\w+)*(?:\.\w+)?>|L?\".+\"|'\w'|/\*|"
                     r"\*/|//|\b\w+\b|\r\n|\n|[ \t]+|\W"))
+# Same as TOKEN but for ASCII-compatible bytes. Runs of non-ASCII bytes are
+# kept together so multibyte characters decode correctly.
+BYTES_TOKEN = re.compile((br"<\w+(?:/\w+)*(?:\.\w+)?>|L?\".+\"|'\w'|/\*|"
+                          br"\*/|//|\b\w+\b|\r\n|\n|[ \t]+|"
+                          br"[\x80-\xff]+|\W"))
 DOUBLE_QUOTE = '"'
 SINGLE_QUOTE = "'"
 CHAR = re.compile(r"^'\w'$")
 CHUNK_MARK = object()
+# Yielded in place of a chunk when pushed input runs out
+PAUSE = object()
 RSTRIP = object()
 COMMENT_START = ("/*", "//")
 LINE_ENDINGS = ("\r\n", "\n")
+VA_ARGS = "__VA_ARGS__"
+LITERAL = "literal"
+EXPANDED = "expanded"
+RAW = "raw"
+STRINGIFIED = "stringified"
+PASTE = "paste"
+# Macro expansions between checks of the deadline
+CHECK_INTERVAL = 256
 
 
 def _tokenize(line_no, line, line_ending):
@@ -20,6 +36,17 @@ def _tokenize(line_no, line, line_ending):
         yield Token.from_string(line_no, s)
 
 
+def tokenizer_for(f_obj, line_ending):
+    """
+    Returns a tokenizer for given file. Files may provide their own through
+    a tokenizer method taking the line ending.
+    """
+    tokenizer = getattr(f_obj, "tokenizer", None)
+    if tokenizer is None:
+        return Tokenizer(f_obj, line_ending)
+    return tokenizer(line_ending)
+
+
 class Token(object):
     __slots__ = ["line_no", "value", "whitespace", "chunk_mark"]
 
@@ -38,40 +65,334 @@ class Token(object):
         return cls(line_no, value, False)
 
     def __repr__(self):
-        return "Line {}, value {!r}".format(self.line_no, self.value)  # pragma: no cover
+        return "Line {}, value {!r}".format(  # pragma: no cover
+            self.line_no, self.value)
+
+
+def strip_whitespace(tokens):
+    start = 0
+    end = len(tokens)
+    while start < end and tokens[start].whitespace:
+        start += 1
+    while end > start and tokens[end - 1].whitespace:
+        end -= 1
+    return tokens[start:end]
+
+
+def stringify(tokens):
+    parts = []
+    for token in strip_whitespace(tokens):
+        if token.whitespace:
+            if parts[-1] != " ":
+                parts.append(" ")
+        elif token.value.lstrip("L")[:1] in (DOUBLE_QUOTE, SINGLE_QUOTE):
+            value = token.value.replace("\\", "\\\\")
+            parts.append(value.replace(DOUBLE_QUOTE, '\\"'))
+        else:
+            parts.append(token.value)
+    return '"%s"' % "".join(parts)
+
+
+class FunctionMacro(object):
+    """
+    Function-like macro compiled once into a substitution template of
+    literal tokens and argument slots. Slots take an argument macro
+    expanded, unexpanded next to ## or stringified after #.
+    """
+
+    def __init__(self, params, body):
+        self.params = params
+        self.variadic = bool(params) and params[-1] == VA_ARGS
+        self.template = self._compile(strip_whitespace(body))
+
+    @classmethod
+    def from_template(cls, params, template):
+        """
+        Returns a macro with an already compiled template, such as one read
+        back from a cache.
+        """
+        macro = cls(params, [])
+        macro.template = template
+        return macro
+
+    def _compile(self, body):
+        slots = {name: index for index, name in enumerate(self.params)}
+        template = []
+        raw = False
+        i = 0
+        while i < len(body):
+            token = body[i]
+            i += 1
+            if token.value == "#" and i < len(body) and body[i].value == "#":
+                while template and template[-1][0] is LITERAL and \
+                        template[-1][1].whitespace:
+                    template.pop()
+                if template and template[-1][0] is EXPANDED:
+                    template[-1] = RAW, template[-1][1]
+                template.append((PASTE, None))
+                i += 1
+                while i < len(body) and body[i].whitespace:
+                    i += 1
+                raw = True
+                continue
+            if token.value == "#":
+                j = i
+                while j < len(body) and body[j].whitespace:
+                    j += 1
+                if j < len(body) and body[j].value in slots:
+                    template.append((STRINGIFIED, slots[body[j].value]))
+                    i = j + 1
+                    raw = False
+                    continue
+            if token.value in slots:
+                kind = RAW if raw else EXPANDED
+                template.append((kind, slots[token.value]))
+            else:
+                template.append((LITERAL, token))
+            raw = False
+        return template
+
+    def arguments(self, name, line_no, arguments):
+        """
+        Checks argument count of an invocation, gathers variadic arguments
+        into one and strips surrounding whitespace.
+        """
+        count = len(self.params)
+        if self.variadic and len(arguments) >= count:
+            rest = arguments[count - 1:]
+            gathered = list(rest[0])
+            for argument in rest[1:]:
+                gathered.append(Token.from_constant(line_no, ","))
+                gathered.extend(argument)
+            arguments = arguments[:count - 1] + [gathered]
+        arguments = [strip_whitespace(argument) for argument in arguments]
+        if count == 0 and arguments == [[]]:
+            return []
+        if len(arguments) != count:
+            fmt = "Macro %s on line %s expects %s arguments, got %s"
+            raise exceptions.ParseError(fmt % (name, line_no, count,
+                                               len(arguments)))
+        return arguments
+
+    def substitute(self, arguments, expand):
+        """
+        Fills the template with given arguments, lists of tokens. Expanded
+        slots use expand, called at most once per argument.
+        """
+        expanded = {}
+        result = []
+        paste = False
+        for kind, item in self.template:
+            if kind is PASTE:
+                paste = True
+                continue
+            elif kind is LITERAL:
+                produced = [item]
+            elif kind is EXPANDED:
+                produced = expanded.get(item)
+                if produced is None:
+                    produced = expanded[item] = list(expand(arguments[item]))
+            elif kind is RAW:
+                produced = arguments[item]
+            else:
+                produced = [Token.from_constant(
+                    None, stringify(arguments[item]))]
+            if paste and produced and result:
+                left = result.pop()
+                pasted = Token.from_constant(left.line_no,
+                                             left.value + produced[0].value)
+                produced = [pasted] + produced[1:]
+            paste = False
+            result.extend(produced)
+        return result
 
 
 class TokenExpander(object):
-    def __init__(self, defines):
+    """
+    Expands macros in tokens. Expansions of a macro outside any other are
+    limited to max_expansion tokens output and as many nested expansions.
+    Given check_deadline, it's called with a line number every
+    CHECK_INTERVAL expansions.
+    """
+
+    def __init__(self, defines, max_expansion=None, check_deadline=None):
         self.defines = defines
         self.seen = set()
+        self.max_expansion = max_expansion
+        self.check_deadline = check_deadline
+        self.expansions = 0
+        # Replacement of each object-like macro and the values in it
+        self.replacement_values = {}
 
-    def expand_tokens(self, tokens):
+    def exceeded(self, owner):
+        fmt = "Expansion of %s on line %s exceeds %s tokens"
+        return exceptions.ParseError(fmt % (owner.value, owner.line_no,
+                                            self.max_expansion))
+
+    def read_arguments(self, tokens):
+        """
+        Reads the arguments of a function-like macro invocation. Returns
+        them as lists of tokens, or None if tokens don't start with an
+        argument list, and all tokens consumed.
+        """
+        consumed = []
         for token in tokens:
-            if token.value in self.seen:
-                yield token
-            else:
-                resolved = self.defines.get(token.value, token)
-                if resolved is token:
-                    yield token
+            consumed.append(token)
+            if not token.whitespace:
+                break
+        if not consumed or consumed[-1].value != "(":
+            return None, consumed
+        arguments = [[]]
+        depth = 0
+        for token in tokens:
+            consumed.append(token)
+            if token.value == "(":
+                depth += 1
+            elif token.value == ")":
+                if depth == 0:
+                    return arguments, consumed
+                depth -= 1
+            elif token.value == "," and depth == 0:
+                arguments.append([])
+                continue
+            arguments[-1].append(token)
+        return None, consumed
+
+    def values(self, name, replacement):
+        cached = self.replacement_values.get(name)
+        if cached is None or cached[0] is not replacement:
+            cached = replacement, frozenset(token.value
+                                            for token in replacement)
+            self.replacement_values[name] = cached
+        return cached[1]
+
+    def expand_tokens(self, tokens):
+        stream = TokenStream(tokens, self.seen)
+        owner = None
+        produced = nested = 0
+        for token in stream:
+            resolved = None
+            if token.value not in self.seen:
+                resolved = self.defines.get(token.value)
+            object_like = resolved.__class__ is list
+            if isinstance(resolved, FunctionMacro):
+                arguments, consumed = self.read_arguments(stream)
+                if arguments is None:
+                    # Not an invocation, carry on after the name
+                    stream.push(consumed)
+                    resolved = None
                 else:
-                    self.seen.add(token.value)
-                    for resolved in self.expand_tokens(resolved):
-                        yield resolved
-                    self.seen.remove(token.value)
+                    arguments = resolved.arguments(
+                        token.value, token.line_no, arguments)
+                    resolved = resolved.substitute(arguments,
+                                                   self.expand_tokens)
+            if resolved is not None:
+                if not stream.open:
+                    owner = token
+                    produced = nested = 0
+                elif self.max_expansion is not None:
+                    # Replacements expanding to nothing count too
+                    nested += 1
+                    if nested > self.max_expansion:
+                        raise self.exceeded(owner)
+                self.expansions += 1
+                if (self.check_deadline is not None and
+                        self.expansions % CHECK_INTERVAL == 0):
+                    self.check_deadline(owner.line_no)
+                if (object_like and
+                        not self.defines.any_defined(
+                            self.values(token.value, resolved))):
+                    # Object-like macro without macros to rescan, its
+                    # replacement goes out as it is
+                    if self.max_expansion is not None:
+                        produced += len(resolved)
+                        if produced > self.max_expansion:
+                            raise self.exceeded(owner)
+                    for replaced in resolved:
+                        yield replaced
+                    continue
+                # Rescanned together with the tokens that follow
+                stream.push_replacement(token.value, resolved)
+                continue
+            if self.max_expansion is not None and stream.open:
+                produced += 1
+                if produced > self.max_expansion:
+                    raise self.exceeded(owner)
+            yield token
+
+
+class Reenable(object):
+    """
+    Marks the end of a macro replacement in a token stream.
+    """
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class TokenStream(object):
+    """
+    Iterator over tokens that can have tokens pushed back in front of the
+    rest. Macro replacements are pushed back so they are rescanned together
+    with the tokens after them. The macro stays in seen, so it isn't
+    expanded again, until the end of its replacement has been read.
+    """
+
+    def __init__(self, tokens, seen):
+        self.tokens = iter(tokens)
+        self.seen = seen
+        self.pending = []
+        self.open = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.pending:
+            token = self.pending.pop()
+            if token.__class__ is not Reenable:
+                return token
+            self.seen.discard(token.name)
+            self.open -= 1
+        return next(self.tokens)
+
+    def push(self, tokens):
+        self.pending.extend(reversed(tokens))
+
+    def push_replacement(self, name, tokens):
+        self.seen.add(name)
+        self.open += 1
+        self.pending.append(Reenable(name))
+        self.push(tokens)
 
 
 class Tokenizer(object):
     NO_COMMENT = Token.from_constant(None, None)
+    # Comment open at the start of input, "/*" or "//" when lexing a range
+    # that begins inside one
+    initial_comment = None
 
-    def __init__(self, f_obj, line_ending):
-        self.source = enumerate(f_obj)
+    def __init__(self, f_obj, line_ending, line_no=0, comment=None):
+        self.source = enumerate(f_obj, line_no)
         self.line_ending = line_ending
+        self.initial_comment = comment
+
+    def _tokenize(self, line_no, line):
+        return _tokenize(line_no, line, self.line_ending)
+
+    def _comment_continues(self, line):
+        return "*/" not in line
 
     def __iter__(self):
         comment = self.NO_COMMENT
+        if self.initial_comment is not None:
+            comment = Token.from_constant(None, self.initial_comment)
         for line_no, line in self.source:
-            tokens = _tokenize(line_no, line, self.line_ending)
+            if (comment.value == "/*" and
+                    self._comment_continues(line)):
+                continue
+            tokens = self._tokenize(line_no, line)
             token = next(tokens)
             for lookahead in tokens:
                 if (token.value != "\\" and
@@ -100,6 +421,7 @@ class Tokenizer(object):
                 comment = self.NO_COMMENT
             if comment is self.NO_COMMENT:
                 yield token
+        self.final_comment = comment.value
 
     def read_chunks(self):
         chunk = []
@@ -110,3 +432,121 @@ class Tokenizer(object):
                     yield chunk
                 chunk = []
                 continue
+
+
+class PushTokenizer(object):
+    """
+    Tokenizes input pushed in pieces of text. Chunks are read as far as
+    complete lines allow, then PAUSE is yielded until more is pushed. Line
+    numbers, open comments and partial chunks carry over between pieces.
+    """
+
+    def __init__(self, line_ending):
+        self.line_ending = line_ending
+        self.lines = []
+        self.partial = ""
+        self.closed = False
+        self.line_no = 0
+        self.comment = None
+        self.chunk = []
+
+    def push(self, text):
+        text = self.partial + text
+        end = text.rfind("\n") + 1
+        self.partial = text[end:]
+        if end:
+            self.lines.extend(line + "\n"
+                              for line in text[:end - 1].split("\n"))
+
+    def close(self):
+        if self.partial:
+            self.lines.append(self.partial)
+        self.closed = True
+
+    def read_chunks(self):
+        while True:
+            lines, self.lines = self.lines, []
+            tokenizer = Tokenizer(lines, self.line_ending, self.line_no,
+                                  self.comment)
+            for token in tokenizer:
+                self.chunk.append(token)
+                if token.chunk_mark:
+                    chunk, self.chunk = self.chunk, []
+                    yield chunk
+            self.comment = tokenizer.final_comment
+            self.line_no += len(lines)
+            if self.closed:
+                return
+            yield PAUSE
+
+
+class BytesTokenizer(Tokenizer):
+    """
+    Tokenizes an ASCII-compatible buffer such as a memory map directly.
+    Lines are never copied out of the buffer and each distinct token is
+    decoded only once. Lines fully inside block comments aren't tokenized.
+    A range of the buffer starting at a line boundary can be tokenized by
+    giving its offsets, first line number and the comment open there.
+    """
+    # Buffers smaller than this are never pre-scanned for skipping
+    prescan_min_size = 64 * 1024
+
+    def __init__(self, buffer, line_ending, start=0, end=None, line_no=0,
+                 comment=None):
+        self.buffer = buffer
+        self.end = len(buffer) if end is None else end
+        self.source = self._lines(start, line_no)
+        self.line_ending = line_ending
+        self.initial_comment = comment
+        self.decoded = {}
+        self.index = None
+
+    def _lines(self, start, line_no):
+        find = self.buffer.find
+        self.position = start
+        self.next_line_no = line_no
+        while self.position < self.end:
+            start = self.position
+            line_no = self.next_line_no
+            end = find(b"\n", start, self.end) + 1
+            if end == 0:
+                end = self.end
+            self.position = end
+            self.next_line_no = line_no + 1
+            yield line_no, (start, end)
+
+    def skip_inactive(self):
+        """
+        Passes over lines up to the next one that may hold a directive.
+        Only valid between chunks, where no comment is open. Does nothing
+        unless NumPy is available.
+        """
+        if self.index is None:
+            from simplecpreprocessor import prescan
+            if (not prescan.available() or
+                    len(self.buffer) < self.prescan_min_size):
+                self.index = False
+            else:
+                self.index = prescan.DirectiveIndex(self.buffer)
+        if self.index:
+            target, lines = self.index.skip(self.position)
+            self.position = min(target, self.end)
+            self.next_line_no += lines
+
+    def _decode(self, s):
+        value = s.decode("utf-8", "replace")
+        if value in LINE_ENDINGS:
+            value = self.line_ending
+        decoded = self.decoded[s] = value, not value.strip()
+        return decoded
+
+    def _tokenize(self, line_no, line):
+        decoded = self.decoded
+        tokens = []
+        for s in BYTES_TOKEN.findall(self.buffer, *line):
+            value, whitespace = decoded.get(s) or self._decode(s)
+            tokens.append(Token(line_no, value, whitespace))
+        return iter(tokens)
+
+    def _comment_continues(self, line):
+        return self.buffer.find(b"*/", *line) < 0